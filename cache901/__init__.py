@@ -22,17 +22,23 @@ import os.path
 import sys
 
 if not hasattr(sys, "frozen") and 'wx' not in sys.modules and 'wxPython' not in sys.modules:
-    import wxversion
-    wxversion.ensureMinimal("2.8")
-import wx
+    # Only the gui needs wx. Importing, searching and the database code
+    # all run without it.
+    try:
+        import wxversion
+        wxversion.ensureMinimal("2.8")
+    except ImportError:
+        pass
 
-import cache901.config
+import cache901.progress
+import cache901.util
 import cache901.sadbobjects
 
 version = "0.7.1"
 appname = 'Cache901'
 
 def cfg():
+    import cache901.config
     return cache901.config.Config()
 
 def db(debugging=False):
@@ -41,16 +47,9 @@ def db(debugging=False):
     return cache901.sadbobjects.DBSession
 
 updating = False
-def notify(message):
-    global updating
-    try:
-        wx.GetApp().GetTopWindow().GetStatusBar().SetStatusText(message, 0)
-        if not updating:
-            updating = True
-            wx.SafeYield()
-            updating = False
-    except:
-        print "cache901.notify: %s" % message
+def notify(message, force=False):
+    # See cache901.progress for where messages go, and how often
+    cache901.progress.notify(message, force)
 
 class InvalidID(Exception):
     pass
@@ -48,6 +48,9 @@ class Cache901App(wx.App):
     def OnInit(self):
         cache901.updating = True
         sys.excepthook = Cache901ExceptionHandler
+        if cache901.cfg().progresslog:
+            # Keep a copy of every progress message
+            cache901.progress.setSinks([cache901.progress.StatusBarSink(), cache901.progress.LogFileSink(cache901.cfg().progresslog)])
         wx.InitAllImageHandlers()
         geoicons = cache901.ui.geoicons()
         splash = cache901.ui_xrc.xrcsplash(None)
@@ -82,6 +85,14 @@ class Cache901App(wx.App):
         return 0
 
 def main():
+    # py2exe builds start the gpx import workers from the frozen exe, and
+    # need this before anything else runs
+    if hasattr(sys, "frozen"):
+        try:
+            import multiprocessing
+            multiprocessing.freeze_support()
+        except ImportError:
+            pass
     if not hasattr(sys, "frozen") and 'wx' not in sys.modules and 'wxPython' not in sys.modules:
         import wxversion
         wxversion.ensureMinimal("2.8")
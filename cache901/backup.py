@@ -0,0 +1,254 @@
+"""
+Cache901 - GeoCaching Software for the Asus EEE PC 901
+Copyright (C) 2008, Michael J. Pedersen <m.pedersen@icelus.org>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+# Deduplicated database backups.
+#
+# Every database file is cut into fixed size chunks, and each chunk is
+# stored once, compressed, under its sha1 in backups/chunks. A backup is a
+# manifest listing the chunks of each file, so backing up a database in
+# which little has changed only writes the chunks which did change.
+# Backups beyond the newest backupKeep are pruned, together with any
+# chunks no remaining backup uses. The gui runs backups in a BackupThread,
+# so the app stays usable while the files are read.
+#
+# Python's sqlite3 module has no binding for sqlite's online backup api,
+# so a database is copied file by file under a write lock instead, and
+# only the quick copy holds the lock (see snapshot).
+
+import datetime
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import zlib
+
+import cache901
+import cache901.progress
+import cache901.util
+
+# A multiple of every sqlite page size, so that a changed page only ever
+# dirties the one chunk holding it
+chunksize = 256 * 1024
+
+def backupDir():
+    return os.sep.join([cache901.cfg().dbpath, 'backups'])
+
+def chunkPath(digest):
+    return os.sep.join([backupDir(), 'chunks', digest[:2], digest])
+
+def dbFiles(dbname):
+    # The files which make up a database: the file itself, and its write
+    # ahead log when there is one
+    path = os.sep.join([cache901.cfg().dbpath, '%s.sqlite' % dbname])
+    return filter(os.path.exists, [path, path + '-wal'])
+
+def storeChunk(data):
+    """
+    Stores data unless an identical chunk is already stored. Returns the
+    chunk's digest, and whether it was new.
+    """
+    digest = hashlib.sha1(data).hexdigest()
+    path = chunkPath(digest)
+    if os.path.exists(path):
+        return digest, False
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    fh = open(path + '.tmp', 'wb')
+    fh.write(zlib.compress(data))
+    fh.close()
+    os.rename(path + '.tmp', path)
+    return digest, True
+
+def loadChunk(digest):
+    return zlib.decompress(open(chunkPath(digest), 'rb').read())
+
+def snapshot(dbname, notify=cache901.notify):
+    """
+    Copies one database into the chunk store, and returns its manifest
+    lines. The files are first copied as they are to backups/snapshot,
+    inside of an immediate transaction on a connection of its own, so that
+    nobody commits to the database halfway through the copy. That only
+    takes as long as reading the files, after which the lock is released
+    again, and the copies are hashed, compressed and stored while the gui
+    (which waits for the lock no more than a few seconds) carries on
+    writing. Progress messages go to notify.
+    """
+    tmpdir = os.sep.join([backupDir(), 'snapshot'])
+    if not os.path.isdir(tmpdir):
+        os.makedirs(tmpdir)
+    copies = []
+    con = sqlite3.connect(dbFiles(dbname)[0], timeout=30, isolation_level=None)
+    try:
+        try:
+            # Empty the write ahead log into the database file first, so
+            # that there usually is no log to back up
+            con.execute('pragma wal_checkpoint(TRUNCATE)').fetchall()
+        except sqlite3.Error:
+            pass
+        notify('Copying %s' % dbname)
+        con.execute('begin immediate')
+        try:
+            for path in dbFiles(dbname):
+                copy = os.sep.join([tmpdir, os.path.basename(path)])
+                shutil.copyfile(path, copy)
+                copies.append(copy)
+        finally:
+            con.execute('rollback')
+    finally:
+        con.close()
+    lines = []
+    newchunks = 0
+    try:
+        for copy in copies:
+            size = os.path.getsize(copy)
+            digests = []
+            fh = open(copy, 'rb')
+            data = fh.read(chunksize)
+            while data:
+                digest, new = storeChunk(data)
+                digests.append(digest)
+                newchunks += new
+                notify('Backing up %s: %d%%' % (os.path.basename(copy), 100 * len(digests) * chunksize / max(size, 1)))
+                data = fh.read(chunksize)
+            fh.close()
+            lines.append('\t'.join([os.path.basename(copy), str(size)] + digests))
+    finally:
+        for copy in copies:
+            os.remove(copy)
+    return lines, newchunks
+
+def backup(keep=None, notify=cache901.notify):
+    """
+    Backs up every database, then prunes all but the newest keep backups
+    (by default the backupKeep setting), never counting the new one. Returns
+    the name of the new backup. Progress messages go to notify.
+    """
+    if keep is None:
+        keep = cache901.cfg().backupkeep
+    # Names sort by age, as long as they are all the same length
+    name = 'Cache901_Backup-%s' % datetime.datetime.now().strftime('%Y-%m-%dT%H-%M-%S.%f')
+    lines = []
+    newchunks = 0
+    for dbname in cache901.util.getDbList():
+        dblines, dbnew = snapshot(dbname, notify)
+        lines.extend(dblines)
+        newchunks += dbnew
+    if not os.path.isdir(backupDir()):
+        os.makedirs(backupDir())
+    fh = open(os.sep.join([backupDir(), '%s.manifest' % name]), 'w')
+    fh.write('\n'.join(lines) + '\n')
+    fh.close()
+    total = sum(map(lambda x: len(x.split('\t')) - 2, lines))
+    prune(max(keep, 1))
+    notify('Backup %s done: %d of %d chunks were new' % (name, newchunks, total), True)
+    return name
+
+class BackupThread(threading.Thread):
+    """
+    Runs backup() in a thread of its own, reporting progress to the gui
+    thread. keep is read up front, since the settings belong to the gui.
+    backupname is the new backup once the thread is done, and error whatever
+    went wrong, if anything did.
+    """
+    def __init__(self, keep=None):
+        threading.Thread.__init__(self)
+        if keep is None:
+            keep = cache901.cfg().backupkeep
+        self.keep = keep
+        self.backupname = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.backupname = backup(self.keep, cache901.progress.threadNotify)
+        except Exception, e:
+            self.error = e
+            cache901.progress.threadNotify('Backup failed: %s' % e, True)
+
+def listBackups():
+    # Backup names, oldest first
+    if not os.path.isdir(backupDir()):
+        return []
+    return sorted(map(lambda x: x[:-len('.manifest')], filter(lambda x: x.endswith('.manifest'), os.listdir(backupDir()))))
+
+def readManifest(name):
+    """
+    Returns a list of (file name, size, chunk digests) for a backup. The
+    manifest has one tab separated line per file, since database names may
+    hold spaces.
+    """
+    files = []
+    for line in open(os.sep.join([backupDir(), '%s.manifest' % name])):
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) > 1:
+            files.append((fields[0], int(fields[1]), fields[2:]))
+    return files
+
+def prune(keep):
+    """
+    Deletes all but the newest keep backups, and every chunk which none of
+    the remaining ones use.
+    """
+    backups = listBackups()
+    for name in backups[:max(len(backups) - keep, 0)]:
+        os.remove(os.sep.join([backupDir(), '%s.manifest' % name]))
+    used = set()
+    for name in listBackups():
+        for fname, size, digests in readManifest(name):
+            used.update(digests)
+    chunkdir = os.sep.join([backupDir(), 'chunks'])
+    if not os.path.isdir(chunkdir):
+        return
+    for subdir in os.listdir(chunkdir):
+        for digest in os.listdir(os.sep.join([chunkdir, subdir])):
+            if digest not in used:
+                os.remove(os.sep.join([chunkdir, subdir, digest]))
+
+def restore(name, dbnames=None):
+    """
+    Puts the databases in backup name back in place, or only those in
+    dbnames when it is given. The open database is closed first; the next
+    call to cache901.db() opens it again.
+    """
+    import cache901.sadbobjects
+    cache901.sadbobjects.closeDb()
+    files = readManifest(name)
+    for dbname in set(map(lambda x: x[0].split('.sqlite')[0], files)):
+        if dbnames is not None and dbname not in dbnames:
+            continue
+        path = os.sep.join([cache901.cfg().dbpath, '%s.sqlite' % dbname])
+        for suffix in ['-wal', '-shm']:
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        for fname, size, digests in files:
+            if fname.split('.sqlite')[0] != dbname:
+                continue
+            cache901.notify('Restoring %s from %s' % (fname, name), True)
+            target = os.sep.join([cache901.cfg().dbpath, fname])
+            fh = open(target + '.restore', 'wb')
+            for digest in digests:
+                fh.write(loadChunk(digest))
+            fh.close()
+            if os.path.getsize(target + '.restore') != size:
+                os.remove(target + '.restore')
+                raise IOError('Backup %s of %s is damaged' % (name, fname))
+            if os.path.exists(target):
+                os.remove(target)
+            os.rename(target + '.restore', target)
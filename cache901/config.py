@@ -34,18 +34,51 @@ import os
 import os.path
 import sys
 
-import wx
+try:
+    import wx
+except ImportError:
+    wx = None
 
 import cache901
 import cache901.util
 
+class MemoryConfig(object):
+    """
+    Holds settings in memory, for running without wx (scripts, benchmarks).
+    Implements just the parts of wx.Config which Config uses, and saves
+    nothing.
+    """
+    def __init__(self):
+        self.path = '/'
+        self.values = {}
+
+    def SetPath(self, path):
+        self.path = path
+
+    def HasEntry(self, key):
+        return (self.path, key) in self.values
+
+    def Read(self, key, default=''):
+        return self.values.get((self.path, key), default)
+    ReadInt = Read
+    ReadBool = Read
+
+    def Write(self, key, value):
+        self.values[(self.path, key)] = value
+        return True
+    WriteInt = Write
+    WriteBool = Write
+
 class Config(object):
     __shared_state = {}
     def __init__(self):
         self.__dict__ = self.__shared_state
         if not hasattr(self, "config"):
-            self.config = wx.Config(cache901.appname)
-            wx.Config.Set(self.config)
+            if wx is None:
+                self.config = MemoryConfig()
+            else:
+                self.config = wx.Config(cache901.appname)
+                wx.Config.Set(self.config)
     
     def getDbMaxLogs(self):
         self.config.SetPath('/PerMachine')
@@ -56,6 +89,88 @@ class Config(object):
         self.config.WriteInt("maxLogs", maxLogs)
         return maxLogs
     
+    def getImportChunkSize(self):
+        self.config.SetPath('/PerMachine')
+        return self.config.ReadInt('importChunkSize', 250)
+    
+    def setImportChunkSize(self, size):
+        self.config.SetPath('/PerMachine')
+        self.config.WriteInt('importChunkSize', size)
+        return size
+    
+    def getCompressText(self):
+        self.config.SetPath('/PerMachine')
+        return self.config.ReadBool('compressText', False)
+    
+    def setCompressText(self, compress):
+        self.config.SetPath('/PerMachine')
+        self.config.WriteBool('compressText', compress)
+        return compress
+    
+    def getDbProfile(self):
+        self.config.SetPath('/PerMachine')
+        return self.config.Read('dbProfile', 'netbook-low-memory')
+    
+    def setDbProfile(self, name):
+        self.config.SetPath('/PerMachine')
+        self.config.Write('dbProfile', name)
+        return name
+    
+    def getBackupKeep(self):
+        self.config.SetPath('/PerMachine')
+        return self.config.ReadInt('backupKeep', 7)
+    
+    def setBackupKeep(self, keep):
+        self.config.SetPath('/PerMachine')
+        self.config.WriteInt('backupKeep', keep)
+        return keep
+    
+    def getSearchAllDbs(self):
+        self.config.SetPath('/PerMachine')
+        return self.config.ReadBool('searchAllDbs', False)
+    
+    def setSearchAllDbs(self, searchall):
+        self.config.SetPath('/PerMachine')
+        self.config.WriteBool('searchAllDbs', searchall)
+        return searchall
+    
+    def getMemoryCopy(self):
+        self.config.SetPath('/PerMachine')
+        return self.config.ReadBool('memoryCopy', False)
+    
+    def setMemoryCopy(self, memory):
+        self.config.SetPath('/PerMachine')
+        self.config.WriteBool('memoryCopy', memory)
+        return memory
+    
+    def getMemoryCeiling(self):
+        self.config.SetPath('/PerMachine')
+        return self.config.ReadInt('memoryCeiling', 128)
+    
+    def setMemoryCeiling(self, megabytes):
+        self.config.SetPath('/PerMachine')
+        self.config.WriteInt('memoryCeiling', megabytes)
+        return megabytes
+    
+    def getProgressLog(self):
+        self.config.SetPath('/PerMachine')
+        if not self.config.HasEntry('progressLog'): return None
+        return self.config.Read('progressLog')
+    
+    def setProgressLog(self, path):
+        self.config.SetPath('/PerMachine')
+        self.config.Write('progressLog', path)
+        return path
+    
+    def getSaveImportStats(self):
+        self.config.SetPath('/PerMachine')
+        return self.config.ReadBool('saveImportStats', False)
+    
+    def setSaveImportStats(self, save):
+        self.config.SetPath('/PerMachine')
+        self.config.WriteBool('saveImportStats', save)
+        return save
+    
     def getGpsType(self):
         self.config.SetPath('/PerMachine')
         return self.config.Read('GPSType', 'nmea')
@@ -325,6 +440,15 @@ class Config(object):
         return colOrderList
         
     dbMaxLogs          = property(getDbMaxLogs,          setDbMaxLogs)
+    saveimportstats    = property(getSaveImportStats,    setSaveImportStats)
+    progresslog        = property(getProgressLog,        setProgressLog)
+    importchunksize    = property(getImportChunkSize,    setImportChunkSize)
+    compresstext       = property(getCompressText,       setCompressText)
+    dbprofile          = property(getDbProfile,          setDbProfile)
+    backupkeep         = property(getBackupKeep,         setBackupKeep)
+    searchalldbs       = property(getSearchAllDbs,       setSearchAllDbs)
+    memorycopy         = property(getMemoryCopy,         setMemoryCopy)
+    memoryceiling      = property(getMemoryCeiling,      setMemoryCeiling)
     gpstype            = property(getGpsType,            setGpsType)
     gpsport            = property(getGpsPort,            setGpsPort)
     degdisplay         = property(getDegDisplay,         setDegDisplay)
@@ -0,0 +1,230 @@
+"""
+Cache901 - GeoCaching Software for the Asus EEE PC 901
+Copyright (C) 2008, Michael J. Pedersen <m.pedersen@icelus.org>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+# Federated searches over several databases.
+#
+# The databases are attached to a connection of their own, which is read
+# only, and each is only attached when a search first needs it. They are
+# never migrated, maintained or opened through the main session, so a
+# database has to be opened on its own once after an upgrade before it
+# can be searched this way. What their triggers queued for cache_status
+# and the full text index is caught up with just before they are
+# attached, the way a search of the open database would (see update).
+#
+# A search is the statement search.execSearch() builds for the open
+# database, rewritten once per attached database to use that database's
+# tables, so every database is searched against its own indexes. The
+# results of all of them are sorted together in sql, and each one is
+# labelled with the database it came from.
+
+import os
+
+from sqlalchemy import MetaData, Table, Column, create_engine, literal, select, union_all
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.interfaces import PoolListener
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.expression import _UnaryExpression
+from sqlalchemy.sql import operators
+
+import cache901
+import cache901.sadbobjects
+
+engine = None
+# Database name -> schema name, for the databases attached so far
+attached = {}
+# Schema name -> {table: the same table in that schema}
+schemas = {}
+
+class ReadOnlyListener(PoolListener):
+    def connect(self, dbapi_con, con_record):
+        dbapi_con.execute('pragma query_only = 1')
+
+def getEngine():
+    global engine
+    if engine is None:
+        # An in memory database is always the same connection, so what is
+        # attached to it stays attached
+        engine = create_engine('sqlite://', listeners=[ReadOnlyListener(), cache901.sadbobjects.FunctionListener()])
+    return engine
+
+def close():
+    global engine
+    if engine is not None:
+        engine.dispose()
+        engine = None
+    attached.clear()
+    schemas.clear()
+
+def latestVersion():
+    return len(filter(lambda x: x.startswith('db_v'), dir(cache901.sadbobjects)))
+
+def sourceTables():
+    sa = cache901.sadbobjects
+    return sa.metadata.sorted_tables + sa.spatialmeta.sorted_tables + sa.fulltextmeta.sorted_tables
+
+def update(path):
+    """
+    Brings cache_status and the full text index of the database at path up
+    to date, over a connection of its own. Only the open database is ever
+    written to, so it is the changes made while a database was last open
+    which may still be waiting. The open database itself is brought up to
+    date through the main session, before this finds nothing left to do.
+    """
+    sa = cache901.sadbobjects
+    dbengine = create_engine('sqlite:///%s' % path)
+    try:
+        con = dbengine.connect()
+        try:
+            existing = set(map(lambda x: x[0], con.execute("select name from sqlite_master")))
+            trans = con.begin()
+            if 'status_pending' in existing:
+                sa.refreshCacheStatus(con)
+            if 'fts_pending' in existing:
+                sa.syncFullText(con)
+            trans.commit()
+        finally:
+            con.close()
+    finally:
+        dbengine.dispose()
+
+def attach(dbname):
+    """
+    Attaches database dbname, unless it already is, and returns its schema
+    name. Returns None when the database is missing, or was last opened by
+    an older version, and can't be searched.
+    """
+    if attached.has_key(dbname):
+        return attached[dbname]
+    path = os.sep.join([cache901.cfg().dbpath, '%s.sqlite' % dbname])
+    if not os.path.exists(path):
+        return None
+    schema = 'fed_%d' % (len(schemas) + 1)
+    con = getEngine().connect()
+    try:
+        try:
+            con.execute('attach database ? as %s' % schema, path)
+        except OperationalError:
+            # sqlite attaches at most ten databases by default
+            cache901.notify('Not searching %s: too many databases' % dbname, True)
+            return None
+        version = con.execute('select max(version) from %s.version' % schema).scalar()
+        if version != latestVersion():
+            con.execute('detach database %s' % schema)
+            cache901.notify('Not searching %s: open it once to upgrade it' % dbname, True)
+            return None
+        try:
+            update(path)
+        except OperationalError, e:
+            # Results from a stale cache_status or index would be wrong
+            con.execute('detach database %s' % schema)
+            cache901.notify('Not searching %s: %s' % (dbname, e.orig), True)
+            return None
+    finally:
+        con.close()
+    meta = MetaData()
+    schemas[schema] = dict(map(lambda x: (x, x.tometadata(meta, schema=schema)), sourceTables()))
+    attached[dbname] = schema
+    return schema
+
+def inSchema(stmt, schema):
+    # stmt, reading the tables of schema instead of those of the open
+    # database
+    tables = schemas[schema]
+    def replace(elem):
+        if isinstance(elem, Table) and tables.has_key(elem):
+            return tables[elem]
+        if isinstance(elem, Column) and tables.has_key(elem.table):
+            return tables[elem.table].c[elem.key]
+        return None
+    return visitors.replacement_traverse(stmt, {}, replace)
+
+def sortColumns(stmt):
+    # (expression, descending) for each sort column of stmt
+    cols = []
+    for col in stmt._order_by_clause.clauses:
+        if isinstance(col, _UnaryExpression) and col.modifier in (operators.desc_op, operators.asc_op):
+            cols.append((col.element, col.modifier == operators.desc_op))
+        else:
+            cols.append((col, False))
+    return cols
+
+class Result(object):
+    """
+    One result of a federated search: the cache, the extra columns of the
+    search (distance, and cache_order for cache days) and source, the name
+    of the database the cache is in. The cache is not in any session.
+    """
+    def __init__(self, cache, extras, source):
+        self.Caches = cache
+        self.source = source
+        for key, value in extras.items():
+            setattr(self, key, value)
+
+def search(qry, dbnames):
+    """
+    Runs qry, as built by search.execSearch(), in every database in
+    dbnames, and returns the results of all of them in the order qry asks
+    for. A cache in more than one database is only returned once, from
+    the first database in dbnames which has it.
+    """
+    sa = cache901.sadbobjects
+    stmt = qry.statement
+    limit = stmt._limit
+    sortcols = sortColumns(stmt)
+    cachecols = map(lambda x: x.key, filter(lambda x: getattr(x, 'table', None) is sa.Caches.__table__, stmt.inner_columns))
+    # Each database's select carries the sort columns, and its position in
+    # dbnames to break ties with
+    stmt = stmt.order_by(None).limit(None)
+    for i, (col, desc) in enumerate(sortcols):
+        stmt = stmt.column(col.label('sort_%d' % i))
+    selects = []
+    sources = []
+    for dbname in dbnames:
+        schema = attach(dbname)
+        if schema is None:
+            continue
+        selects.append(inSchema(stmt, schema).column(literal(len(sources)).label('source')))
+        sources.append(dbname)
+    if len(selects) == 0:
+        return []
+    cache901.notify('Searching %d databases' % len(selects))
+    matches = union_all(*selects).alias('federated')
+    order = []
+    for i, (col, desc) in enumerate(sortcols):
+        if desc:
+            order.append(matches.c['sort_%d' % i].desc())
+        else:
+            order.append(matches.c['sort_%d' % i])
+    fedqry = select([matches]).order_by(*(order + [matches.c.source]))
+    results = []
+    seen = set()
+    for row in getEngine().execute(fedqry):
+        values = dict(zip(row.keys(), row))
+        if values['cache_id'] in seen:
+            continue
+        seen.add(values['cache_id'])
+        cache = sa.Caches()
+        for key in cachecols:
+            setattr(cache, key, values.pop(key))
+        for key in filter(lambda x: x.startswith('sort_'), values.keys()):
+            del values[key]
+        results.append(Result(cache, values, sources[values.pop('source')]))
+        if limit is not None and len(results) >= limit:
+            break
+    return results
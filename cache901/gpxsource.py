@@ -45,16 +45,19 @@ import cache901.ui
 import cache901.ui_xrc
 import cache901.validators
 
-from cache901.xml901 import parse
+from cache901.xml901 import parse, gpxSources, importSources, ImportStats
 from cache901.sadbobjects import *
 from cache901 import sadbobjects
 from sqlalchemy import func, and_
+from sqlalchemy.orm import undefer
 
 class GPXSource(object):
     # Objects of this interface must be iterable. Furthermore, they must
     # return the next gpx file in their data set. Callers will only care
     # about the gpx files, so only those get returned.
-    # gpx objects are required to be file contents as a single string
+    # gpx objects should be file-like objects (open files, zip members,
+    # StringIO around an email payload) so the parser can stream them. A
+    # plain string is accepted as well.
     def __iter__(self):
         return self
     
@@ -68,14 +71,21 @@ class FolderSource(GPXSource):
         self.zipfiles = filter(lambda x: x.lower().endswith('.zip'), os.listdir(folder))
         self.gpxzip = []
         self.z = None
+    
+    def sources(self):
+        # The gpx files and zip members of the folder, as importSources
+        # takes them
+        sources = []
+        for fname in self.gpxfiles + self.zipfiles:
+            sources.extend(gpxSources(os.sep.join([self.folder, fname])))
+        return sources
         
     def next(self):
         ext = ""
         if len(self.gpxfiles) > 0:
             fname = self.gpxfiles.pop()
             cache901.notify('Processing %s' % fname)
-            f = open(os.sep.join([self.folder, fname]))
-            return "\n".join(f.readlines())
+            return open(os.sep.join([self.folder, fname]))
         if len(self.zipfiles) > 0:
             if self.z is None:
                 fname = self.zipfiles[-1]
@@ -83,7 +93,7 @@ class FolderSource(GPXSource):
                 self.gpxzip = filter(lambda x: x.lower().endswith('.gpx'), self.z.namelist())
             if len(self.gpxzip) > 0:
                 cache901.notify('Processing %s' % os.sep.join([fname, self.gpxzip[-1]]))
-                return self.z.read(self.gpxzip.pop())
+                return self.z.open(self.gpxzip.pop())
             else:
                 self.z = None
                 self.zipfiles.pop()
@@ -119,7 +129,7 @@ class PopSource(GPXSource):
                         isinstance(part, email.message.Message)
                         fname = part.get_filename('').lower()
                         if fname.endswith('.gpx'):
-                            return part.get_payload(decode=True)
+                            return StringIO(part.get_payload(decode=True))
                         if fname.endswith('.zip'):
                             self.zfile = zipfile.ZipFile(StringIO(part.get_payload(decode=True)))
                             self.gpxlist = filter(lambda x: x.lower().endswith('.gpx'), self.zfile.namelist())
@@ -131,7 +141,7 @@ class PopSource(GPXSource):
                     return '<gpx></gpx>'
                 fname = self.gpxlist.pop()
                 cache901.notify('Processing Message %d, Zip Attachment, File %s' % (self.count, fname))
-                return self.zfile.read(fname)
+                return self.zfile.open(fname)
         raise StopIteration
 
 class IMAPSource(GPXSource):
@@ -171,7 +181,7 @@ class IMAPSource(GPXSource):
                                     fname = header[header.find('name')+5:]
                         if fname.endswith('.gpx'):
                             cache901.notify('Found gpx file, processing')
-                            return part.get_payload(decode=True)
+                            return StringIO(part.get_payload(decode=True))
                         if fname.endswith('.zip'):
                             cache901.notify('Found zip file, trying to load')
                             self.zfile = zipfile.ZipFile(StringIO(part.get_payload(decode=True)))
@@ -191,7 +201,7 @@ class IMAPSource(GPXSource):
                     self.count = self.count + 1
                     return '<gpx></gpx>'
                 cache901.notify('Processing Message %s, Zip Attachment, File %s' % (self.msgnums[self.count], self.gpxlist[-1]))
-                return self.zfile.read(self.gpxlist.pop())
+                return self.zfile.open(self.gpxlist.pop())
         raise StopIteration
 
 class GeoCachingComSource(GPXSource):
@@ -367,31 +377,39 @@ def gpxSyncAll(callingwin):
     for imap in dbsession.query(sadbobjects.EmailSources).filter(sadbobjects.EmailSources.svrtype == 'imap'):
         imapaccts.append(imap.emailid)
         
-    # Synchronize folders
-    for folder in folders:
-        fld = FolderSource(folder)
-        for gpxfile in fld:
-            parse(gpxfile, False)
-    
-    # Synchronize POP3 sources
-    for popid in popaccts:
-        email = cache901.db().query(sadbobjects.EmailSources).get(popid)
-        popsrc = PopSource(email.svrname, email.svruser, email.svrpass, email.usessl)
-        for gpxfile in popsrc:
-            parse(gpxfile, False)
-    cache901.notify('Completed syncing pop3 accounts')
-            
-    # Synchronize IMAP4 sources
-    for imapid in imapaccts:
-        email = cache901.db().query(sadbobjects.EmailSources).get(imapid)
-        cache901.notify('Syncing imap:%s@%s' % (email.svruser, email.svrname))
-        imapsrc = IMAPSource(email.svrname, email.svruser, email.svrpass, email.usessl, email.deffolder)
-        for gpxfile in imapsrc:
-            parse(gpxfile, False)
-    cache901.notify('Completed syncing imap accounts')
+    # All sources are loaded in one bulk load, so the indexes are only
+    # rebuilt once, after the last file
+    stats = ImportStats()
+    sadbobjects.beginBulkLoad()
+    try:
+        # Synchronize folders, parsing the files in parallel
+        sources = []
+        for folder in folders:
+            sources.extend(FolderSource(folder).sources())
+        importSources(sources, False, True, stats=stats)
+        
+        # Synchronize POP3 sources
+        for popid in popaccts:
+            email = cache901.db().query(sadbobjects.EmailSources).get(popid)
+            popsrc = PopSource(email.svrname, email.svruser, email.svrpass, email.usessl)
+            for gpxfile in popsrc:
+                parse(gpxfile, False, True, stats)
+        cache901.notify('Completed syncing pop3 accounts')
+                
+        # Synchronize IMAP4 sources
+        for imapid in imapaccts:
+            email = cache901.db().query(sadbobjects.EmailSources).get(imapid)
+            cache901.notify('Syncing imap:%s@%s' % (email.svruser, email.svrname))
+            imapsrc = IMAPSource(email.svrname, email.svruser, email.svrpass, email.usessl, email.deffolder)
+            for gpxfile in imapsrc:
+                parse(gpxfile, False, True, stats)
+        cache901.notify('Completed syncing imap accounts')
+    finally:
+        stats.timed('indexes', sadbobjects.endBulkLoad)
             
     # Finally, perform all database maintenance
-    cache901.db().maintdb()
+    stats.timed('maint', cache901.db().maintdb)
+    return stats.finish(u'sync')
 
 class GPXSourceUI(cache901.ui_xrc.xrcGPXSourcesUI):
     def __init__(self, parent=None):
@@ -700,7 +718,7 @@ class LogUploadTable(wx.grid.PyGridTableBase):
         self.caches = {}
         self.accounts = cache901.db().query(sadbobjects.Accounts). \
             order_by(sadbobjects.Accounts.ispremium.desc(), sadbobjects.Accounts.isteam.desc()).all()
-        for log in cache901.db().query(sadbobjects.Logs).filter(and_(
+        for log in cache901.db().query(sadbobjects.Logs).options(undefer('log_entry')).filter(and_(
             sadbobjects.Logs.my_log_uploaded == 0,
             sadbobjects.Logs.finder.in_(cache901.db().query(sadbobjects.Accounts.username)))):
             self.logs.append(log)
@@ -29,6 +29,7 @@ import cache901.ui
 import cache901.util
 
 from cache901 import sadbobjects
+from cache901.util import inQuery
 
 from xml.sax.saxutils import escape
 
@@ -147,10 +148,8 @@ class KML(object):
     def writeCaches(self):
         curtype = ''
         first=True
-        qry = cache901.db().query(sadbobjects.Caches).order_by(sadbobjects.Caches.type).order_by(sadbobjects.Caches.name)
-        for cache in qry:
-            if cache.cache_id not in self.cacheids:
-                continue
+        qry = inQuery(cache901.db().query(sadbobjects.Caches), sadbobjects.Caches.cache_id, self.cacheids)
+        for cache in sorted(qry, key=lambda c: (c.type, c.name)):
             kmlname = escape("%s - %s (%1.1f / %1.1f)" % (cache901.util.forceAscii(cache.name), cache901.util.forceAscii(cache.url_name), cache.difficulty, cache.terrain))
             if cache.type != curtype:
                 curtype = cache.type
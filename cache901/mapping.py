@@ -26,6 +26,7 @@ import cache901.util
 import cache901.validators
 
 from cache901 import sadbobjects
+from cache901.util import inQuery
 
 class MapUI(cache901.ui_xrc.xrcMapUI):
     def __init__(self, parent=None, caches=[]):
@@ -40,13 +41,13 @@ class MapUI(cache901.ui_xrc.xrcMapUI):
         self.maxlat = -92.0
         self.maxlon = -182.0
         self.caches = []
-        for c in cache901.db().query(sadbobjects.Caches).order_by(sadbobjects.Caches.url_name):
-            if c.cache_id in self.cacheids:
-                self.minlat = min(self.minlat, float(c.lat))
-                self.maxlat = max(self.maxlat, float(c.lat))
-                self.minlon = min(self.minlon, float(c.lon))
-                self.maxlon = max(self.maxlon, float(c.lon))
-                self.caches.append(c)
+        for c in inQuery(cache901.db().query(sadbobjects.Caches), sadbobjects.Caches.cache_id, self.cacheids):
+            self.minlat = min(self.minlat, float(c.lat))
+            self.maxlat = max(self.maxlat, float(c.lat))
+            self.minlon = min(self.minlon, float(c.lon))
+            self.maxlon = max(self.maxlon, float(c.lon))
+            self.caches.append(c)
+        self.caches.sort(key=lambda c: c.url_name)
                 
         self.searches = []
         for w in cache901.db().query(sadbobjects.Locations).filter(sadbobjects.Locations.loc_type == 2).order_by(sadbobjects.Locations.name):
@@ -45,6 +45,7 @@ class OptionsUI(cache901.ui_xrc.xrcOptionsUI):
         self.locSplit.SetValidator(cache901.validators.splitValidator("optsplitloc"))
         self.acctTabSplit.SetValidator(cache901.validators.splitValidator("optsplitacct"))
         self.maxLogs.SetValidator(cache901.validators.spinCtlValidator("dbMaxLogs"))
+        self.compressText.SetValidator(cache901.validators.checkBoxValidator("compresstext"))
         
         w,h = self.GetTextExtent("QQQQQQQQQQQQQQQQQQ")
         self.cacheDays.InsertColumn(0, 'Cache Day', width=w)
@@ -473,6 +474,7 @@ class OptionsUI(cache901.ui_xrc.xrcOptionsUI):
         isinstance(self.gpsbabelPath, wx.StaticText)
         isinstance(self.getFromGPS,   wx.Button)
         isinstance(self.maxLogs,      wx.SpinCtrl)
+        isinstance(self.compressText, wx.CheckBox)
         
         # Search Tab
         isinstance(self.search,    wx.Panel)
@@ -0,0 +1,180 @@
+"""
+Cache901 - GeoCaching Software for the Asus EEE PC 901
+Copyright (C) 2008, Michael J. Pedersen <m.pedersen@icelus.org>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import sys
+import time
+
+import cache901
+
+class Sink(object):
+    """
+    A destination for progress messages. Sinks only ever see the messages
+    the Progress reporter lets through, so they may be slow.
+    """
+    def show(self, message):
+        pass
+
+    def later(self, delay, func):
+        """
+        Calls func after delay seconds, if the sink has a way to, so that
+        a held message still goes out when no other one follows it.
+        Returns whether it will.
+        """
+        return False
+
+class NullSink(Sink):
+    """
+    Drops every message, for benchmarks and anything else which should not
+    pay for progress reporting.
+    """
+    pass
+
+class ConsoleSink(Sink):
+    def __init__(self, stream=None):
+        if stream is None:
+            stream = sys.stdout
+        self.stream = stream
+
+    def show(self, message):
+        self.stream.write("cache901.notify: %s\n" % message)
+
+class LogFileSink(Sink):
+    def __init__(self, path):
+        self.fh = open(path, 'a')
+
+    def show(self, message):
+        self.fh.write('%s %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S'), message))
+        self.fh.flush()
+
+    def close(self):
+        self.fh.close()
+
+class StatusBarSink(Sink):
+    """
+    Puts messages in the status bar of the application's top window, then
+    lets the event loop run so the window repaints. wx is only imported
+    here, when the first message is shown.
+    """
+    def show(self, message):
+        import wx
+        wx.GetApp().GetTopWindow().GetStatusBar().SetStatusText(message, 0)
+        if not cache901.updating:
+            cache901.updating = True
+            try:
+                wx.SafeYield()
+            finally:
+                cache901.updating = False
+
+    def later(self, delay, func):
+        import wx
+        if wx.GetApp() is None:
+            return False
+        wx.CallLater(max(int(delay * 1000), 1), func)
+        return True
+
+class Progress(object):
+    """
+    Passes progress messages on to its sinks, at most once per interval
+    seconds. A message which arrives sooner is held back, and replaced by
+    any later one. The held message goes out once the interval has passed,
+    when a sink can call back later (the status bar does, from the event
+    loop), or else on flush(), which the end of an import, a search or
+    maintenance calls. Messages sent with force
+    set go out at once, for the last word of an operation, or to announce
+    a step which will keep the caller busy for a while.
+
+    A sink which fails hands its message to the fallback sink instead, so
+    that, as before, messages are printed when there is no window to show
+    them in.
+    """
+    def __init__(self, sinks=None, interval=0.2, fallback=None):
+        if sinks is None:
+            sinks = [StatusBarSink()]
+        if fallback is None:
+            fallback = ConsoleSink()
+        self.sinks = sinks
+        self.interval = interval
+        self.fallback = fallback
+        self.last = 0
+        self.pending = None
+        self.scheduled = False
+
+    def notify(self, message, force=False):
+        now = time.time()
+        if force or now - self.last >= self.interval:
+            self.pending = None
+            self.last = now
+            self.emit(message)
+        else:
+            self.pending = message
+            if not self.scheduled:
+                delay = self.interval - (now - self.last)
+                for sink in self.sinks:
+                    try:
+                        self.scheduled = sink.later(delay, self.flush) or self.scheduled
+                    except:
+                        pass
+
+    def flush(self):
+        self.scheduled = False
+        if self.pending is not None:
+            self.notify(self.pending, True)
+
+    def emit(self, message):
+        for sink in self.sinks:
+            try:
+                sink.show(message)
+            except:
+                self.fallback.show(message)
+
+reporter = Progress()
+
+def setSinks(sinks, interval=None):
+    """
+    Sends all further progress messages to sinks, e.g. setSinks([NullSink()])
+    for a benchmark, or setSinks([ConsoleSink(), LogFileSink(path)]) for a
+    script. interval changes the rate limit, when given.
+    """
+    reporter.flush()
+    reporter.sinks = sinks
+    if interval is not None:
+        reporter.interval = interval
+
+def notify(message, force=False):
+    reporter.notify(message, force)
+
+def threadNotify(message, force=False):
+    """
+    notify() for threads other than the gui's: the message is handed to the
+    gui thread, the only one allowed to touch its windows. Without a gui
+    the message is passed on as usual.
+    """
+    try:
+        import wx
+        app = wx.GetApp()
+    except ImportError:
+        app = None
+    if app is None:
+        notify(message, force)
+    else:
+        wx.CallAfter(notify, message, force)
+
+def flush():
+    # Sends the message held back, if there is one
+    reporter.flush()
@@ -5,16 +5,25 @@
 __all__ = ['Accounts', 'CacheDayNames', 'Categories', \
            'EmailSources', 'GpxFolders', 'Searches', 'WatchedWayPoints', \
            'Caches', 'Locations', 'AltCoords', 'Attributes', 'CacheDay', \
-           'Hints', 'Logs', 'Notes', 'Photos', 'TravelBugs']
+           'Hints', 'Logs', 'Notes', 'Photos', 'TravelBugs', 'ImportStatistics']
 
 import datetime
 import os
-import zipfile
+import re
+import sqlite3
+import threading
+import time
+import zlib
 
 from sqlalchemy import *
 from sqlalchemy.types import *
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import scoped_session, sessionmaker, relation, backref
+from sqlalchemy.interfaces import ConnectionProxy, PoolListener
+from sqlalchemy.orm import scoped_session, sessionmaker, relation, backref, deferred
+from sqlalchemy.orm import MapperExtension, EXT_CONTINUE
+from sqlalchemy.pool import StaticPool
 
 import migrate.changeset
 
@@ -27,6 +36,412 @@ maker = None
 DeclarativeBase = declarative_base()
 metadata = None
 
+# Number of statements sent to sqlite since startup. Import statistics
+# take the difference over an import.
+querycount = 0
+
+# Bumped by every statement which may change the database, and whenever a
+# database is opened, so that anything derived from the database (the
+# search result cache, see search.searchCursor) can tell when it is stale.
+generation = 0
+
+# Statements which leave the database as it is
+readonlystmt = re.compile(r'\s*(select|explain|pragma)\b', re.I)
+
+class QueryCounter(ConnectionProxy):
+    def cursor_execute(self, execute, cursor, statement, parameters, context, executemany):
+        global querycount, generation
+        querycount += 1
+        if not readonlystmt.match(statement):
+            generation += 1
+        return execute(cursor, statement, parameters, context)
+
+# Whether long text columns are written compressed (the compressText
+# setting, read by init_db and maintdb), and the shortest value which is
+# worth compressing.
+compresstext = False
+compressmin = 256
+
+class CompressedText(TypeDecorator):
+    """
+    Text which is written zlib compressed, as a blob, while compresstext is
+    on and the value is at least compressmin characters long. Blobs are
+    always decompressed when read and text is passed through untouched, so
+    a column can hold a mix of both, and turning compression on or off
+    never needs a migration to read the database.
+    """
+    impl = Text
+
+    def process_bind_param(self, value, dialect):
+        if compresstext and value is not None and len(value) >= compressmin:
+            return buffer(zlib.compress(value.encode('utf8')))
+        return value
+
+    def process_result_value(self, value, dialect):
+        if isinstance(value, buffer):
+            return zlib.decompress(value).decode('utf8')
+        return value
+
+# Storage profiles: the pragmas set on every sqlite connection. page_size
+# comes first, since it only takes effect before the database is created
+# (or, outside of WAL mode, on the next vacuum). A negative cache_size is
+# in kilobytes rather than pages.
+pragmas = ['page_size', 'journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'temp_store']
+profiles = {
+    'netbook-low-memory': {
+        'page_size'    : 4096,
+        'journal_mode' : 'WAL',
+        'synchronous'  : 'NORMAL',
+        'cache_size'   : -2048,
+        'mmap_size'    : 0,
+        'temp_store'   : 'FILE',
+        },
+    'desktop': {
+        'page_size'    : 4096,
+        'journal_mode' : 'WAL',
+        'synchronous'  : 'NORMAL',
+        'cache_size'   : -65536,
+        'mmap_size'    : 268435456,
+        'temp_store'   : 'MEMORY',
+        },
+    'bulk-import': {
+        'page_size'    : 4096,
+        'journal_mode' : 'WAL',
+        'synchronous'  : 'OFF',
+        'cache_size'   : -32768,
+        'mmap_size'    : 0,
+        'temp_store'   : 'MEMORY',
+        },
+    }
+profile = 'netbook-low-memory'
+
+class PragmaListener(PoolListener):
+    """
+    Applies the active storage profile to each connection as it is handed
+    out, and again whenever the profile has changed since the connection
+    last saw it. setProfile() therefore reaches connections which are
+    already open, starting with their next transaction.
+    """
+    def connect(self, dbapi_con, con_record):
+        # A new database file gets incremental auto vacuum, which has to be
+        # set before anything (even switching to WAL) writes to the file.
+        # For an existing database this does nothing until the next vacuum.
+        dbapi_con.execute('pragma auto_vacuum = incremental')
+        con_record.info['profile'] = None
+
+    def checkout(self, dbapi_con, con_record, con_proxy):
+        if con_record.info.get('profile') != profile:
+            applyProfile(dbapi_con, profile)
+            con_record.info['profile'] = profile
+
+# sql functions written in python, by name: (argument count, function).
+# Every connection registers all of them, see FunctionListener. init_db
+# adds the ones searches rely on.
+sqlfunctions = {}
+
+class FunctionListener(PoolListener):
+    """
+    Registers the functions in sqlfunctions with each connection the pool
+    opens, and any added by registerFunction() since then as the connection
+    is next handed out. Queries using them can then run on any connection,
+    in any thread.
+    """
+    def connect(self, dbapi_con, con_record):
+        con_record.info['functions'] = set()
+
+    def checkout(self, dbapi_con, con_record, con_proxy):
+        registered = con_record.info['functions']
+        for name in sqlfunctions.keys():
+            if name not in registered:
+                nargs, func = sqlfunctions[name]
+                dbapi_con.create_function(name, nargs, func)
+                registered.add(name)
+
+def registerFunction(name, nargs, func):
+    sqlfunctions[name] = (nargs, func)
+
+def applyProfile(dbapi_con, name):
+    settings = profiles[name]
+    cursor = dbapi_con.cursor()
+    for pragma in pragmas:
+        if settings.has_key(pragma):
+            cursor.execute('pragma %s = %s' % (pragma, settings[pragma]))
+            cursor.fetchall()
+    cursor.close()
+
+def setProfile(name):
+    """
+    Makes name the active storage profile, and returns the one it replaces,
+    so that callers can put it back when they are done.
+    """
+    global profile
+    if not profiles.has_key(name):
+        raise ValueError('Unknown storage profile: %s' % name)
+    previous = profile
+    if name != previous:
+        if DBSession is not None:
+            DBSession.commit()
+        profile = name
+    return previous
+
+# The in-memory copy (the memoryCopy setting). init_db copies the database
+# file into an in-memory database, as long as the file is no bigger than
+# memoryCeiling megabytes, and every read is served from the copy. Each
+# statement which changes the copy is run on the file as well, inside of
+# the same transaction, so the file always holds what the copy holds once
+# a transaction commits, for backups, federated searches and the next
+# start. A copy which outgrows the ceiling is dropped by maintdb, and the
+# database is opened from disk again.
+memorycopy = None
+
+# Read only statements are not written through, apart from the pragmas
+# which change the file
+writepragmas = re.compile(r'\s*pragma\s+(auto_vacuum|incremental_vacuum)\b', re.I)
+dmlstmt = re.compile(r'\s*(insert|update|delete|replace)\b', re.I)
+
+class MemoryCopy(object):
+    """
+    The connection to an in-memory copy of the database file at path, as
+    handed to the pool. It stands in for the sqlite connection of the
+    copy, and keeps a second connection to the file, which write() runs
+    the copy's changes on. Commits and rollbacks of the copy are passed on
+    to the file. The one connection and its transaction belong to the
+    thread which opened the copy (the gui's); any other thread using it
+    is refused, since its commits would be the gui's as well.
+
+    The copy is made with sql rather than sqlite's backup api, which
+    python's sqlite module does not offer: the tables are created from
+    the file's schema, filled with insert ... select through an attached
+    database, and only then indexed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.memory = None
+        self.disk = None
+        self.intransaction = False
+        self.profile = None
+        self.functions = set()
+        self.thread = None
+
+    def __getattr__(self, name):
+        return getattr(self.memory, name)
+
+    def connect(self):
+        # The pool's creator
+        cache901.notify('Copying %s into memory' % os.path.basename(self.path), True)
+        self.thread = threading.currentThread()
+        self.disk = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.memory = sqlite3.connect(':memory:', check_same_thread=False)
+        self.memory.execute('pragma page_size = %d' % self.disk.execute('pragma page_size').fetchone()[0])
+        self.memory.execute("attach database ? as disk", (self.path,))
+        try:
+            self.copy()
+        finally:
+            self.memory.commit()
+            self.memory.execute('detach database disk')
+        return self
+
+    def copy(self):
+        schema = self.memory.execute("select type, name, sql from disk.sqlite_master where sql is not null order by rowid").fetchall()
+        # Virtual tables first, as they create their own shadow tables
+        for stype, name, sql in schema:
+            if stype == 'table' and sql.lower().startswith('create virtual table'):
+                self.memory.execute(sql)
+        created = set(map(lambda x: x[0], self.memory.execute("select name from sqlite_master")))
+        for stype, name, sql in schema:
+            if stype == 'table' and name not in created and not name.startswith('sqlite_'):
+                self.memory.execute(sql)
+                created.add(name)
+        if 'sqlite_stat1' in map(lambda x: x[1], schema):
+            self.memory.execute('analyze sqlite_master')
+        created = set(map(lambda x: x[0], self.memory.execute("select name from sqlite_master")))
+        for stype, name, sql in schema:
+            if stype == 'table' and name in created and not sql.lower().startswith('create virtual table'):
+                self.memory.execute('delete from main."%s"' % name)
+                self.memory.execute('insert into main."%s" select * from disk."%s"' % (name, name))
+        for stype, name, sql in schema:
+            if stype in ('index', 'trigger', 'view'):
+                self.memory.execute(sql)
+
+    def checkThread(self):
+        if threading.currentThread() is not self.thread:
+            raise RuntimeError('The in-memory copy of the database can only be used by the thread which opened it')
+
+    def size(self):
+        # Bytes used by the copy
+        return self.memory.execute('pragma page_count').fetchone()[0] * self.memory.execute('pragma page_size').fetchone()[0]
+
+    def write(self, statement, parameters, executemany):
+        # Like python's sqlite module does for the copy, only inserts,
+        # updates and deletes open a transaction, and any other statement
+        # commits the one which is open
+        if not dmlstmt.match(statement):
+            self.commit()
+        if not self.intransaction:
+            if self.profile != profile:
+                applyProfile(self.disk, profile)
+                self.profile = profile
+            for name in sqlfunctions.keys():
+                if name not in self.functions:
+                    nargs, func = sqlfunctions[name]
+                    self.disk.create_function(name, nargs, func)
+                    self.functions.add(name)
+        if dmlstmt.match(statement) and not self.intransaction:
+            self.disk.execute('begin')
+            self.intransaction = True
+        if executemany:
+            self.disk.executemany(statement, parameters)
+        else:
+            self.disk.execute(statement, parameters)
+
+    def commit(self):
+        # The file first: should it fail, both roll back, so the copy never
+        # holds what the file does not
+        if self.intransaction:
+            try:
+                self.disk.execute('commit')
+            except sqlite3.Error:
+                self.memory.rollback()
+                self.intransaction = False
+                try:
+                    self.disk.execute('rollback')
+                except sqlite3.Error:
+                    # sqlite rolled it back already
+                    pass
+                raise
+            self.intransaction = False
+        self.memory.commit()
+
+    def rollback(self):
+        self.memory.rollback()
+        if self.intransaction:
+            self.disk.execute('rollback')
+            self.intransaction = False
+
+    def close(self):
+        self.rollback()
+        self.memory.close()
+        self.disk.close()
+        self.memory = self.disk = None
+
+class WriteThrough(QueryCounter):
+    """
+    Writes each statement which changes the in-memory copy to the
+    database file as well, once it has worked on the copy.
+    """
+    def cursor_execute(self, execute, cursor, statement, parameters, context, executemany):
+        memorycopy.checkThread()
+        result = QueryCounter.cursor_execute(self, execute, cursor, statement, parameters, context, executemany)
+        if not readonlystmt.match(statement) or writepragmas.match(statement):
+            memorycopy.write(statement, parameters, executemany)
+        return result
+
+def memoryCopyFits(path):
+    # Whether the database file at path is small enough to be copied
+    # into memory
+    size = sum(map(os.path.getsize, filter(os.path.exists, [path, path + '-wal'])))
+    return size <= cache901.cfg().memoryceiling * 1024 * 1024
+
+def checkMemoryCeiling():
+    """
+    Drops the in-memory copy once it has grown beyond the ceiling. The
+    next call to cache901.db() opens the database from disk.
+    """
+    if memorycopy is not None and memorycopy.size() > cache901.cfg().memoryceiling * 1024 * 1024:
+        cache901.notify('Database has outgrown %d MB, reading it from disk' % cache901.cfg().memoryceiling, True)
+        DBSession.commit()
+        closeDb()
+
+class UnitVectorExtension(MapperExtension):
+    """
+    Keeps the unit_x, unit_y and unit_z columns of a mapped class in step
+    with its lat and lon, for objects written through the ORM.
+    """
+    def before_insert(self, mapper, connection, instance):
+        setUnitVector(instance)
+        return EXT_CONTINUE
+
+    def before_update(self, mapper, connection, instance):
+        setUnitVector(instance)
+        return EXT_CONTINUE
+
+def setUnitVector(instance):
+    if instance.lat is None or instance.lon is None:
+        instance.unit_x, instance.unit_y, instance.unit_z = None, None, None
+    else:
+        instance.unit_x, instance.unit_y, instance.unit_z = cache901.util.unitVector(instance.lat, instance.lon)
+
+def addUnitVector(table, row):
+    # The bulk writers' counterpart of UnitVectorExtension
+    if 'unit_x' in table.c and row.has_key('lat') and row.has_key('lon'):
+        if row['lat'] is None or row['lon'] is None:
+            row['unit_x'], row['unit_y'], row['unit_z'] = None, None, None
+        else:
+            row['unit_x'], row['unit_y'], row['unit_z'] = cache901.util.unitVector(row['lat'], row['lon'])
+    return row
+
+def unitDot(cls, lat, lon):
+    """
+    The dot product of the unit vectors of the rows of cls and of lat, lon,
+    as sql. It is the cosine of the angle between the two points, so it
+    grows as the distance shrinks; see util.dotForDistance().
+    """
+    x, y, z = cache901.util.unitVector(lat, lon)
+    return cls.unit_x * x + cls.unit_y * y + cls.unit_z * z
+
+# Folded copies of the name columns, see util.searchKey(), which the name
+# searches use so that they can run off of an index
+searchkeys = {'caches': [('name', 'name_key'), ('url_name', 'url_name_key')],
+              'locations': [('name', 'name_key')]}
+
+class SearchKeyExtension(MapperExtension):
+    """
+    Keeps the search key columns of a mapped class in step with the columns
+    they fold, for objects written through the ORM.
+    """
+    def before_insert(self, mapper, connection, instance):
+        setSearchKeys(instance)
+        return EXT_CONTINUE
+
+    def before_update(self, mapper, connection, instance):
+        setSearchKeys(instance)
+        return EXT_CONTINUE
+
+def setSearchKeys(instance):
+    for col, keycol in searchkeys[instance.__tablename__]:
+        setattr(instance, keycol, cache901.util.searchKey(getattr(instance, col)))
+
+def addSearchKeys(table, row):
+    # The bulk writers' counterpart of SearchKeyExtension
+    for col, keycol in searchkeys.get(table.name, []):
+        if row.has_key(col):
+            row[keycol] = cache901.util.searchKey(row[col])
+    return row
+
+def searchKeyFilter(keycol, pattern, substring=False):
+    """
+    Returns a filter matching the rows whose search key column keycol
+    starts with pattern, in any case and with or without accents. A * (or
+    %) in pattern matches anything. The part of pattern before the first
+    wildcard is looked up as a range of the key's index, so a pattern which
+    starts with one (*wally, to find wally anywhere) scans the whole table,
+    as does setting substring, which is the same as a leading *. Words
+    inside of names and descriptions are better found with a full text
+    search.
+    """
+    key = cache901.util.searchKey(pattern).replace('%', '*')
+    if substring:
+        key = '*' + key
+    prefix = key.split('*')[0]
+    if len(prefix) > 0:
+        low, high = cache901.util.searchKeyBounds(prefix)
+        match = and_(keycol >= low, keycol < high)
+    else:
+        match = keycol != None
+    if '*' in key.rstrip('*'):
+        match = and_(match, keycol.like(key.replace('*', '%') + '%'))
+    return match
+
 def getDbVersion():
     try:
         version = DBSession.query(Version).order_by(Version.version.desc()).first().version
@@ -46,12 +461,33 @@ def init_db(debugging=False):
     else:
         url = cache901.cfg().dbfile
     
-    engine = create_engine(url)
-    engine.connect().connection.create_function("distance", 4, cache901.util.distance_exact)
+    global profile
+    profile = cache901.cfg().dbprofile
+    if not profiles.has_key(profile):
+        profile = 'netbook-low-memory'
+    registerFunction('distance', 4, cache901.util.distance_exact)
+    registerFunction('ftsrank', -1, cache901.util.ftsRank)
+    global memorycopy
+    memorycopy = None
+    if not debugging and cache901.cfg().memorycopy:
+        path = make_url(url).database
+        if memoryCopyFits(path):
+            memorycopy = MemoryCopy(path)
+        else:
+            cache901.notify('Database is over %d MB, reading it from disk' % cache901.cfg().memoryceiling, True)
+    if memorycopy is not None:
+        # One connection, since each connection to sqlite:// would be
+        # another, empty, database. Only the gui's thread may use it.
+        engine = create_engine('sqlite://', creator=memorycopy.connect, poolclass=StaticPool,
+                               proxy=WriteThrough(), listeners=[PragmaListener(), FunctionListener()])
+    else:
+        engine = create_engine(url, proxy=QueryCounter(), listeners=[PragmaListener(), FunctionListener()])
     
     maker = sessionmaker(autoflush=True, autocommit=False)
     
     DBSession = scoped_session(maker)
+    global generation
+    generation += 1
     DeclarativeBase.metadata.bind = engine
     DBSession.configure(bind=engine)
     metadata = DeclarativeBase.metadata
@@ -61,46 +497,611 @@ def init_db(debugging=False):
     while dbver < len(dbups):
         globals()['db_v%03d' % (dbver+1)]()
         dbver = getDbVersion()
+    # A bulk load which never finished leaves its indexes dropped
+    createIndexes()
+    global spatialindex
+    spatialindex = len(engine.execute("select name from sqlite_master where name='caches_rtree'").fetchall()) > 0
+    global fulltext
+    fulltext = len(engine.execute("select name from sqlite_master where name='caches_fts'").fetchall()) > 0
+    global compresstext
+    compresstext = cache901.cfg().compresstext
     
     DBSession.maintdb = maintdb
+    DBSession.idleMaint = idleMaint
     DBSession.scrub = scrub
     DBSession.backup = backup
     DBSession.delAllCaches = delAllCaches
 
-def maintdb():
-    scrub()
-    cache901.notify('Recovering unused disk space')
-    engine.execute("vacuum")
-    cache901.notify('Rebuilding database indices')
-    engine.execute("analyze")
+# Maintenance thresholds: the share of free pages which makes a full
+# vacuum worthwhile, the change in a table's row count (as a share of
+# the count at its last analyze) which makes it worth analyzing again,
+# and how long the gui has to go without input before idleMaint() runs a
+# full vacuum.
+vacuumfraction = 0.25
+analyzefraction = 0.1
+idledelay = 120
+
+# When a full vacuum became due, or None
+vacuumdue = None
+
+def pragma(name):
+    return engine.execute('pragma %s' % name).scalar()
+
+def analyzedRows():
+    """
+    Returns the row count of each table as of its last analyze, from
+    sqlite_stat1. The stat column starts with the row count.
+    """
+    if engine.execute("select count(*) from sqlite_master where name='sqlite_stat1'").scalar() == 0:
+        return {}
+    return dict(engine.execute('select tbl, max(cast(stat as integer)) from sqlite_stat1 group by tbl').fetchall())
+
+def staleTables():
+    analyzed = analyzedRows()
+    for table in metadata.sorted_tables:
+        rows = engine.execute(select([func.count()]).select_from(table)).scalar()
+        before = analyzed.get(table.name)
+        if before is None:
+            if rows > 0:
+                yield table.name
+        elif abs(rows - before) > analyzefraction * max(before, 1):
+            yield table.name
+
+def vacuum():
+    # Switching to incremental auto vacuum only takes effect on a vacuum,
+    # after which the freelist can be emptied without one
+    global vacuumdue
+    engine.execute('pragma auto_vacuum = incremental')
+    engine.execute('vacuum')
+    vacuumdue = None
+
+def incrementalVacuum():
+    engine.execute('pragma incremental_vacuum').fetchall()
+
+def planMaintenance(full=False):
+    """
+    Works out which maintenance steps the database needs, and returns them
+    as a list of (description, function) pairs. Free pages are handed back
+    with an incremental vacuum where the database allows it. A full vacuum,
+    which rewrites the whole file, is only planned when full is set; when
+    one is merely worthwhile it is noted as due, for idleMaint(). Only
+    tables whose size changed noticeably are analyzed again.
+    """
+    global vacuumdue
+    steps = []
+    pages = pragma('page_count')
+    free = pragma('freelist_count')
+    incremental = pragma('auto_vacuum') == 2
+    if full:
+        steps.append(('vacuum', vacuum))
+    elif incremental and free > 0:
+        steps.append(('incremental vacuum (%d pages)' % free, incrementalVacuum))
+    elif pages > 0 and float(free) / pages >= vacuumfraction and vacuumdue is None:
+        vacuumdue = time.time()
+    if full:
+        steps.append(('analyze', lambda: engine.execute('analyze')))
+    else:
+        for name in staleTables():
+            steps.append(('analyze %s' % name, lambda name=name: engine.execute('analyze %s' % name)))
+    return steps
+
+def runMaintenance(steps):
+    # Runs each step, and reports how long each one took
+    report = []
+    for desc, step in steps:
+        cache901.notify('Database maintenance: %s' % desc, True)
+        start = time.time()
+        step()
+        report.append((desc, time.time() - start))
+    if report:
+        cache901.notify('Database maintenance done: %s' % ', '.join(map(lambda x: '%s %3.2fs' % x, report)), True)
+    return report
+
+def maintdb(full=False):
+    """
+    Scrubs the database and runs the maintenance planMaintenance() asks
+    for. Imports call this with full unset; the Database Maintenance menu
+    item sets it, to vacuum and analyze everything. Returns a list of
+    (description, seconds) pairs, one per step.
+    """
+    steps = [('scrub', scrub), ('text storage', checkTextStorage), ('full text index', syncFullText)]
+    report = runMaintenance(steps) + runMaintenance(planMaintenance(full))
+    checkMemoryCeiling()
+    cache901.progress.flush()
+    return report
+
+def idleMaint(idle):
+    """
+    Runs a full vacuum which is due, once idle, the seconds since anybody
+    last used the gui, reaches idledelay. The gui calls this from a timer,
+    so that the vacuum never blocks somebody in the middle of their work.
+    sqlite refuses to vacuum inside of a transaction, so the session's is
+    committed first, and the vacuum waits while the session holds changes
+    nobody has saved yet. Should sqlite still refuse (another connection
+    writing, say), that is reported and the vacuum is left for the next
+    maintenance to plan again, rather than failing the timer.
+    """
+    global vacuumdue
+    if vacuumdue is None or idle < idledelay:
+        return []
+    if DBSession.new or DBSession.dirty or DBSession.deleted:
+        return []
+    DBSession.commit()
+    try:
+        return runMaintenance(planMaintenance(True))
+    except (OperationalError, sqlite3.Error), e:
+        # The in-memory copy's writes to the file fail with sqlite3's own
+        vacuumdue = None
+        cache901.notify('Database maintenance failed: %s' % getattr(e, 'orig', e), True)
+        return []
 
 
 def scrub():
+    """
+    Removes the rows left behind by caches which are gone, marks my own
+    logs, and trims every cache down to its newest dbMaxLogs logs by other
+    people. Each step is a single statement, run inside of sqlite.
+    """
     maxlogs = cache901.cfg().dbMaxLogs
-    cache901.notify('Scrubbing database of old/invalid data')
+    cache901.notify('Scrubbing database of old/invalid data', True)
     if DBSession is not None:
-        validids = DBSession.query(Caches.cache_id).all()
+        DBSession.flush()
         for objtype in [TravelBugs, Hints, Logs, Notes, Photos, CacheDay, AltCoords]:
-            for obj in DBSession.query(objtype).filter(not_(objtype.cache_id.in_(DBSession.query(Caches.cache_id)))):
-                DBSession.delete(obj)
+            DBSession.execute("""
+                delete from %(table)s
+                where cache_id is not null
+                  and not exists (select 1 from caches where caches.cache_id = %(table)s.cache_id)
+                """ % {'table': objtype.__tablename__})
         ## update logs to show my_log for any logs where finder is in gpx accounts
-        cache901.notify('Ensuring my logs are noted properly')
-        for log in DBSession.query(Logs).filter(Logs.finder.in_(DBSession.query(Accounts.username))):
-            log.my_log = 1
-        cache_id = -1
-        cache901.notify('Removing old logs')
-        for log in DBSession.query(Logs).filter(Logs.my_log != 1):
-            if log.cache_id != cache_id:
-                cache_id = log.cache_id
-                logcount = 0
-            logcount += 1
-            if logcount > maxlogs:
-                DBSession.delete(log)
+        cache901.notify('Ensuring my logs are noted properly', True)
+        DBSession.execute("""
+            update logs set my_log = 1
+            where finder in (select username from accounts)
+              and coalesce(my_log, 0) != 1
+            """)
+        cache901.notify('Removing old logs', True)
+        DBSession.execute("""
+            delete from logs
+            where coalesce(my_log, 0) != 1
+              and id not in (select newest.id from logs newest
+                             where newest.cache_id = logs.cache_id
+                               and coalesce(newest.my_log, 0) != 1
+                             order by newest.date desc, newest.id desc
+                             limit :maxlogs)
+            """, {'maxlogs': maxlogs})
         DBSession.commit()
     
 
+def compressedColumns():
+    for table in metadata.sorted_tables:
+        for col in table.c:
+            if isinstance(col.type, CompressedText):
+                yield table, col
+
+def textStorage(compress):
+    if compress:
+        return u'compressed'
+    return u'plain'
+
+def checkTextStorage():
+    """
+    Converts the text storage when the compressText setting no longer
+    matches the textstorage row in settings, which records what the last
+    conversion left behind. Otherwise this is a single primary key lookup,
+    so maintdb can call it after every import.
+    """
+    global compresstext
+    compresstext = cache901.cfg().compresstext
+    marker = DBSession.query(Settings).get(u'textstorage')
+    if marker is not None and marker.value == textStorage(compresstext):
+        return False
+    convertTextStorage()
+    if marker is None:
+        marker = Settings()
+        marker.name = u'textstorage'
+        DBSession.add(marker)
+    marker.value = textStorage(compresstext)
+    DBSession.commit()
+    return True
+
+def convertTextStorage():
+    """
+    Rewrites the compressible columns which are not stored the way the
+    compressText setting asks for: long text values are compressed when it
+    is on, and compressed values are expanded again when it is off. Only
+    the rows which need it are touched, but finding them scans every
+    table, so this is left to checkTextStorage to call.
+    """
+    global compresstext
+    compresstext = cache901.cfg().compresstext
+    for table, col in compressedColumns():
+        key = list(table.primary_key)[0]
+        if compresstext:
+            wrong = and_(func.typeof(col) == 'text', func.length(col) >= compressmin)
+        else:
+            wrong = func.typeof(col) == 'blob'
+        while True:
+            rows = DBSession.execute(select([key, col], wrong, limit=500)).fetchall()
+            if len(rows) == 0:
+                break
+            if compresstext:
+                cache901.notify('Compressing %s' % table.name)
+            else:
+                cache901.notify('Expanding %s' % table.name)
+            bulkUpdate(table, key.name, map(lambda x: { key.name: x[0], col.name: x[1] }, rows))
+            DBSession.commit()
+
+bulkloading = 0
+bulkprofile = None
+
+def beginBulkLoad():
+    """
+    Enters bulk load mode. Search indexes are dropped so that they are
+    not maintained row by row, and are rebuilt once by the matching
+    endBulkLoad(). Calls nest, so gpxSyncAll can wrap many files in a
+    single bulk load.
+    """
+    global bulkloading, bulkprofile
+    if bulkloading == 0:
+        bulkprofile = setProfile('bulk-import')
+        DBSession.commit()
+        cache901.notify('Pausing database indices for bulk load', True)
+        dropIndexes()
+    bulkloading += 1
+
+def endBulkLoad():
+    global bulkloading
+    bulkloading -= 1
+    if bulkloading == 0:
+        DBSession.commit()
+        cache901.notify('Rebuilding database indices', True)
+        createIndexes()
+        setProfile(bulkprofile)
+
+def existingIndexes():
+    return set(map(lambda x: x[0], engine.execute("select name from sqlite_master where type='index'")))
+
+# Indexes a bulk load looks rows up by, once per chunk or per row (the
+# keys of existing travel bugs and the logs of a cache).  Dropping them
+# would turn every lookup into a table scan.
+bulkkeepindexes = set(['travelbugs_ref', 'logs_cache_id'])
+
+def dropIndexes():
+    # Drops the search indexes, keeping those in bulkkeepindexes
+    existing = existingIndexes()
+    for table in metadata.sorted_tables:
+        for idx in table.indexes:
+            if idx.name in existing and idx.name not in bulkkeepindexes:
+                idx.drop()
+
+def createIndexes():
+    existing = existingIndexes()
+    for table in metadata.sorted_tables:
+        for idx in table.indexes:
+            if idx.name not in existing:
+                idx.create()
+
+# R*Tree indexes over the coordinates of caches and locations, kept up to
+# date by triggers, so that every writer (the importers, edits, deletes)
+# maintains them. They live outside of metadata, since create_all can't
+# make virtual tables. spatialindex is False when sqlite was built
+# without the rtree module; radius searches then narrow by bounding box
+# on the plain columns instead.
+spatialindex = False
+
+def spatialTable(name):
+    return Table('%s_rtree' % name, spatialmeta,
+        Column('id', Integer, primary_key=True),
+        Column('minlat', Float), Column('maxlat', Float),
+        Column('minlon', Float), Column('maxlon', Float))
+
+spatialmeta = MetaData()
+spatialtables = {'caches': spatialTable('caches'), 'locations': spatialTable('locations')}
+
+def spatialSources():
+    # (table, id column) for each table with a spatial index
+    return [(Caches.__table__, 'cache_id'), (Locations.__table__, 'wpt_id')]
+
+def createSpatialIndexes():
+    """
+    Creates, fills and hooks up the spatial index of every table which
+    does not have one yet. Returns False if sqlite has no rtree module.
+    """
+    existing = set(map(lambda x: x[0], engine.execute("select name from sqlite_master")))
+    for table, idcol in spatialSources():
+        rtree = '%s_rtree' % table.name
+        if rtree in existing:
+            continue
+        try:
+            engine.execute('create virtual table %s using rtree(id, minlat, maxlat, minlon, maxlon)' % rtree)
+        except OperationalError:
+            return False
+        parms = {'table': table.name, 'rtree': rtree, 'id': idcol}
+        engine.execute("""
+            insert into %(rtree)s
+            select %(id)s, lat, lat, lon, lon from %(table)s
+            where lat is not null and lon is not null""" % parms)
+        engine.execute("""
+            create trigger %(rtree)s_insert after insert on %(table)s
+            when new.lat is not null and new.lon is not null
+            begin
+                insert or replace into %(rtree)s values (new.%(id)s, new.lat, new.lat, new.lon, new.lon);
+            end""" % parms)
+        engine.execute("""
+            create trigger %(rtree)s_update after update of %(id)s, lat, lon on %(table)s
+            begin
+                delete from %(rtree)s where id = old.%(id)s;
+                insert into %(rtree)s select new.%(id)s, new.lat, new.lat, new.lon, new.lon
+                    where new.lat is not null and new.lon is not null;
+            end""" % parms)
+        engine.execute("""
+            create trigger %(rtree)s_delete after delete on %(table)s
+            begin
+                delete from %(rtree)s where id = old.%(id)s;
+            end""" % parms)
+    return True
+
+def withinRadius(cls, lat, lon, miles):
+    """
+    Returns a filter which matches the rows of cls (Caches or Locations)
+    inside of the bounding box of a circle of radius miles around lat, lon.
+    The box holds every row of the circle, so the exact distance only has
+    to be checked for the rows the filter lets through.
+    """
+    minlat, maxlat, minlon, maxlon = cache901.util.boundingBox(lat, lon, miles)
+    table = cls.__table__
+    if spatialindex:
+        idcol = dict(spatialSources())[table]
+        rtree = spatialtables[table.name]
+        return table.c[idcol].in_(select([rtree.c.id], and_(
+            rtree.c.maxlat >= minlat, rtree.c.minlat <= maxlat,
+            rtree.c.maxlon >= minlon, rtree.c.minlon <= maxlon)))
+    return and_(table.c.lat.between(minlat, maxlat), table.c.lon.between(minlon, maxlon))
+
+# Full text indexes: caches_fts over the names, descriptions and hint of
+# each cache (its docid is the cache_id), and logs_fts over log entries
+# (its docid is the log id). Descriptions and logs may be stored
+# compressed, which sql can't read, so triggers only note which caches and
+# logs changed in fts_pending, and syncFullText() indexes them from
+# python. Deletes are handled by the triggers alone. fulltext is False
+# when sqlite was built without fts. The last column of each table is the
+# hidden one named after the table itself, which MATCH and matchinfo()
+# take; as a column of the table, a federated search moves it to the
+# attached database along with the rest.
+fulltext = False
+fulltextmeta = MetaData()
+cachesfts = Table('caches_fts', fulltextmeta,
+    Column('docid', Integer, primary_key=True),
+    Column('name', Unicode), Column('url_name', Unicode),
+    Column('short_desc', Unicode), Column('long_desc', Unicode), Column('hint', Unicode),
+    Column('caches_fts', Unicode))
+logsfts = Table('logs_fts', fulltextmeta,
+    Column('docid', Integer, primary_key=True),
+    Column('log_entry', Unicode),
+    Column('logs_fts', Unicode))
+# How much a match in each column of caches_fts counts for
+ftsweights = [4, 4, 1, 1, 2]
+
+def createFullText():
+    """
+    Creates the full text tables and their triggers, and queues every cache
+    and log for indexing. Returns False if sqlite has no fts module.
+    """
+    existing = set(map(lambda x: x[0], engine.execute("select name from sqlite_master")))
+    if 'caches_fts' in existing:
+        return True
+    for module in ['fts4', 'fts3']:
+        try:
+            engine.execute('create virtual table caches_fts using %s(name, url_name, short_desc, long_desc, hint)' % module)
+            engine.execute('create virtual table logs_fts using %s(log_entry)' % module)
+            break
+        except OperationalError:
+            pass
+    else:
+        return False
+    engine.execute('create table fts_pending (kind integer, id integer, primary key (kind, id))')
+    for trigger, event, table, kind, row, col in [
+            ('caches_fts_insert', 'insert', 'caches', 1, 'new', 'cache_id'),
+            ('caches_fts_update', 'update of name, url_name, short_desc, long_desc', 'caches', 1, 'new', 'cache_id'),
+            ('hints_fts_insert', 'insert', 'hints', 1, 'new', 'cache_id'),
+            ('hints_fts_update', 'update of hint', 'hints', 1, 'new', 'cache_id'),
+            ('hints_fts_delete', 'delete', 'hints', 1, 'old', 'cache_id'),
+            ('logs_fts_insert', 'insert', 'logs', 2, 'new', 'id'),
+            ('logs_fts_update', 'update of log_entry', 'logs', 2, 'new', 'id')]:
+        engine.execute("""
+            create trigger %s after %s on %s
+            begin
+                insert or ignore into fts_pending values (%d, %s.%s);
+            end""" % (trigger, event, table, kind, row, col))
+    engine.execute("""
+        create trigger caches_fts_delete after delete on caches
+        begin
+            delete from caches_fts where docid = old.cache_id;
+            delete from fts_pending where kind = 1 and id = old.cache_id;
+        end""")
+    engine.execute("""
+        create trigger logs_fts_delete after delete on logs
+        begin
+            delete from logs_fts where docid = old.id;
+            delete from fts_pending where kind = 2 and id = old.id;
+        end""")
+    engine.execute('insert into fts_pending select 1, cache_id from caches')
+    engine.execute('insert into fts_pending select 2, id from logs')
+    return True
+
+def stripTags(text):
+    if text is None:
+        return None
+    return re.sub('<[^>]*>', ' ', text)
+
+def syncFullText(bind=None):
+    """
+    Indexes the caches and logs which changed since the last call. Imports
+    call this when they are done, and searches before they use the index.
+    bind is a connection to another database to index instead of the open
+    one (see federation); its caller commits.
+    """
+    if bind is None:
+        if not fulltext:
+            return
+        bind = DBSession
+    caches = Caches.__table__
+    hints = Hints.__table__
+    logs = Logs.__table__
+    pending = bind.execute('select kind, id from fts_pending').fetchall()
+    cacheids = map(lambda x: x[1], filter(lambda x: x[0] == 1, pending))
+    logids = map(lambda x: x[1], filter(lambda x: x[0] == 2, pending))
+    for i in range(0, len(cacheids), 500):
+        chunk = cacheids[i:i+500]
+        bind.execute(cachesfts.delete(cachesfts.c.docid.in_(chunk)))
+        rows = bind.execute(select([caches.c.cache_id, caches.c.name, caches.c.url_name,
+                                         caches.c.short_desc, caches.c.long_desc, hints.c.hint],
+                                        caches.c.cache_id.in_(chunk),
+                                        from_obj=[caches.outerjoin(hints, hints.c.cache_id == caches.c.cache_id)])).fetchall()
+        if len(rows) > 0:
+            bind.execute(cachesfts.insert(), map(lambda x: {
+                'docid': x[0], 'name': x[1], 'url_name': x[2], 'short_desc': stripTags(x[3]),
+                'long_desc': stripTags(x[4]), 'hint': x[5]}, rows))
+        bind.execute('delete from fts_pending where kind = 1 and id in (%s)' % ','.join(map(str, chunk)))
+    for i in range(0, len(logids), 500):
+        chunk = logids[i:i+500]
+        bind.execute(logsfts.delete(logsfts.c.docid.in_(chunk)))
+        rows = bind.execute(select([logs.c.id, logs.c.log_entry], logs.c.id.in_(chunk))).fetchall()
+        if len(rows) > 0:
+            bind.execute(logsfts.insert(), map(lambda x: {'docid': x[0], 'log_entry': x[1]}, rows))
+        bind.execute('delete from fts_pending where kind = 2 and id in (%s)' % ','.join(map(str, chunk)))
+    if bind is DBSession:
+        DBSession.commit()
+
+def fullTextHits(text):
+    """
+    Returns a subquery of (cache_id, score) for the caches matching text,
+    in fts query syntax, in their names, descriptions, hint or logs. Better
+    matches score higher.
+    """
+    syncFullText()
+    logs = Logs.__table__
+    cachematch = select([cachesfts.c.docid.label('cache_id'),
+                         func.ftsrank(func.matchinfo(cachesfts.c.caches_fts), *ftsweights).label('score')],
+                        cachesfts.c.caches_fts.op('MATCH')(text), from_obj=[cachesfts])
+    # Each matching log looks up its cache on its own; with a join, sqlite
+    # may decide to run the match once for every log instead
+    logmatch = select([select([logs.c.cache_id], logs.c.id == logsfts.c.docid).as_scalar().label('cache_id'),
+                       func.ftsrank(func.matchinfo(logsfts.c.logs_fts)).label('score')],
+                      logsfts.c.logs_fts.op('MATCH')(text), from_obj=[logsfts])
+    # matchinfo() only works on a query sqlite runs as it stands, so the
+    # limit keeps sqlite from flattening the matches into the sum
+    hits = union_all(cachematch, logmatch).limit(-1).alias('fts_matches')
+    return select([hits.c.cache_id, func.sum(hits.c.score).label('score')]).group_by(hits.c.cache_id).alias('fts_hits')
+
+# cache_status holds one row per cache summing up its logs, travel bugs,
+# notes and photos, so that the search filters on them are plain column
+# tests. As with the full text index, triggers only note which caches
+# changed in status_pending, and refreshCacheStatus() brings their rows up
+# to date, in sql, before a search uses them. A change of accounts touches
+# the caches with logs by that user. Each column keeps the exact test the
+# search used before there was a cache_status: found_by_me folds the case
+# of the log type, while found only counts logs of type 'Found It'.
+def createCacheStatus():
+    """
+    Creates the triggers which keep cache_status up to date, and queues
+    every cache for it.
+    """
+    existing = set(map(lambda x: x[0], engine.execute("select name from sqlite_master")))
+    if 'status_pending' in existing:
+        return
+    engine.execute('create table status_pending (cache_id integer primary key)')
+    for trigger, event, table, sources in [
+            ('caches_status_insert', 'insert', 'caches', ['new.cache_id']),
+            ('logs_status_insert', 'insert', 'logs', ['new.cache_id']),
+            ('logs_status_update', 'update of cache_id, date, type, finder', 'logs', ['old.cache_id', 'new.cache_id']),
+            ('logs_status_delete', 'delete', 'logs', ['old.cache_id']),
+            ('travelbugs_status_insert', 'insert', 'travelbugs', ['new.cache_id']),
+            ('travelbugs_status_update', 'update of cache_id', 'travelbugs', ['old.cache_id', 'new.cache_id']),
+            ('travelbugs_status_delete', 'delete', 'travelbugs', ['old.cache_id']),
+            ('notes_status_insert', 'insert', 'notes', ['new.cache_id']),
+            ('notes_status_delete', 'delete', 'notes', ['old.cache_id']),
+            ('photos_status_insert', 'insert', 'photos', ['new.cache_id']),
+            ('photos_status_delete', 'delete', 'photos', ['old.cache_id'])]:
+        engine.execute("""
+            create trigger %s after %s on %s
+            begin
+                %s
+            end""" % (trigger, event, table, ' '.join(map(lambda x: 'insert or ignore into status_pending values (%s);' % x, sources))))
+    for trigger, event, users in [
+            ('accounts_status_insert', 'insert', ['new.username']),
+            ('accounts_status_update', 'update of username', ['old.username', 'new.username']),
+            ('accounts_status_delete', 'delete', ['old.username'])]:
+        engine.execute("""
+            create trigger %s after %s on accounts
+            begin
+                %s
+            end""" % (trigger, event, ' '.join(map(lambda x: 'insert or ignore into status_pending select cache_id from logs where finder = %s;' % x, users))))
+    engine.execute("""
+        create trigger caches_status_delete after delete on caches
+        begin
+            delete from cache_status where cache_id = old.cache_id;
+            delete from status_pending where cache_id = old.cache_id;
+        end""")
+    engine.execute('insert into status_pending select cache_id from caches')
+
+def refreshCacheStatus(bind=None):
+    """
+    Rebuilds the cache_status rows of the caches which changed since the
+    last call. Imports call this when they are done, and searches before
+    they filter on cache_status. bind works as in syncFullText.
+    """
+    if bind is None:
+        bind = DBSession
+    if bind.execute('select count(*) from status_pending').scalar() == 0:
+        return
+    bind.execute("""
+        insert or replace into cache_status
+        select c.cache_id,
+            exists (select 1 from logs l where l.cache_id = c.cache_id and lower(l.type) = 'found it'
+                and l.finder in (select username from accounts)),
+            exists (select 1 from logs l where l.cache_id = c.cache_id and l.type = 'Found It'),
+            (select max(l.date) from logs l where l.cache_id = c.cache_id),
+            (select count(*) from travelbugs t where t.cache_id = c.cache_id),
+            exists (select 1 from logs l where l.cache_id = c.cache_id and l.finder in (select username from accounts)),
+            exists (select 1 from notes n where n.cache_id = c.cache_id),
+            exists (select 1 from photos p where p.cache_id = c.cache_id)
+        from caches c where c.cache_id in (select cache_id from status_pending)""")
+    bind.execute('delete from status_pending')
+    if bind is DBSession:
+        DBSession.commit()
+
+def groupByColumns(rows):
+    # executemany needs every parameter set to name the same columns
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row.keys())), []).append(row)
+    return groups.values()
+
+def bulkInsert(table, rows):
+    rows = map(lambda x: addSearchKeys(table, addUnitVector(table, x)), rows)
+    for group in groupByColumns(rows):
+        DBSession.execute(table.insert(), group)
+
+def bulkUpdate(table, key, rows):
+    """
+    Updates rows of table in batches, matching each on its key column.
+    Only the columns named in each row are changed.
+    """
+    if len(rows) == 0:
+        return
+    stmt = table.update(table.c[key] == bindparam('_key'))
+    params = []
+    for row in rows:
+        param = dict(filter(lambda x: x[0] != key, addSearchKeys(table, addUnitVector(table, dict(row))).items()))
+        if len(param) > 0:
+            param['_key'] = row[key]
+            params.append(param)
+    for group in groupByColumns(params):
+        DBSession.execute(stmt, group)
+
 def delAllCaches():
-    cache901.notify("Emptying all caches and waypoints from the database")
+    cache901.notify("Emptying all caches and waypoints from the database", True)
     DBSession.query(Caches).delete()
     DBSession.query(Locations).filter(Locations.loc_type == 1).delete()
     DBSession.query(Logs).delete()
@@ -116,23 +1117,31 @@ def delAllCaches():
 
 
 def backup():
-    dbpath = cache901.cfg().dbpath
-    today = datetime.date.today().isoformat()
-    ext = "-%s.zip" % (today)
-    zfilename = os.sep.join([dbpath, 'Cache901_Backup%s' % ext])
-    z=zipfile.ZipFile(zfilename, "w", allowZip64=True)
-    for dbfile in filter(lambda x:x.lower().endswith('.sqlite'), os.listdir(cache901.cfg().dbpath)):
-        dbfile = os.sep.join([dbpath, dbfile.encode('ascii')])
-        arcname = "%s-%s.sqlite" % (os.path.splitext(os.path.split(dbfile)[1])[0], today)
-        arcname = arcname.encode('ascii')
-        cache901.notify('Backing up %s into %s' % (arcname, zfilename))
-        z.write(dbfile, arcname, compress_type=zipfile.ZIP_DEFLATED)
-    z.close()
+    import cache901.backup
+    DBSession.commit()
+    return cache901.backup.backup()
+
+def closeDb():
+    """
+    Closes every connection to the database, and those federated searches
+    hold to the others, e.g. before a restore writes over their files. The
+    next call to cache901.db() opens it again.
+    """
+    global DBSession
+    import cache901.federation
+    cache901.federation.close()
+    if DBSession is not None:
+        DBSession.remove()
+        engine.dispose()
+        DBSession = None
 
 def db_v001():
     metadata.create_all(engine)
+    createSpatialIndexes()
+    createFullText()
+    createCacheStatus()
     v = Version()
-    v.version=6
+    v.version=16
     DBSession.add(v)
     DBSession.flush()
     DBSession.commit()
@@ -203,6 +1212,111 @@ def db_v006():
     DBSession.flush()
     DBSession.commit()
 
+def db_v007():
+    for idx in TravelBugs.__table__.indexes:
+        if idx.name == u'travelbugs_ref':
+            idx.create()
+    v = Version()
+    v.version=7
+    DBSession.add(v)
+    DBSession.flush()
+    DBSession.commit()
+
+def db_v008():
+    cfingerprint = Column('fingerprint', Unicode(), primary_key=False)
+    lfingerprint = Column('fingerprint', Unicode(), primary_key=False)
+    cfingerprint.create(Caches.__table__)
+    lfingerprint.create(Locations.__table__)
+    v = Version()
+    v.version=8
+    DBSession.add(v)
+    DBSession.flush()
+    DBSession.commit()
+
+def db_v009():
+    ImportStatistics.__table__.create()
+    v = Version()
+    v.version=9
+    DBSession.add(v)
+    DBSession.flush()
+    DBSession.commit()
+
+def db_v010():
+    createSpatialIndexes()
+    v = Version()
+    v.version=10
+    DBSession.add(v)
+    DBSession.flush()
+    DBSession.commit()
+
+def db_v011():
+    for table, key in [(Caches.__table__, 'cache_id'), (Locations.__table__, 'wpt_id')]:
+        for col in ['unit_x', 'unit_y', 'unit_z']:
+            Column(col, Float, primary_key=False).create(table)
+        rows = map(lambda x: {key: x[0], 'lat': x[1], 'lon': x[2]},
+                   engine.execute(select([table.c[key], table.c.lat, table.c.lon])).fetchall())
+        bulkUpdate(table, key, rows)
+    v = Version()
+    v.version=11
+    DBSession.add(v)
+    DBSession.flush()
+    DBSession.commit()
+
+def db_v012():
+    global fulltext
+    fulltext = createFullText()
+    syncFullText()
+    v = Version()
+    v.version=12
+    DBSession.add(v)
+    DBSession.flush()
+    DBSession.commit()
+
+def db_v013():
+    CacheStatus.__table__.create()
+    createCacheStatus()
+    refreshCacheStatus()
+    v = Version()
+    v.version=13
+    DBSession.add(v)
+    DBSession.flush()
+    DBSession.commit()
+
+def db_v014():
+    for table, key in [(Caches.__table__, 'cache_id'), (Locations.__table__, 'wpt_id')]:
+        for col, keycol in searchkeys[table.name]:
+            Column(keycol, Unicode(), primary_key=False).create(table)
+            # Only the key column is written, so that no trigger takes the
+            # name for changed
+            rows = map(lambda x: {key: x[0], keycol: cache901.util.searchKey(x[1])},
+                       engine.execute(select([table.c[key], table.c[col]])).fetchall())
+            bulkUpdate(table, key, rows)
+    v = Version()
+    v.version=14
+    DBSession.add(v)
+    DBSession.flush()
+    DBSession.commit()
+
+def db_v015():
+    # No textstorage row yet, so the next maintdb converts the text once
+    Settings.__table__.create()
+    v = Version()
+    v.version=15
+    DBSession.add(v)
+    DBSession.flush()
+    DBSession.commit()
+
+def db_v016():
+    # cache_status.found replaces last_found, so every row is built again
+    CacheStatus.__table__.drop()
+    CacheStatus.__table__.create()
+    engine.execute('insert or ignore into status_pending select cache_id from caches')
+    refreshCacheStatus()
+    v = Version()
+    v.version=16
+    DBSession.add(v)
+    DBSession.flush()
+    DBSession.commit()
 
 
 class Version(DeclarativeBase):
@@ -218,7 +1332,7 @@ class Logs(DeclarativeBase):
     type = Column(Unicode(), primary_key=False)
     finder = Column(Unicode(), primary_key=False)
     finder_id = Column(Integer, primary_key=False)
-    log_entry = Column(Unicode(), primary_key=False)
+    log_entry = deferred(Column(CompressedText(), primary_key=False))
     log_entry_encoded = Column(Integer, primary_key=False)
     my_log = Column(Integer, primary_key=False)
     my_log_found = Column(Integer, primary_key=False)
@@ -306,6 +1420,7 @@ class TravelBugs(DeclarativeBase):
 
 class Caches(DeclarativeBase):
     __tablename__ =  'caches'
+    __mapper_args__ = {'extension': [UnitVectorExtension(), SearchKeyExtension()]}
     cache_id = Column(Integer, primary_key=True)
     catid = Column(Integer, primary_key=False)
     name = Column(Unicode(), primary_key=False)
@@ -326,11 +1441,17 @@ class Caches(DeclarativeBase):
     terrain= Column(Numeric(precision=None, scale=None, asdecimal=True), primary_key=False)
     country = Column(Unicode(), primary_key=False)
     state = Column(Unicode(), primary_key=False)
-    short_desc = Column(Unicode(), primary_key=False)
+    short_desc = deferred(Column(CompressedText(), primary_key=False), group='descriptions')
     short_desc_html = Column(Integer, primary_key=False)
-    long_desc = Column(Unicode(), primary_key=False)
+    long_desc = deferred(Column(CompressedText(), primary_key=False), group='descriptions')
     long_desc_html = Column(Integer, primary_key=False)
     hidden = Column(Integer, primary_key=False)
+    fingerprint = Column(Unicode(), primary_key=False)
+    unit_x = Column(Float, primary_key=False)
+    unit_y = Column(Float, primary_key=False)
+    unit_z = Column(Float, primary_key=False)
+    name_key = Column(Unicode(), primary_key=False)
+    url_name_key = Column(Unicode(), primary_key=False)
 
     logs = relation(Logs, order_by=Logs.date.desc(), backref=backref('cache'), cascade='all,delete-orphan')
     alt_coords = relation('AltCoords', order_by='AltCoords.sequence_num', backref=backref('cache'), cascade='all,delete-orphan')
@@ -341,17 +1462,62 @@ class Caches(DeclarativeBase):
     travelbugs = relation(TravelBugs, backref=backref('cache'), cascade='all,delete-orphan')
     
 
+class CacheStatus(DeclarativeBase):
+    __tablename__ = 'cache_status'
+    cache_id = Column(Integer, ForeignKey(Caches.cache_id), primary_key=True)
+    found_by_me = Column(Integer, primary_key=False)
+    found = Column(Integer, primary_key=False)
+    last_log = Column(Integer, primary_key=False)
+    bug_count = Column(Integer, primary_key=False)
+    my_logs = Column(Integer, primary_key=False)
+    my_notes = Column(Integer, primary_key=False)
+    my_photos = Column(Integer, primary_key=False)
+
+
 class Locations(DeclarativeBase):
     __tablename__ = 'locations'
+    __mapper_args__ = {'extension': [UnitVectorExtension(), SearchKeyExtension()]}
     wpt_id = Column(Integer, primary_key=True)
     loc_type = Column(Integer, primary_key=False)
     refers_to = Column(Integer, primary_key=False)
     name = Column(Unicode(), primary_key=False)
     desc = Column(Unicode(), primary_key=False)
-    comment = Column(Unicode(), primary_key=False)
+    comment = deferred(Column(Unicode(), primary_key=False))
     lat= Column(Numeric(precision=None, scale=None, asdecimal=True), primary_key=False)
     lon= Column(Numeric(precision=None, scale=None, asdecimal=True), primary_key=False)
     hidden = Column(Integer, primary_key=False)
+    fingerprint = Column(Unicode(), primary_key=False)
+    unit_x = Column(Float, primary_key=False)
+    unit_y = Column(Float, primary_key=False)
+    unit_z = Column(Float, primary_key=False)
+    name_key = Column(Unicode(), primary_key=False)
+
+
+class ImportStatistics(DeclarativeBase):
+    __tablename__ = 'import_stats'
+    run_id = Column(Integer, primary_key=True)
+    started = Column(Integer, primary_key=False)
+    version = Column(Unicode(), primary_key=False)
+    source = Column(Unicode(), primary_key=False)
+    elapsed = Column(Float, primary_key=False)
+    parse_time = Column(Float, primary_key=False)
+    lookup_time = Column(Float, primary_key=False)
+    write_time = Column(Float, primary_key=False)
+    commit_time = Column(Float, primary_key=False)
+    index_time = Column(Float, primary_key=False)
+    maint_time = Column(Float, primary_key=False)
+    waypoints = Column(Integer, primary_key=False)
+    logs = Column(Integer, primary_key=False)
+    queries = Column(Integer, primary_key=False)
+    added = Column(Integer, primary_key=False)
+    updated = Column(Integer, primary_key=False)
+    skipped = Column(Integer, primary_key=False)
+
+
+class Settings(DeclarativeBase):
+    __tablename__ = 'settings'
+    name = Column(Unicode(), primary_key=True)
+    value = Column(Unicode(), primary_key=False)
 
 
 class AltCoords(DeclarativeBase):
@@ -392,10 +1558,21 @@ Index(u'alt_coords_cid_seq', AltCoords.cache_id, AltCoords.sequence_num, unique=
 Index(u'cacheday_name', CacheDay.dayname, unique=False)
 Index(u'caches_url_name', Caches.url_name, unique=0)
 Index(u'caches_name', Caches.name, unique=0)
+Index(u'caches_url_name_key', Caches.url_name_key, unique=0)
+Index(u'caches_name_key', Caches.name_key, unique=0)
+Index(u'cache_status_found_by_me', CacheStatus.found_by_me, unique=0)
+Index(u'cache_status_found', CacheStatus.found, unique=0)
+Index(u'cache_status_last_log', CacheStatus.last_log, unique=0)
+Index(u'cache_status_bug_count', CacheStatus.bug_count, unique=0)
+Index(u'cache_status_my_logs', CacheStatus.my_logs, unique=0)
+Index(u'cache_status_my_notes', CacheStatus.my_notes, unique=0)
+Index(u'cache_status_my_photos', CacheStatus.my_photos, unique=0)
 Index(u'locations_name', Locations.name, unique=0)
+Index(u'locations_name_key', Locations.name_key, unique=0)
 Index(u'locations_refers_to', Locations.refers_to, unique=0)
 Index(u'logs_cache_id', Logs.cache_id, unique=0)
 Index(u'notes_id', Notes.cache_id, unique=0)
 Index(u'photos_id', Photos.cache_id, unique=0)
 Index(u'searches_name', Searches.name, unique=0)
 Index(u'travelbugs_cache_id', TravelBugs.cache_id, unique=0)
+Index(u'travelbugs_ref', TravelBugs.ref, unique=0)
@@ -31,6 +31,7 @@ from sqlalchemy.sql import select
 import gpsbabel
 
 import cache901
+import cache901.federation
 import cache901.ui_xrc
 import cache901.util
 import cache901.validators
@@ -395,18 +396,39 @@ def loadSavedSearch(sname):
         params[search.param] = search.value
     return params
 
-def execSearch(params):
+def searchOrigin(params):
+    """
+    Returns the location the search params measures distances from: the
+    current gps position, or the search location it names. None when
+    params has no origin.
+    """
+    if not params.has_key("searchOrigin"):
+        return None
+    org = params["searchOrigin"]
+    if org == "From GPS":
+        cfg = cache901.cfg()
+        gpstype = cfg.gpstype
+        gpsport = cfg.gpsport
+        cache901.notify('Retrieving current GPS position')
+        return gpsbabel.gps.getCurrentGpsLocation(gpsport, gpstype)
+    return cache901.util.getSearchLocs(org).first()
+
+def execSearch(params, origin=None):
     seconds = 86400*7 # Number of seconds in a week
     now = int(time.time())
     isinstance(params, dict)
     orderbycol = sadbobjects.Caches.url_name
     qry = cache901.db().query(sadbobjects.Caches)
     accounts = cache901.db().query(sadbobjects.Accounts.username)
-    log_cache_ids = sadbobjects.Logs.cache_id
-    log_cache_qry = cache901.db().query(log_cache_ids.distinct().label('cache_id'))
     cache_id = sadbobjects.Caches.cache_id
-    
-    cachesfoundbyme = cache901.db().query(log_cache_ids).filter(and_(func.lower(sadbobjects.Logs.type) == 'found it', sadbobjects.Logs.finder.in_(accounts)))
+    status = sadbobjects.CacheStatus
+    statusflags = ['notfoundbyme', 'found', 'foundlast7', 'notfound', 'updatedlast7',
+                   'hasbugs', 'hasmylogs', 'hasmynotes', 'hasmyphotos']
+    if len(filter(params.has_key, statusflags)) > 0:
+        # An outer join, so that a cache without a status row is treated
+        # like one without logs, bugs, notes or photos
+        sadbobjects.refreshCacheStatus()
+        qry = qry.outerjoin((status, status.cache_id == cache_id))
 
     if params.has_key('ids'):
         qry = qry.add_column(sadbobjects.CacheDay.cache_order)
@@ -414,11 +436,21 @@ def execSearch(params):
         qry = qry.filter(sadbobjects.CacheDay.cache_id.in_(params['ids']))
         orderbycol = sadbobjects.CacheDay.cache_order
     if params.has_key("urlname"):
-        sname = '%%%s%%' % (params['urlname'].replace('*', '%').lower())
         qry = qry.filter(or_(
-            func.lower(sadbobjects.Caches.url_name).like(sname),
-            func.lower(sadbobjects.Caches.name).like(sname)
+            sadbobjects.searchKeyFilter(sadbobjects.Caches.url_name_key, params['urlname']),
+            sadbobjects.searchKeyFilter(sadbobjects.Caches.name_key, params['urlname'])
             ))
+    rankcol = None
+    if params.has_key('fulltext'):
+        if sadbobjects.fulltext:
+            hits = sadbobjects.fullTextHits(params['fulltext'])
+            qry = qry.join((hits, hits.c.cache_id == cache_id))
+            rankcol = hits.c.score.desc()
+        else:
+            qry = qry.filter(or_(
+                sadbobjects.searchKeyFilter(sadbobjects.Caches.url_name_key, params['fulltext'], True),
+                sadbobjects.searchKeyFilter(sadbobjects.Caches.name_key, params['fulltext'], True)
+                ))
     if params.has_key('terrain'):
         vals=params['terrain'].split(' ')
         diff = float(vals[1])
@@ -436,28 +468,29 @@ def execSearch(params):
             dist = dist * 1.61
     else: params["searchScale"] = "mi"
     if params.has_key("searchOrigin"):
-        org = params["searchOrigin"]
-        if org == "From GPS":
-            cfg = cache901.cfg()
-            gpstype = cfg.gpstype
-            gpsport = cfg.gpsport
-            cache901.notify('Retrieving current GPS position')
-            loc = gpsbabel.gps.getCurrentGpsLocation(gpsport, gpstype)
-        else:
-            loc = cache901.util.getSearchLocs(org).first()
+        # origin is the location searchOrigin() found, when the caller
+        # already looked it up
+        loc = origin
+        if loc is None:
+            loc = searchOrigin(params)
         if params.has_key("searchScale") and params["searchScale"] != "mi":
             scale = 1.61
         else:
             scale = 1.0
+        # The distance function is only called for the displayed column;
+        # filtering and sorting use the dot product of the unit vectors
         distcol = (cast(func.distance(sadbobjects.Caches.lat, sadbobjects.Caches.lon, loc.lat, loc.lon)*scale, sqlalchemy.types.Text)+params['searchScale'])
-        distfloat = func.distance(sadbobjects.Caches.lat, sadbobjects.Caches.lon, loc.lat, loc.lon)
-        orderbycol = distfloat
+        distdot = sadbobjects.unitDot(sadbobjects.Caches, loc.lat, loc.lon)
+        orderbycol = distdot.desc()
         cache901.notify("Found location")
+        if params.has_key("searchDist"):
+            # Only the caches in the bounding box need the exact distance
+            qry = qry.filter(sadbobjects.withinRadius(sadbobjects.Caches, loc.lat, loc.lon, dist))
+        qry = qry.filter(distdot >= cache901.util.dotForDistance(dist))
     else:
+        # The distance to 200, 200 is always 0, so there is nothing to filter
         distcol = (cast(func.distance(sadbobjects.Caches.lat, sadbobjects.Caches.lon, 200, 200), sqlalchemy.types.Text)+'mi')
-        distfloat = func.distance(sadbobjects.Caches.lat, sadbobjects.Caches.lon, 200, 200)
     qry = qry.add_column(distcol.label('distance'))
-    qry = qry.filter(distfloat <= dist)
     
     if params.has_key('countries'):
         countries = params['countries'].split(',')
@@ -472,33 +505,296 @@ def execSearch(params):
         containers = params['containers'].split(',')
         qry = qry.filter(sadbobjects.Caches.container.in_(containers))
     if params.has_key('notfoundbyme'):
-        qry = qry.filter(not_(cache_id.in_(cachesfoundbyme)))
+        qry = qry.filter(func.coalesce(status.found_by_me, 0) == 0)
     if params.has_key('found'):
-        qry = qry.filter(cache_id.in_(cachesfoundbyme))
+        qry = qry.filter(status.found_by_me == 1)
     if params.has_key('notowned'):
         qry = qry.filter(not_(sadbobjects.Caches.owner_name.in_(accounts)))
     if params.has_key('owned'):
         qry = qry.filter(sadbobjects.Caches.owner_name.in_(accounts))
     if params.has_key('foundlast7'):
-        qry = qry.filter(cache_id.in_(log_cache_qry.filter(and_(sadbobjects.Logs.date >= now-seconds, log_cache_ids.in_(log_cache_qry.filter(sadbobjects.Logs.type == 'Found It'))))))
+        # Any log in the last week, on a cache somebody has found
+        qry = qry.filter(and_(status.found == 1, status.last_log >= now-seconds))
     if params.has_key('notfound'):
-        qry = qry.filter(not_(cache_id.in_(log_cache_qry.filter(sadbobjects.Logs.type=='Found It'))))
+        qry = qry.filter(func.coalesce(status.found, 0) == 0)
     if params.has_key('updatedlast7'):
-        qry = qry.filter(cache_id.in_(log_cache_qry.filter(sadbobjects.Logs.date >= now-seconds)))
+        qry = qry.filter(status.last_log >= now-seconds)
     if params.has_key('hasbugs'):
-        qry = qry.filter(cache_id.in_(cache901.db().query(sadbobjects.TravelBugs.cache_id.distinct().label('cache_id'))))
+        qry = qry.filter(status.bug_count > 0)
     if params.has_key('notactive'):
         qry = qry.filter(sadbobjects.Caches.archived == 1)
     if params.has_key('active'):
         qry = qry.filter(sadbobjects.Caches.available == 1)
     if params.has_key('hasmylogs'):
-        qry = qry.filter(cache_id.in_(cache901.db().query(sadbobjects.Logs.cache_id).filter(sadbobjects.Logs.finder.in_(accounts))))
+        qry = qry.filter(status.my_logs == 1)
     if params.has_key('hasmynotes'):
-        qry = qry.filter(cache_id.in_(cache901.db().query(sadbobjects.Notes.cache_id)))
+        qry = qry.filter(status.my_notes == 1)
     if params.has_key('hasmyphotos'):
-        qry = qry.filter(cache_id.in_(cache901.db().query(sadbobjects.Photos.cache_id)))
+        qry = qry.filter(status.my_photos == 1)
+    if rankcol is not None:
+        # The best full text matches come first, whatever else is asked for
+        orderbycol = rankcol
     qry = qry.order_by(orderbycol)
     if params.has_key('maxresults'):
         qry = qry.limit(int(params['maxresults']))
     return qry
 
+def federatedSearch(params, dbnames=None):
+    """
+    Runs execSearch(params) over several databases at once: dbnames, or the
+    open database and then every other one. Returns federation.Result
+    objects, each labelled with the database its cache came from.
+    """
+    if dbnames is None:
+        current = cache901.cfg().dbfilebase
+        dbnames = [current] + filter(lambda x: x != current, cache901.util.getDbList())
+    # The open database is brought up to date through the session, so that
+    # federation.update never writes to it behind the session's back
+    sadbobjects.refreshCacheStatus()
+    sadbobjects.syncFullText()
+    return cache901.federation.search(execSearch(params), dbnames)
+
+class ResultCache(object):
+    """
+    The cursors of the last size searches (see searchCursor), along with
+    the rows each has read. An entry only holds for the database
+    generation it was made in (see sadbobjects.generation); the least
+    recently used one is dropped first when the cache is full. hits and
+    misses count lookups.
+
+    The cursor is kept rather than the search's whole list of ids and
+    distances: building that list means reading every row the search
+    finds, which is what the paged cursor is there to avoid. A cursor
+    holds its count and at most SearchCursor.keeppages pages, each row
+    with its id and distance, so a hit shows the list again without a
+    query, and an entry's size does not grow with the number of results.
+    """
+    def __init__(self, size=16):
+        self.size = size
+        self.entries = {}
+        self.tick = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != sadbobjects.generation:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.tick += 1
+        entry[1] = self.tick
+        return entry[2]
+
+    def put(self, key, results):
+        # Entries from older generations can never be used again
+        for oldkey in self.entries.keys():
+            if self.entries[oldkey][0] != sadbobjects.generation:
+                del self.entries[oldkey]
+        self.tick += 1
+        self.entries[key] = [sadbobjects.generation, self.tick, results]
+        while len(self.entries) > self.size:
+            oldest = min(self.entries.keys(), key=lambda x: self.entries[x][1])
+            del self.entries[oldest]
+
+    def clear(self):
+        self.entries = {}
+
+resultcache = ResultCache()
+
+def resultKey(params, origin):
+    """
+    Returns params in a form fit to key the result cache with: names and
+    text to search for folded the way the search folds them, the scale
+    always given, lists made hashable, and the origin (which for "From
+    GPS" is wherever the gps is now) as its position. Searches relative to
+    the current time are only the same within the hour.
+    """
+    norm = dict(params)
+    norm.setdefault('searchScale', 'mi')
+    for name in ['urlname', 'fulltext']:
+        if norm.has_key(name):
+            norm[name] = cache901.util.searchKey(norm[name])
+    if norm.has_key('ids'):
+        norm['ids'] = tuple(sorted(norm['ids']))
+    if norm.has_key('foundlast7') or norm.has_key('updatedlast7'):
+        norm['hour'] = int(time.time()) / 3600
+    if origin is not None:
+        norm['searchOrigin'] = (round(origin.lat, 5), round(origin.lon, 5))
+    return tuple(sorted(norm.items()))
+
+class SearchCursor(object):
+    """
+    The rows of a select, read a page at a time as they are asked for, so
+    that a list of any length only ever holds the few pages on screen.
+    key names the column which tells the rows apart, and order is a list
+    of (expression, descending) to sort them by, the select's own order
+    when not given; the key breaks ties.
+
+    Pages are read by keyset: each one starts after the sort values of
+    the last row of the page before, which is remembered for every page
+    read, so scrolling on never skips over rows with an offset. Only a
+    page jumped to, whose predecessor was never read, needs the offset.
+    """
+    pagesize = 100
+    keeppages = 8
+
+    def __init__(self, stmt, key, order=None):
+        if order is None:
+            order = cache901.federation.sortColumns(stmt)
+        if stmt._limit is None:
+            # Only a limit needs the select's own order inside
+            stmt = stmt.order_by(None)
+        for i, (col, desc) in enumerate(order):
+            stmt = stmt.column(col.label('sort_%d' % i))
+        self.found = stmt.alias('found')
+        self.key = key
+        self.order = map(lambda x: (self.found.c['sort_%d' % x[0]], x[1][1]), enumerate(order)) + [(self.found.c[key], False)]
+        self.refresh()
+
+    def refresh(self):
+        # Forgets everything read, e.g. after a row was deleted
+        self.total = None
+        self.pages = {}
+        self.used = {}
+        self.tick = 0
+        # Page number -> sort values of the last row of the page before
+        self.bounds = {}
+
+    def count(self):
+        if self.total is None:
+            self.total = cache901.db().execute(select([func.count()], from_obj=[self.found])).scalar()
+        return self.total
+
+    def after(self, values):
+        # The rows which sort after values: for each sort column, those
+        # equal to values on the columns before it, and beyond it on this
+        # one. sqlite sorts nulls first.
+        clauses = []
+        for i, (col, desc) in enumerate(self.order):
+            value = values[i]
+            if desc and value is None:
+                continue
+            if desc:
+                beyond = or_(col < value, col == None)
+            elif value is None:
+                beyond = col != None
+            else:
+                beyond = col > value
+            same = map(lambda x: x[0][0] == x[1], zip(self.order[:i], values[:i]))
+            clauses.append(and_(*(same + [beyond])))
+        return or_(*clauses)
+
+    def load(self, page):
+        qry = select([self.found]).order_by(*map(lambda x: x[1] and x[0].desc() or x[0], self.order)).limit(self.pagesize)
+        if self.bounds.has_key(page):
+            qry = qry.where(self.after(self.bounds[page]))
+        elif page > 0:
+            qry = qry.offset(page * self.pagesize)
+        rows = cache901.db().execute(qry).fetchall()
+        if len(rows) > 0:
+            self.bounds[page+1] = map(lambda x: rows[-1][x[0].key], self.order)
+        self.pages[page] = rows
+        self.tick += 1
+        self.used[page] = self.tick
+        while len(self.pages) > self.keeppages:
+            oldest = min(self.pages.keys(), key=lambda x: self.used[x])
+            del self.pages[oldest]
+            del self.used[oldest]
+
+    def row(self, index):
+        """
+        Returns row index, or None when the rows have changed underneath
+        the cursor and there no longer is one.
+        """
+        page = index / self.pagesize
+        if not self.pages.has_key(page):
+            self.load(page)
+        self.tick += 1
+        self.used[page] = self.tick
+        rows = self.pages[page]
+        if index % self.pagesize < len(rows):
+            return rows[index % self.pagesize]
+        return None
+
+    def rowKey(self, index):
+        row = self.row(index)
+        if row is None:
+            return None
+        return row[self.key]
+
+    def ids(self):
+        # Every key, in order, for whatever needs all of the rows at once
+        # (the map, and the exports)
+        qry = select([self.found.c[self.key]]).order_by(*map(lambda x: x[1] and x[0].desc() or x[0], self.order))
+        return map(lambda x: x[0], cache901.db().execute(qry))
+
+    def find(self, key):
+        """
+        Returns the index of the row whose key is key, or -1 when there is
+        none. The index is counted from the row's sort values, the same
+        way a page is found, without reading the rows before it.
+        """
+        values = cache901.db().execute(select(map(lambda x: x[0], self.order), self.found.c[self.key] == key)).fetchone()
+        if values is None:
+            return -1
+        later = cache901.db().execute(select([func.count()], self.after(list(values)), from_obj=[self.found])).scalar()
+        return self.count() - later - 1
+
+    def remove(self, index):
+        # The row is gone from the database already
+        self.refresh()
+
+class RowList(object):
+    """
+    Rows which are already in memory (the results of a federated search),
+    with the interface of SearchCursor. key returns the key of a row.
+    """
+    def __init__(self, rows, key):
+        self.rows = rows
+        self.key = key
+
+    def count(self):
+        return len(self.rows)
+
+    def row(self, index):
+        if index < len(self.rows):
+            return self.rows[index]
+        return None
+
+    def rowKey(self, index):
+        return self.key(self.rows[index])
+
+    def ids(self):
+        return map(self.key, self.rows)
+
+    def find(self, key):
+        ids = self.ids()
+        if key in ids:
+            return ids.index(key)
+        return -1
+
+    def remove(self, index):
+        del self.rows[index]
+
+def searchCursor(params, sort=None, descending=False):
+    """
+    Returns a SearchCursor over the caches execSearch(params) finds, sorted
+    by the caches column sort when given, or else the way the search sorts
+    them, in reverse when descending is set. The cursor, and the pages it
+    has read, is kept in the result cache, and handed out again for the
+    same search until the database changes.
+    """
+    params = dict(params)
+    origin = searchOrigin(params)
+    key = (resultKey(params, origin), sort, descending)
+    cursor = resultcache.get(key)
+    if cursor is None:
+        stmt = execSearch(params, origin).statement
+        if sort is None:
+            order = map(lambda x: (x[0], x[1] != descending), cache901.federation.sortColumns(stmt))
+        else:
+            order = [(sadbobjects.Caches.__table__.c[sort], descending)]
+        cursor = SearchCursor(stmt, 'cache_id', order)
+        resultcache.put(key, cursor)
+    return cursor
@@ -24,22 +24,23 @@ import re
 import shutil
 import sys
 import time
-import zipfile
 
 from urlparse import urlparse
 from sqlalchemy import func, and_
+from sqlalchemy.orm import undefer, undefer_group
 
 import gpsbabel
 import wx
 import wx.grid
-import wx.lib.mixins.listctrl  as  listmix
 import wx.xrc as xrc
 import wx.html
 
 import cache901
+import cache901.backup
 import cache901.gpxsource
 import cache901.mapping
 import cache901.options
+import cache901.progress
 import cache901.search
 import cache901.ui_xrc
 import cache901.util
@@ -47,7 +48,7 @@ import cache901.xml901
 
 from cache901 import sadbobjects
 
-class Cache901UI(cache901.ui_xrc.xrcCache901UI, wx.FileDropTarget, listmix.ColumnSorterMixin):
+class Cache901UI(cache901.ui_xrc.xrcCache901UI, wx.FileDropTarget):
     """
     The main UI class.
     """
@@ -65,15 +66,18 @@ class Cache901UI(cache901.ui_xrc.xrcCache901UI, wx.FileDropTarget, listmix.Colum
         cache901.ui_xrc.xrcCache901UI.__init__(self, parent)
         wx.FileDropTarget.__init__(self)
         self.SetDropTarget(self)
-        listmix.ColumnSorterMixin.__init__(self, 5)
 
         self.geoicons = geoicons()
         self.logtrans = logTrans()
         self.SetIcon(self.geoicons["appicon"])
         self.dropfile = wx.FileDataObject()
         self.SetDataObject(self.dropfile)
-        self.itemDataMap = {}
-        self.wptlist = {}
+        self.cacheparams = {}
+        self.cachecolumns = []
+        self.cachesort = None
+        self.cachedesc = False
+        self.fedresults = None
+        self.backupthread = None
 
         # do all the GUI config stuff - creating extra controls and binding objects to events
         self.miscBinds()        
@@ -93,6 +97,7 @@ class Cache901UI(cache901.ui_xrc.xrcCache901UI, wx.FileDropTarget, listmix.Colum
         self.updSearchMenu()
         self.updPhotoList()
         # The following is done last, since some menu items are dynamically generated.
+        self.addRestoreMenu()
         self.bindMenuOptions()
         self.buildDbMenu()
 
@@ -103,6 +108,30 @@ class Cache901UI(cache901.ui_xrc.xrcCache901UI, wx.FileDropTarget, listmix.Colum
         self.Bind(wx.EVT_SIZE, self.OnWindowResize)
         self.caches.Bind(wx.EVT_CONTEXT_MENU, self.OnPopupMenuCaches)
         self.points.Bind(wx.EVT_CONTEXT_MENU, self.OnPopupMenuWpts)
+        self.caches.Bind(wx.EVT_LIST_COL_CLICK, self.OnSortCaches)
+        # a full vacuum left over from an import waits until nobody has
+        # touched the keyboard or moved the mouse for a while
+        self.lastinput = time.time()
+        self.lastmouse = wx.GetMousePosition()
+        self.Bind(wx.EVT_CHAR_HOOK, self.OnInput)
+        self.mainttimer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.OnMaintTimer, self.mainttimer)
+        self.mainttimer.Start(5000)
+    
+    def OnInput(self, evt):
+        self.lastinput = time.time()
+        evt.Skip()
+    
+    def OnMaintTimer(self, evt):
+        mouse = wx.GetMousePosition()
+        if mouse != self.lastmouse:
+            self.lastmouse = mouse
+            self.lastinput = time.time()
+        backup = self.backupthread is not None and self.backupthread.isAlive()
+        if not cache901.updating and not backup:
+            if len(cache901.db().idleMaint(time.time() - self.lastinput)) > 0:
+                self.lastinput = time.time()
+                self.updStatus()
     
 
     def createStatusBarSearchField(self):
@@ -162,6 +191,7 @@ class Cache901UI(cache901.ui_xrc.xrcCache901UI, wx.FileDropTarget, listmix.Colum
                         (self.OnDeleteCacheOrWaypoint, self.mnuDeleteThisCache),
                         (self.OnDeleteAllCaches, self.mnuDeleteAll),
                         (self.OnDbBackup,       self.mnuFileBackup),
+                        (self.OnDbRestore,      self.mnuFileRestore),
                         (self.OnExportKML,      self.mnuExportKML),
                         (self.OnExportTomTomPOI, self.mnuExportTomTomPOI)
                       ] 
@@ -351,24 +381,19 @@ class Cache901UI(cache901.ui_xrc.xrcCache901UI, wx.FileDropTarget, listmix.Colum
 
             
     def loadWaypoints(self, wpt_params={}):
-        self.points.DeleteAllItems()
-        self.wptlist = {}
         if len(wpt_params.keys()) == 0:
             wpt_params['searchpat'] = self.search.GetValue()
-        for wpt in cache901.util.getWaypoints(wpt_params):
-            wpt_id = self.points.Append((wpt.name, wpt.desc))
-            self.points.SetItemData(wpt_id, wpt.wpt_id)
-            self.wptlist[wpt.wpt_id] = wpt_id
+        wpts = cache901.search.SearchCursor(cache901.util.getWaypoints(wpt_params).statement, 'wpt_id')
+        self.points.setSource(wpts, lambda row, col: (row['name'], row['desc'])[col])
             
 
     def loadData(self, params={}, wpt_params={}):
-        self.caches.DeleteAllItems()
         self.caches.DeleteAllColumns()
-        self.itemDataMap = {}
         columnOrder = cache901.cfg().cachecolumnorder
         for colName in columnOrder:
             w, h = self.GetTextExtent(self.LISTDATA[colName][2])
             self.caches.InsertColumn(columnOrder.index(colName), self.LISTDATA[colName][1], width=w)
+        self.cachecolumns = list(columnOrder)
 
         if len(self.search.GetValue()) > 2:
             params["urlname"] = self.search.GetValue()
@@ -376,19 +401,68 @@ class Cache901UI(cache901.ui_xrc.xrcCache901UI, wx.FileDropTarget, listmix.Colum
             if params.has_key("urlname"):
                 del params["urlname"]
         cache901.notify('Refreshing cache list from database')
-        for cache in cache901.search.execSearch(params):
-            cacheElements = []
-            for colName in columnOrder:
-                try:
-                    cacheElements.append(getattr(cache.Caches, self.LISTDATA[colName][0]))
-                except:
-                    cacheElements.append(getattr(cache, self.LISTDATA[colName][0]))
-            cacheTuple = tuple(cacheElements)
-            cache_id = self.caches.Append(cacheTuple)
-            self.caches.SetItemData(cache_id, cache.Caches.cache_id)
-            self.itemDataMap[cache.Caches.cache_id] = cacheTuple
+        self.cacheparams = dict(params)
+        self.cachesort = None
+        self.cachedesc = False
+        if cache901.cfg().searchalldbs:
+            self.fedresults = cache901.search.federatedSearch(params)
+        else:
+            self.fedresults = None
+        self.showCaches()
         if self.caches.GetItemCount() > 0:
             self.caches.Select(0)
+        cache901.progress.flush()
+
+
+    def showCaches(self):
+        # Fills the cache list with the last search, sorted by the column
+        # picked last. Only the rows on screen are ever read.
+        if self.fedresults is not None:
+            results = list(self.fedresults)
+            if self.cachesort is not None:
+                results.sort(key=lambda x: getattr(x.Caches, self.cachesort))
+            if self.cachedesc:
+                results.reverse()
+            source = cache901.search.RowList(results, lambda x: x.Caches.cache_id)
+        else:
+            source = cache901.search.searchCursor(self.cacheparams, self.cachesort, self.cachedesc)
+        self.caches.setSource(source, self.cacheText)
+
+
+    def cacheText(self, row, col):
+        field = self.LISTDATA[self.cachecolumns[col]][0]
+        try:
+            value = getattr(getattr(row, 'Caches', row), field)
+        except AttributeError:
+            value = getattr(row, field)
+        if value is None:
+            value = ''
+        text = unicode(value)
+        source = getattr(row, 'source', None)
+        if source is not None and self.cachecolumns[col] == "Cache Name":
+            # Label each cache with the database it is in
+            text = '[%s] %s' % (source, text)
+        return text
+
+
+    def OnSortCaches(self, evt):
+        colName = self.cachecolumns[evt.GetColumn()]
+        if colName == "Distance":
+            # The search's own order: by distance, or by cache day
+            sort = None
+        else:
+            sort = self.LISTDATA[colName][0]
+        if sort == self.cachesort:
+            self.cachedesc = not self.cachedesc
+        else:
+            self.cachesort = sort
+            self.cachedesc = False
+        self.showCaches()
+        if isinstance(self.ld_cache, sadbobjects.Caches):
+            item = self.caches.FindItemData(0, self.ld_cache.cache_id)
+            if item != -1:
+                self.caches.Select(item)
+                self.caches.EnsureVisible(item)
 
 
     def updStatus(self):
@@ -396,12 +470,45 @@ class Cache901UI(cache901.ui_xrc.xrcCache901UI, wx.FileDropTarget, listmix.Colum
 
 
     def OnDbMaint(self, evt):
-        cache901.db().maintdb()
+        if self.backupRunning():
+            return
+        cache901.db().maintdb(True)
         self.updStatus()
         
+    def backupRunning(self):
+        if self.backupthread is not None and self.backupthread.isAlive():
+            wx.MessageBox('A backup is still running', 'Backup Running', wx.ICON_INFORMATION)
+            return True
+        return False
+        
     def OnDbBackup(self, evt):
-        cache901.db().backup()
-        self.updStatus()
+        if self.backupRunning():
+            return
+        cache901.db().commit()
+        self.backupthread = cache901.backup.BackupThread()
+        self.backupthread.start()
+        
+    def OnDbRestore(self, evt):
+        if self.backupRunning():
+            return
+        backups = cache901.backup.listBackups()
+        if len(backups) == 0:
+            wx.MessageBox('There are no backups to restore', 'No Backups', wx.ICON_INFORMATION)
+            return
+        backups.reverse()
+        name = wx.GetSingleChoice('Choose the backup to restore:', 'Restore Backup', backups, self)
+        if name != '' and wx.MessageBox('Restoring %s will replace all of your databases with their backed up copies.\nContinue?' % name,
+                                        'Really Restore?', wx.YES_NO | wx.CENTER, self) == wx.YES:
+            cache901.backup.restore(name)
+            self.buildDbMenu()
+            self.loadData()
+            self.updStatus()
+        
+    def addRestoreMenu(self):
+        # The restore item goes right after Backup, in the same menu
+        menu = self.mnuFileBackup.GetMenu()
+        pos = map(lambda x: x.GetId(), menu.GetMenuItems()).index(self.mnuFileBackup.GetId())
+        self.mnuFileRestore = menu.Insert(pos+1, -1, 'Restore Backup')
         
     def OnClose(self, evt):
         if  wx.MessageBox("Are you sure you wish to exit?", "Really Exit?", wx.YES_NO | wx.CENTER, self) == wx.YES:
@@ -415,6 +522,9 @@ class Cache901UI(cache901.ui_xrc.xrcCache901UI, wx.FileDropTarget, listmix.Colum
             cfg.logsplitpos = self.logsSplitter.GetSashPosition()
             cfg.picsplitpos = self.picSplitter.GetSashPosition()
             cfg.mainwinsize = self.GetSize()
+            self.mainttimer.Stop()
+            if self.backupthread is not None:
+                self.backupthread.join()
             try:
                 self.geoicons.Destroy()
             except:
@@ -476,7 +586,7 @@ class Cache901UI(cache901.ui_xrc.xrcCache901UI, wx.FileDropTarget, listmix.Colum
             self.caches.Select(iid, 0)
             iid = self.caches.GetFirstSelected()
         self.clearAllGui()
-        self.ld_cache = cache901.db().query(sadbobjects.Locations).get(evt.GetData())
+        self.ld_cache = cache901.db().query(sadbobjects.Locations).options(undefer('comment')).get(self.points.GetItemData(evt.GetIndex()))
         self.cacheName.SetLabel(self.ld_cache.name)
         self.waypointLink.Label = self.ld_cache.name
         self.waypointLink.Refresh()
@@ -491,7 +601,15 @@ class Cache901UI(cache901.ui_xrc.xrcCache901UI, wx.FileDropTarget, listmix.Colum
             self.points.Select(iid, 0)
             iid = self.points.GetFirstSelected()
         self.clearAllGui()
-        self.ld_cache = cache901.db().query(sadbobjects.Caches).get(evt.GetData())
+        source = getattr(self.caches.source.row(evt.GetIndex()), 'source', None)
+        if source is not None and source != cache901.cfg().dbfilebase:
+            # The cache came from another database in a search of them all,
+            # and only the open database can be shown and edited
+            if wx.MessageBox('This cache is in the %s database.\nOpen %s to show it?' % (source, source),
+                             'Switch Database?', wx.YES_NO | wx.CENTER, self) != wx.YES:
+                return
+            self.openDatabase(source)
+        self.ld_cache = cache901.db().query(sadbobjects.Caches).options(undefer_group('descriptions')).get(self.caches.GetItemData(evt.GetIndex()))
         # Set up travel bug listings
         self.trackableListCtrl.DeleteAllItems()
         for bug in self.ld_cache.travelbugs:
@@ -587,24 +705,16 @@ class Cache901UI(cache901.ui_xrc.xrcCache901UI, wx.FileDropTarget, listmix.Colum
             usernames.append(account.username)
         return usernames
 
-    def importSpecificFile(self, path, maintdb=True):
-        if path.lower().endswith('.zip'):
-            cache901.notify('Examining %s for gpx files' % path)
-            zfile = zipfile.ZipFile(path)
-            gpxziplist = filter(lambda x: x.lower().endswith('.gpx'), zfile.namelist())
-            for gpxname in gpxziplist:
-                cache901.notify('Processing %s%s%s' % (path, os.sep, gpxname))
-                cache901.xml901.parse(zfile.read(gpxname), False)
-                cache901.notify('Completed processing %s%s%s' % (path, os.sep, gpxname))
-        elif path.lower().endswith('.gpx'):
-            cache901.notify('Processing %s' % path)
-            infile = open(path)
-            cache901.xml901.parse(infile, False)
-            cache901.notify('Completed processing %s' % path)
-        else:
-            cache901.notify('Unable to process file %s' % path)
-        if maintdb:
-            cache901.db().maintdb()
+    def importFiles(self, paths, maintdb=True):
+        sources = []
+        for path in paths:
+            if path.lower().endswith('.zip'):
+                cache901.notify('Examining %s for gpx files' % path)
+            pathsources = cache901.xml901.gpxSources(path)
+            if len(pathsources) == 0:
+                cache901.notify('Unable to process file %s' % path)
+            sources.extend(pathsources)
+        return cache901.xml901.importSources(sources, maintdb)
     
     
     def OnImportFile(self, evt):
@@ -614,9 +724,7 @@ class Cache901UI(cache901.ui_xrc.xrcCache901UI, wx.FileDropTarget, listmix.Colum
             fdg.SetDirectory(cfg.lastimportdir)
         if fdg.ShowModal() == wx.ID_OK:
             cfg.lastimportdir = fdg.GetDirectory()
-            for path in fdg.GetPaths():
-                self.importSpecificFile(path, False)
-            cache901.db().maintdb()
+            self.importFiles(fdg.GetPaths())
             self.loadData()
         self.updStatus()
 
@@ -807,12 +915,7 @@ class Cache901UI(cache901.ui_xrc.xrcCache901UI, wx.FileDropTarget, listmix.Colum
 
 
     def OnShowMap(self, evt):
-        i = 0
-        cacheids = []
-        while i < self.caches.GetItemCount():
-            cacheids.append(self.caches.GetItemData(i))
-            i = i + 1
-        mapui = cache901.mapping.MapUI(self, cacheids)
+        mapui = cache901.mapping.MapUI(self, self.caches.itemIds())
         if mapui.ShowModal() == wx.ID_OK:
             cid = mapui.found
             if cid is not None:
@@ -1118,15 +1221,10 @@ class Cache901UI(cache901.ui_xrc.xrcCache901UI, wx.FileDropTarget, listmix.Colum
 
 
     def OnDropFiles(self, x, y, filenames):
-        for filename in filenames:
-            self.importSpecificFile(filename, False)
-        cache901.db().maintdb()
+        self.importFiles(filenames)
         self.updStatus()
             
     
-    def GetListCtrl(self):
-        return self.caches
-    
     def OnDeleteCacheOrWaypoint(self, evt):
         iid = self.caches.GetFirstSelected()
         if iid > -1:
@@ -1134,15 +1232,10 @@ class Cache901UI(cache901.ui_xrc.xrcCache901UI, wx.FileDropTarget, listmix.Colum
             if wx.MessageBox('Warning! This cannot be undone!\nReally delete cache: "%s"?' % cache.url_name, 'Really Delete?', wx.ICON_WARNING | wx.YES_NO, self) == wx.YES:
                 cache901.db().delete(cache)
                 cache901.db().commit()
-                if self.caches.GetItemCount() > 1:
-                    if iid == 0:
-                        self.caches.Select(iid+1)
-                        self.caches.DeleteItem(iid)
-                    else:
-                        self.caches.Select(iid-1)
-                        self.caches.DeleteItem(iid)
+                self.caches.DeleteItem(iid)
+                if self.caches.GetItemCount() > 0:
+                    self.caches.Select(max(iid-1, 0))
                 else:
-                    self.caches.DeleteItem(iid)
                     self.clearAllGui()
         else:
             iid = self.points.GetFirstSelected()
@@ -1151,15 +1244,10 @@ class Cache901UI(cache901.ui_xrc.xrcCache901UI, wx.FileDropTarget, listmix.Colum
                 if wx.MessageBox('Warning! This cannot be undone!\nReally delete waypoint: "%s"?' % wpt.name, 'Really Delete?', wx.ICON_WARNING | wx.YES_NO, self) == wx.YES:
                     cache901.db().delete(wpt)
                     cache901.db().commit()
-                    if self.points.GetItemCount() > 1:
-                        if iid == 0:
-                            self.points.Select(iid+1)
-                            self.points.DeleteItem(iid)
-                        else:
-                            self.points.Select(iid-1)
-                            self.points.DeleteItem(iid)
+                    self.points.DeleteItem(iid)
+                    if self.points.GetItemCount() > 0:
+                        self.points.Select(max(iid-1, 0))
                     else:
-                        self.points.DeleteItem(iid)
                         self.clearAllGui()
                 
     def OnAddAltCoords(self, evt):
@@ -1194,13 +1282,31 @@ class Cache901UI(cache901.ui_xrc.xrcCache901UI, wx.FileDropTarget, listmix.Colum
         isinstance(evt, wx.CommandEvent)
         item = self.mnuSwitchDb.FindItemById(evt.GetId())
         isinstance(item, wx.MenuItem)
-        dbname = os.sep.join([cache901.cfg().dbpath, "%s.sqlite" % (item.GetItemLabel())])
-        cache901.cfg().dbfile = dbname
-        cache901.sadbobjects.DBSession = None
+        self.openDatabase(item.GetItemLabel())
         self.loadData()
+        self.updStatus()
+    
+    def openDatabase(self, dbname):
+        if cache901.sadbobjects.DBSession is not None:
+            # Searches of all databases can't update the one being left
+            cache901.sadbobjects.syncFullText()
+            cache901.sadbobjects.refreshCacheStatus()
+        cache901.sadbobjects.closeDb()
+        cache901.cfg().dbfile = os.sep.join([cache901.cfg().dbpath, "%s.sqlite" % (dbname)])
         dbname = cache901.cfg().dbfilebase
         for item in self.mnuSwitchDb.GetMenuItems():
+            if item.GetId() not in (self.mnuSearchAllDbs.GetId(), self.mnuMemoryCopy.GetId()):
                 item.Check(dbname == item.GetLabel())
+    
+    def OnSearchAllDbs(self, evt):
+        cache901.cfg().searchalldbs = self.mnuSearchAllDbs.IsChecked()
+        self.loadData()
+        self.updStatus()
+    
+    def OnMemoryCopy(self, evt):
+        cache901.cfg().memorycopy = self.mnuMemoryCopy.IsChecked()
+        cache901.sadbobjects.closeDb()
+        self.loadData()
         self.updStatus()
     
     def buildDbMenu(self):
@@ -1208,6 +1314,12 @@ class Cache901UI(cache901.ui_xrc.xrcCache901UI, wx.FileDropTarget, listmix.Colum
             self.mnuSwitchDb.RemoveItem(item)
         item = self.mnuSwitchDb.Append(-1, 'New Database')
         self.Bind(wx.EVT_MENU, self.OnNewDatabase, item)
+        self.mnuSearchAllDbs = self.mnuSwitchDb.AppendCheckItem(-1, 'Search All Databases')
+        self.mnuSearchAllDbs.Check(cache901.cfg().searchalldbs)
+        self.Bind(wx.EVT_MENU, self.OnSearchAllDbs, self.mnuSearchAllDbs)
+        self.mnuMemoryCopy = self.mnuSwitchDb.AppendCheckItem(-1, 'Keep Database in Memory')
+        self.mnuMemoryCopy.Check(cache901.cfg().memorycopy)
+        self.Bind(wx.EVT_MENU, self.OnMemoryCopy, self.mnuMemoryCopy)
         self.mnuSwitchDb.AppendSeparator()
         dbname = cache901.cfg().dbfilebase
         for db in cache901.util.getDbList():
@@ -1218,11 +1330,11 @@ class Cache901UI(cache901.ui_xrc.xrcCache901UI, wx.FileDropTarget, listmix.Colum
                 item.Check()
     
     def OnExportKML(self, evt):
-        cache901.util.exportKML(self.itemDataMap.keys())
+        cache901.util.exportKML(self.caches.itemIds())
         self.updStatus()
     
     def OnExportTomTomPOI(self, evt):
-        cache901.util.exportTomTomPOI(self.itemDataMap.keys())
+        cache901.util.exportTomTomPOI(self.caches.itemIds())
         self.updStatus()
     
     def forWingIde(self):
@@ -1302,6 +1414,70 @@ class Cache901UI(cache901.ui_xrc.xrcCache901UI, wx.FileDropTarget, listmix.Colum
         isinstance(self.mnuExportKML, wx.MenuItem)
 
         
+class VirtualList(wx.ListCtrl):
+    """
+    The cache and waypoint lists. They hold no rows of their own: source
+    (a search.SearchCursor, or a search.RowList) hands out the rows as they
+    are drawn, and text(row, column) turns them into the text to show.
+    Item data is the key of each row.
+    """
+    def __init__(self):
+        # Two stage creation, since xrc creates the control
+        pre = wx.PreListCtrl()
+        self.PostCreate(pre)
+        self.source = None
+        self.text = None
+
+    def setSource(self, source, text):
+        self.clearSelection()
+        self.source = source
+        self.text = text
+        self.SetItemCount(source.count())
+        self.Refresh()
+
+    def clearSelection(self):
+        # A virtual list selects by index, which means another row once
+        # the rows change
+        item = self.GetFirstSelected()
+        while item != -1:
+            self.Select(item, 0)
+            item = self.GetNextSelected(item)
+
+    def OnGetItemText(self, item, col):
+        row = self.source.row(item)
+        if row is None:
+            return ''
+        return self.text(row, col)
+
+    def GetItemData(self, item):
+        return self.source.rowKey(item)
+
+    def FindItemData(self, start, data):
+        item = self.source.find(data)
+        if item < start:
+            return -1
+        return item
+
+    def itemIds(self):
+        # Only for what works on every cache in the list: the map and the
+        # exports. Finding one row goes through FindItemData.
+        if self.source is None:
+            return []
+        return self.source.ids()
+
+    def DeleteItem(self, item):
+        self.Select(item, 0)
+        self.source.remove(item)
+        self.SetItemCount(self.source.count())
+        self.Refresh()
+
+    def DeleteAllItems(self):
+        self.clearSelection()
+        self.source = cache901.search.RowList([], None)
+        self.SetItemCount(0)
+        self.Refresh()
+
+
 class AltCoordsTable(wx.grid.PyGridTableBase):
     def __init__(self):
         wx.grid.PyGridTableBase.__init__(self)
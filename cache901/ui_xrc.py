@@ -255,6 +255,7 @@ class xrcOptionsUI(wx.Dialog):
         self.general = xrc.XRCCTRL(self, "general")
         self.coordDisplay = xrc.XRCCTRL(self, "coordDisplay")
         self.maxLogs = xrc.XRCCTRL(self, "maxLogs")
+        self.compressText = xrc.XRCCTRL(self, "compressText")
         self.gpsType = xrc.XRCCTRL(self, "gpsType")
         self.gpsPort = xrc.XRCCTRL(self, "gpsPort")
         self.gpsbabelLoc = xrc.XRCCTRL(self, "gpsbabelLoc")
@@ -506,8 +507,8 @@ def __init_resources():
                   <object class="sizeritem">
                     <object class="wxStaticBoxSizer">
                       <object class="sizeritem">
-                        <object class="wxListCtrl" name="caches">
-                          <style>wxSUNKEN_BORDER|wxLC_REPORT</style>
+                        <object class="wxListCtrl" name="caches" subclass="cache901.ui.VirtualList">
+                          <style>wxSUNKEN_BORDER|wxLC_REPORT|wxLC_VIRTUAL</style>
                           <XRCED>
                             <assign_var>1</assign_var>
                           </XRCED>
@@ -531,8 +532,8 @@ def __init_resources():
                   <object class="sizeritem">
                     <object class="wxStaticBoxSizer">
                       <object class="sizeritem">
-                        <object class="wxListCtrl" name="points">
-                          <style>wxSUNKEN_BORDER|wxLC_REPORT</style>
+                        <object class="wxListCtrl" name="points" subclass="cache901.ui.VirtualList">
+                          <style>wxSUNKEN_BORDER|wxLC_REPORT|wxLC_VIRTUAL</style>
                           <XRCED>
                             <assign_var>1</assign_var>
                           </XRCED>
@@ -2076,6 +2077,17 @@ http://www.justwill.com/</value>
                               <flag>wxEXPAND|wxGROW|wxALIGN_LEFT</flag>
                               <cellpos>2,1</cellpos>
                             </object>
+                            <object class="sizeritem">
+                              <object class="wxCheckBox" name="compressText">
+                                <label>Compress long text (applied by database maintenance)</label>
+                                <XRCED>
+                                  <assign_var>1</assign_var>
+                                </XRCED>
+                              </object>
+                              <flag>wxALIGN_LEFT|wxALIGN_CENTRE_VERTICAL</flag>
+                              <cellpos>3,0</cellpos>
+                              <cellspan>1,2</cellspan>
+                            </object>
                             <vgap>5</vgap>
                             <hgap>5</hgap>
                             <growablecols>1</growablecols>
@@ -21,19 +21,21 @@ with this program; if not, write to the Free Software Foundation, Inc.,
 import math
 import os
 import os.path
-import serial
 import shutil
+import struct
 import sys
 import tempfile
-import wx
+import unicodedata
 
 from decimal import Decimal, InvalidOperation
 
 from sqlalchemy import func, or_
 import cache901
-import cache901.kml
 from cache901 import sadbobjects
-import gpsbabel
+
+# wx, serial, gpsbabel and cache901.kml are imported by the functions which
+# need them, so the database and import code can use this module without
+# any of them installed.
 
 degsym = u'\u00B0'
 
@@ -50,6 +52,78 @@ def distance_exact(lat1_in, lon1_in, lat2_in, lon2_in):
           math.cos(lat2/57.2958) * 
           math.cos(lon2/57.2958 - lon1/57.2958))))
 
+def unitVector(lat_in, lon_in):
+    # The point on the unit sphere at lat, lon, as (x, y, z)
+    lat = float(lat_in) / 57.2958
+    lon = float(lon_in) / 57.2958
+    return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+
+def dotForDistance(miles):
+    """
+    Returns the smallest dot product of two unit vectors which are within
+    miles of each other, as distance_exact measures it (rounded to
+    hundredths of a mile).
+    """
+    return math.cos(min(miles + 0.005, math.pi * 3958.75) / 3958.75)
+
+def searchKey(text):
+    """
+    Folds text for the name search keys: accents are dropped and letters
+    lower cased, so u'Caf\xe9 Wally' and u'cafe wally' have the same key.
+    """
+    if text is None:
+        return None
+    if not isinstance(text, unicode):
+        text = unicode(text, 'utf-8', 'replace')
+    text = unicodedata.normalize('NFKD', text)
+    return u''.join(filter(lambda x: not unicodedata.combining(x), text)).lower()
+
+def searchKeyBounds(prefix):
+    """
+    Returns (low, high), the range of keys which start with prefix: every
+    one sorts at or after prefix, and before prefix with its last character
+    bumped up by one.
+    """
+    return (prefix, prefix[:-1] + unichr(ord(prefix[-1]) + 1))
+
+def ftsRank(matchinfo, *weights):
+    """
+    Scores a full text match from its matchinfo() blob: for each phrase and
+    column, the share of all of that phrase's hits in the column which are
+    in this row, times the column's weight (1 unless given).
+    """
+    ints = struct.unpack('=%dI' % (len(matchinfo) / 4), str(matchinfo))
+    phrases, cols = ints[0], ints[1]
+    score = 0.0
+    for phrase in range(phrases):
+        for col in range(cols):
+            hits, total = ints[2 + 3 * (phrase * cols + col)], ints[3 + 3 * (phrase * cols + col)]
+            if hits > 0:
+                weight = 1.0
+                if col < len(weights):
+                    weight = weights[col]
+                score += weight * float(hits) / total
+    return score
+
+def boundingBox(lat_in, lon_in, miles):
+    """
+    Returns (minlat, maxlat, minlon, maxlon) of a box holding every point
+    within miles of lat, lon. Near a pole, or across the date line, the
+    box spans every longitude.
+    """
+    lat = float(lat_in)
+    lon = float(lon_in)
+    # a little extra, since distance_exact rounds to hundredths of a mile
+    dlat = (miles * 1.01 + 0.01) / (3958.75 / 57.2958)
+    minlat = lat - dlat
+    maxlat = lat + dlat
+    if minlat <= -90 or maxlat >= 90:
+        return (max(minlat, -90.0), min(maxlat, 90.0), -180.0, 180.0)
+    dlon = dlat / math.cos(max(abs(minlat), abs(maxlat)) / 57.2958)
+    if lon - dlon < -180 or lon + dlon > 180:
+        return (minlat, maxlat, -180.0, 180.0)
+    return (minlat, maxlat, lon - dlon, lon + dlon)
+
 def decToD(decDegree):
     plus = (decDegree >= 0)
     decDegree = abs(decDegree)
@@ -176,6 +250,7 @@ def which(cmd):
     return None
 
 def scanForSerial():
+    import serial
     available = []
     if sys.platform == "win32":
         import cache901.scanwin32
@@ -197,6 +272,20 @@ def scanForSerial():
                 pass
     return available
 
+# SQLite refuses statements with more than 999 bound parameters, so IN
+# lists are split into slices no longer than this.
+maxinlist = 500
+
+def inQuery(qry, column, values):
+    """
+    Runs qry once per slice of values, filtered with column IN (slice),
+    and yields every row found.
+    """
+    values = list(values)
+    for i in range(0, len(values), maxinlist):
+        for row in qry.filter(column.in_(values[i:i+maxinlist])):
+            yield row
+
 def getWaypoints(params={}):
     qry = cache901.db().query(sadbobjects.Locations).filter(sadbobjects.Locations.loc_type == 1).order_by(sadbobjects.Locations.name)
     if params.has_key('ids'):
@@ -206,7 +295,7 @@ def getWaypoints(params={}):
         qry = qry.filter(sadbobjects.Locations.wpt_id.in_(params['ids']))
         qry = qry.order_by(sadbobjects.CacheDay.cache_order)
     if params.has_key('searchpat') and len(params['searchpat']) >= 2:
-        qry = qry.filter(func.lower(sadbobjects.Locations.name).like(params['searchpat']))
+        qry = qry.filter(sadbobjects.searchKeyFilter(sadbobjects.Locations.name_key, params['searchpat']))
     if params.has_key('addwpts'): # additional waypoints listing
         qry = qry.filter(sadbobjects.Locations.name.in_(params['addwpts']))
     return qry
@@ -214,10 +303,11 @@ def getWaypoints(params={}):
 def getSearchLocs(searchpat=None):
     qry = cache901.db().query(sadbobjects.Locations).filter(sadbobjects.Locations.loc_type == 2)
     if searchpat is not None and len(searchpat) >= 2:
-        searchpat = '%%%s%%' % (searchpat.lower())
+        # There are only ever a few search locations, so matching anywhere
+        # in their names costs next to nothing
         qry = qry.filter(or_(
-            func.lower(sadbobjects.Locations.name).like(searchpat),
-            func.lower(sadbobjects.Locations.desc).like(searchpat)
+            sadbobjects.searchKeyFilter(sadbobjects.Locations.name_key, searchpat, True),
+            func.lower(sadbobjects.Locations.desc).like('%%%s%%' % searchpat.lower())
         ))
     qry = qry.order_by(sadbobjects.Locations.name)
     return qry
@@ -230,6 +320,8 @@ def getDefaultCoords(cache):
     
 
 def exportKML(cacheids, outdir=None, confirmDir=True):
+    import wx
+    import cache901.kml
     if outdir is None and not confirmDir:
         raise Exception('Never exported KML before, no idea where to write it.')
     if confirmDir:
@@ -244,6 +336,9 @@ def exportKML(cacheids, outdir=None, confirmDir=True):
     k.export(cacheids, outdir)
 
 def exportTomTomPOI(cacheids, outdir=None, confirmDir=True):
+    import wx
+    import gpsbabel
+    import cache901.kml
     if outdir is None and not confirmDir:
         raise Exception('Never exported TomTom POI before, no idea where to write it.')
     if confirmDir:
@@ -272,6 +367,7 @@ def getDbList():
     return map(lambda x: os.path.splitext(x)[0], filter(lambda x: x.lower().endswith('.sqlite'), os.listdir(cache901.cfg().dbpath)))
 
 def CacheToGPX(cache):
+    import gpsbabel
     gpx = gpsbabel.GPXData()
     wpt = gpsbabel.GPXWaypoint()
     (lat, lon) = getDefaultCoords(cache)
@@ -284,6 +380,7 @@ def CacheToGPX(cache):
     return gpx
 
 def CacheDayToGPX(cacheday):
+    import gpsbabel
     gpx = gpsbabel.GPXData()
     route = gpsbabel.GPXRoute()
     route.name = cacheday.dayname
@@ -55,6 +55,30 @@ class spinCtlValidator(wx.PyValidator):
         spinnum = fp.GetValue()
         setattr(cfg, self.varname, spinnum)
         
+class checkBoxValidator(wx.PyValidator):
+    def __init__(self, varname):
+        wx.PyValidator.__init__(self)
+        self.varname = varname
+        
+    def Clone(self):
+        return checkBoxValidator(self.varname)
+    
+    def Validate(self, win):
+        return True
+    
+    def TransferToWindow(self):
+        fp = self.GetWindow()
+        isinstance(fp, wx.CheckBox)
+        cfg = cache901.cfg()
+        fp.SetValue(getattr(cfg, self.varname))
+        fp.Refresh()
+        
+    def TransferFromWindow(self):
+        fp = self.GetWindow()
+        isinstance(fp, wx.CheckBox)
+        cfg = cache901.cfg()
+        setattr(cfg, self.varname, fp.GetValue())
+        
 class cmdValidator(wx.PyValidator):
     def Clone(self):
         return cmdValidator()
@@ -20,121 +20,654 @@ with this program; if not, write to the Free Software Foundation, Inc.,
 import xml.sax
 import xml.sax.handler
 import datetime
+import hashlib
+import os
 import time
+import zipfile
 
+from cStringIO import StringIO
 from decimal import Decimal
 from xml.etree import cElementTree
 
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
 import cache901
+import cache901.progress
+import cache901.util
 
 from cache901.sadbobjects import *
+from cache901.util import inQuery
+
+gpxns = '{http://www.topografix.com/GPX/1/0}'
+gsns = '{http://www.groundspeak.com/cache/1/0}'
+gpxwpt = gpxns + 'wpt'
+
+def iterwpts(data):
+    """
+    Yields each wpt element of a gpx file as soon as it has been completely
+    read. data can be a string, or any file-like object (an open file, a
+    zip member, a StringIO wrapped around an email payload). Elements which
+    have already been handed out are released from the tree once the caller
+    asks for the next one, so memory use does not grow with the file size.
+    """
+    if isinstance(data, basestring):
+        data = StringIO(data)
+    context = iter(cElementTree.iterparse(data, events=('start', 'end')))
+    event, root = context.next()
+    for event, elem in context:
+        if event == 'end' and elem.tag == gpxwpt:
+            yield elem
+            root.clear()
+
+# Number of waypoints whose cache, hint, log and travel bug rows are looked
+# up together. Each lookup is a handful of IN queries per chunk instead of
+# one query per row. Every chunk is committed on its own, too. Imports use
+# the importchunksize setting; this is the size used without one.
+chunksize = 250
+
+class ImportResolver(object):
+    """
+    Collects the cache ids, log ids and travel bug refs of a chunk of
+    waypoint records, and resolves all of them with a few set based
+    queries. The importer then works from the in-memory maps, and registers
+    any new objects it creates so that later waypoints in the same chunk
+    find them.
+    """
+    def __init__(self, records):
+        cacheids, logids, bugrefs = recordKeys(records)
+        db = cache901.db()
+        self.caches = {}
+        self.hints = {}
+        self.logs = {}
+        self.bugs = {}
+        for cache in inQuery(db.query(Caches), Caches.cache_id, cacheids):
+            self.caches[cache.cache_id] = cache
+        for hint in inQuery(db.query(Hints), Hints.cache_id, cacheids):
+            self.hints[hint.cache_id] = hint
+        for log in inQuery(db.query(Logs), Logs.id, logids):
+            self.logs[log.id] = log
+        for bug in inQuery(db.query(TravelBugs), TravelBugs.ref, bugrefs):
+            self.bugs[bug.ref] = bug
+
+def recordKeys(records):
+    cacheids = set()
+    logids = set()
+    bugrefs = set()
+    for rec in records:
+        if rec['cache'] is not None:
+            cacheids.add(rec['cache']['cache_id'])
+            for log in rec['logs']:
+                logids.add(log['id'])
+            for bug in rec['bugs']:
+                bugrefs.add(bug['ref'])
+    return (cacheids, logids, bugrefs)
+
+# Only the day of a gpx timestamp is kept, and a pocket query's logs are
+# spread over comparatively few days, so each day is converted only once.
+gpxdates = {}
 
-def parse(data, maint=True):
-    if (type(data) is str):
-        parsed = cElementTree.fromstring(data)
+def gpxDate(datestr):
+    datepart = datestr.split('T')[0]
+    try:
+        return gpxdates[datepart]
+    except KeyError:
+        pass
+    (year, mon, day)=map(lambda x: int(x), datepart.split('-'))
+    d = datetime.datetime(year, mon, day, 0, 0, 0)
+    stamp = time.mktime(d.timetuple())
+    if time.daylight:
+        stamp -= time.altzone
     else:
-        parsed = cElementTree.parse(data)
-    # manage the parsed data here
-    cache_counter = 0
-    for wpt in parsed.findall('{http://www.topografix.com/GPX/1/0}wpt'):
-        cachedata = wpt.find('{http://www.groundspeak.com/cache/1/0}cache')
-        if cachedata:
-            cache_id = int(cachedata.get('id'))
-            cache = cache901.db().query(Caches).get(cache_id)
-            if not cache:
-                cache = Caches()
-                cache901.db().add(cache)
-            cache.cache_id = cache_id
-            cache.available = (cachedata.get('available').lower() == 'true')
-            cache.archived = (cachedata.get('archived').lower() == 'true')
-            for node in cachedata.getchildren():
-                if node.tag.endswith('}placed_by'): cache.placed_by = node.text
-                elif node.tag.endswith('}owner'):
-                    cache.owner_name = node.text
-                    cache.owner_id = node.get('id')
-                elif node.tag.endswith('}container'): cache.container = node.text
-                elif node.tag.endswith('}country'): cache.country = node.text
-                elif node.tag.endswith('}state'): cache.state = node.text
-                elif node.tag.endswith('}short_description'):
-                    cache.short_desc = node.text
-                    cache.short_desc_html = (node.get('html').lower() == 'true')
-                elif node.tag.endswith('}long_description'):
-                    cache.long_desc = node.text
-                    cache.long_desc_html = (node.get('html').lower() == 'true')
-                elif node.tag.endswith('}difficulty'): cache.difficulty = Decimal(node.text)
-                elif node.tag.endswith('}terrain'): cache.terrain = Decimal(node.text)
-                elif node.tag.endswith('}encoded_hints'):
-                    hint = cache901.db().query(Hints).get(cache_id)
-                    if not hint:
-                        hint = Hints()
-                        cache.hint.append(hint)
-                    hint.hint = node.text
-                    hint.cache_id = cache.cache_id
-                elif node.tag.endswith('}travelbugs'):
-                    for bugnode in node.findall('{http://www.groundspeak.com/cache/1/0}travelbug'):
-                        ref = bugnode.get('ref')
-                        bug = cache901.db().query(TravelBugs).filter(TravelBugs.ref == ref).first()
-                        if not bug:
-                            bug = TravelBugs()
-                            cache.travelbugs.append(bug)
-                        bug.ref = ref
-                        bug.id = int(bugnode.get('id'))
-                        bug.cache_id = cache.cache_id
-                        bug.name = bugnode.find('{http://www.groundspeak.com/cache/1/0}name').text
-                elif node.tag.endswith('}logs'):
-                    for lognode in node.findall('{http://www.groundspeak.com/cache/1/0}log'):
-                        logid = lognode.get('id')
-                        log = cache901.db().query(Logs).get(logid)
-                        if not log:
-                            log = Logs()
-                            cache.logs.append(log)
-                        log.id = logid
-                        log.cache_id = cache.cache_id
-                        logfindernode = lognode.find('{http://www.groundspeak.com/cache/1/0}finder')
-                        log.finder_id = logfindernode.get('id')
-                        log.finder = logfindernode.text
-                        logtextnode = lognode.find('{http://www.groundspeak.com/cache/1/0}text')
-                        log.log_entry_encoded = (logtextnode.get('encoded').lower() == 'true')
-                        log.log_entry = logtextnode.text
-                        log.type = lognode.find('{http://www.groundspeak.com/cache/1/0}type').text
-                        logdatenode = lognode.find('{http://www.groundspeak.com/cache/1/0}date')
-                        (year, mon, day)=map(lambda x: int(x), logdatenode.text.split('T')[0].split('-'))
-                        d = datetime.datetime(year, mon, day, 0, 0, 0)
-                        log.date = time.mktime(d.timetuple())
-                        if time.daylight:
-                            log.date -= time.altzone
-                        else:
-                            log.date -= time.timezone
-        else:
-            cache = Locations()
-            cache.loc_type = 1
-            cache.refers_to = -1
-        cache.lat = Decimal(wpt.get('lat'))
-        cache.lon = Decimal(wpt.get('lon'))
-        for node in wpt.getchildren():
-            if node.tag.endswith('}name'): cache.name = node.text
-            elif node.tag.endswith('}time'):
-                (year, mon, day)=map(lambda x: int(x), node.text.split('T')[0].split('-'))
-                d = datetime.datetime(year, mon, day, 0, 0, 0)
-                hidden = time.mktime(d.timetuple())
-                if time.daylight:
-                    hidden -= time.altzone
-                else:
-                    hidden -= time.timezone
-                cache.hidden = hidden
-            elif node.tag.endswith('}cmt'): cache.comment = node.text
-            elif node.tag.endswith('}desc'):
-                cache.desc = node.text
-                cache.url_desc = node.text
-            elif node.tag.endswith('}url'): cache.url = node.text
-            elif node.tag.endswith('}urlname'):
-                cache.url_name = node.text
-                if cache_counter == 0:
-                    cache901.notify("Processing %s" % cache901.util.forceAscii(cache.url_name))
-                cache_counter = (cache_counter + 1) % 5
-            elif node.tag.endswith('}sym'): cache.sym = node.text
-            elif node.tag.endswith('}type'): cache.type = node.text
-        cache901.db().add(cache)
-    cache901.db().commit()
+        stamp -= time.timezone
+    gpxdates[datepart] = stamp
+    return stamp
+
+def nodeText(node): return node.text
+def nodeDecimal(node): return Decimal(node.text)
+def nodeDate(node): return gpxDate(node.text)
+def nodeAttr(name): return lambda node: node.get(name)
+def nodeFlag(name): return lambda node: (node.get(name).lower() == 'true')
+
+def fieldTable(ns, fields):
+    """
+    Compiles a list of (tag, column, converter) entries into a dictionary
+    from fully qualified tag to the (column, converter) pairs filled from
+    that tag. A tag may feed more than one column.
+    """
+    table = {}
+    for tag, column, converter in fields:
+        table.setdefault(ns + tag, []).append((column, converter))
+    return table
+
+def mapFields(table, parent, row):
+    # Fills row from the children of parent which appear in table
+    for node in parent:
+        for column, converter in table.get(node.tag, ()):
+            row[column] = converter(node)
+    return row
+
+wptfields = fieldTable(gpxns, [
+    ('name', 'name', nodeText),
+    ('time', 'hidden', nodeDate),
+    ('cmt', 'comment', nodeText),
+    ('desc', 'desc', nodeText),
+    ('desc', 'url_desc', nodeText),
+    ('url', 'url', nodeText),
+    ('urlname', 'url_name', nodeText),
+    ('sym', 'sym', nodeText),
+    ('type', 'type', nodeText),
+    ])
+
+cachefields = fieldTable(gsns, [
+    ('placed_by', 'placed_by', nodeText),
+    ('owner', 'owner_name', nodeText),
+    ('owner', 'owner_id', nodeAttr('id')),
+    ('container', 'container', nodeText),
+    ('country', 'country', nodeText),
+    ('state', 'state', nodeText),
+    ('short_description', 'short_desc', nodeText),
+    ('short_description', 'short_desc_html', nodeFlag('html')),
+    ('long_description', 'long_desc', nodeText),
+    ('long_description', 'long_desc_html', nodeFlag('html')),
+    ('difficulty', 'difficulty', nodeDecimal),
+    ('terrain', 'terrain', nodeDecimal),
+    ])
+
+logfields = fieldTable(gsns, [
+    ('finder', 'finder', nodeText),
+    ('finder', 'finder_id', nodeAttr('id')),
+    ('text', 'log_entry', nodeText),
+    ('text', 'log_entry_encoded', nodeFlag('encoded')),
+    ('type', 'type', nodeText),
+    ('date', 'date', nodeDate),
+    ])
+
+bugfields = fieldTable(gsns, [
+    ('name', 'name', nodeText),
+    ])
+
+cachecols = set(Caches.__table__.c.keys())
+locationcols = set(Locations.__table__.c.keys())
+
+def loadFingerprints():
+    """
+    Returns the fingerprints of every cache and waypoint in the database.
+    A wpt whose fingerprint is in here is already stored exactly as the
+    file has it, and is skipped without being mapped. This is a full read
+    of both tables, so it is done once per import run and the set handed
+    on to the parsing (see parse and importSources).
+    """
+    db = cache901.db()
+    prints = set(map(lambda x: x[0], db.query(Caches.fingerprint).filter(Caches.fingerprint != None)))
+    prints.update(map(lambda x: x[0], db.query(Locations.fingerprint).filter(Locations.fingerprint != None)))
+    return prints
+
+# The writer's fingerprints, inside a process pool worker
+knownprints = set()
+
+def setFingerprints(prints):
+    # Process pool initializer, handing the writer's fingerprints to a worker
+    global knownprints
+    knownprints = prints
+
+def wptFingerprint(wpt):
+    """
+    Returns a hash of everything in a wpt element, including its logs and
+    travel bugs. The whitespace after the element is left out, so the
+    position of a waypoint within its file does not change the hash.
+    """
+    tail = wpt.tail
+    wpt.tail = None
+    try:
+        return unicode(hashlib.md5(cElementTree.tostring(wpt)).hexdigest())
+    finally:
+        wpt.tail = tail
+
+class ImportStats(object):
+    """
+    Timings and counters for an import, which can span many files (a whole
+    gpxSyncAll shares one). Time is split into phases: parse (xml reading
+    and field mapping, summed over the pool workers), lookup (finding
+    existing rows), write (mapping onto rows and flushing them), commit,
+    indexes (rebuilding them after a bulk load, full text indexing and
+    the cache status summary) and maint (maintdb). The counters are
+    indexed like a dictionary, e.g. stats['skipped'] += 1.
+    """
+    phases = ['parse', 'lookup', 'write', 'commit', 'indexes', 'maint']
+    counters = ['waypoints', 'logs', 'added', 'updated', 'skipped']
+
+    def __init__(self):
+        self.started = time.time()
+        self.firstquery = cache901.sadbobjects.querycount
+        self.times = dict.fromkeys(self.phases, 0.0)
+        self.counts = dict.fromkeys(self.counters, 0)
+
+    def __getitem__(self, key):
+        return self.counts[key]
+
+    def __setitem__(self, key, val):
+        self.counts[key] = val
+
+    def addTime(self, phase, secs):
+        self.times[phase] += secs
+
+    def timed(self, phase, func, *args, **kwargs):
+        # Calls func, charging the time it takes to phase
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.addTime(phase, time.time() - start)
+
+    def merge(self, counts, times):
+        for key, val in counts.items():
+            self.counts[key] += val
+        for key, val in times.items():
+            self.times[key] += val
+
+    def report(self):
+        """
+        Returns the statistics as a dictionary holding the total elapsed
+        time, the time per phase, the counters (plus the number of queries
+        issued) and the waypoint and log throughput per second.
+        """
+        elapsed = time.time() - self.started
+        counts = dict(self.counts)
+        counts['queries'] = cache901.sadbobjects.querycount - self.firstquery
+        rates = {}
+        for key in ['waypoints', 'logs']:
+            if elapsed > 0:
+                rates[key] = counts[key] / elapsed
+            else:
+                rates[key] = 0.0
+        return { 'elapsed': elapsed, 'phases': dict(self.times), 'counts': counts, 'rates': rates }
+
+    def summary(self):
+        rpt = self.report()
+        return 'Import complete: %d added, %d updated, %d unchanged and skipped, %.1f waypoints/s' % (
+            rpt['counts']['added'], rpt['counts']['updated'], rpt['counts']['skipped'], rpt['rates']['waypoints'])
+
+    def save(self, source):
+        rpt = self.report()
+        row = cache901.sadbobjects.ImportStatistics()
+        row.started = int(self.started)
+        row.version = unicode(cache901.version)
+        row.source = unicode(source)
+        row.elapsed = rpt['elapsed']
+        for phase in ['parse', 'lookup', 'write', 'commit', 'maint']:
+            setattr(row, '%s_time' % phase, rpt['phases'][phase])
+        row.index_time = rpt['phases']['indexes']
+        for key in ['waypoints', 'logs', 'queries', 'added', 'updated', 'skipped']:
+            setattr(row, key, rpt['counts'][key])
+        cache901.db().add(row)
+        cache901.db().commit()
+
+    def finish(self, source):
+        """
+        Reports the outcome of an import, and keeps the statistics in the
+        import_stats table if the user has asked for that.
+        """
+        cache901.notify(self.summary(), True)
+        if cache901.cfg().saveimportstats:
+            self.save(source)
+        return self.report()
+
+def wptRecord(wpt, fingerprint=None):
+    """
+    Maps a single wpt element onto plain dictionaries of column values.
+    The result has a 'cache' or a 'location' row (the other is None), plus
+    the 'hint' row and the 'logs' and 'bugs' rows belonging to a cache.
+    Only columns which are present in the gpx data appear in the rows, so
+    applying a record never blanks out data the file did not mention.
+    """
+    rec = { 'cache': None, 'location': None, 'hint': None, 'logs': [], 'bugs': [] }
+    row = {}
+    if fingerprint is not None:
+        row['fingerprint'] = fingerprint
+    cachedata = wpt.find(gsns + 'cache')
+    if cachedata:
+        cache_id = int(cachedata.get('id'))
+        row['cache_id'] = cache_id
+        row['available'] = (cachedata.get('available').lower() == 'true')
+        row['archived'] = (cachedata.get('archived').lower() == 'true')
+        mapFields(cachefields, cachedata, row)
+        hintnode = cachedata.find(gsns + 'encoded_hints')
+        if hintnode is not None:
+            rec['hint'] = { 'cache_id': cache_id, 'hint': hintnode.text }
+        for bugnode in cachedata.findall(gsns + 'travelbugs/' + gsns + 'travelbug'):
+            rec['bugs'].append(mapFields(bugfields, bugnode, {
+                'ref': bugnode.get('ref'),
+                'id': int(bugnode.get('id')),
+                'cache_id': cache_id
+                }))
+        for lognode in cachedata.findall(gsns + 'logs/' + gsns + 'log'):
+            rec['logs'].append(mapFields(logfields, lognode, {
+                'id': int(lognode.get('id')),
+                'cache_id': cache_id
+                }))
+    else:
+        row['loc_type'] = 1
+        row['refers_to'] = -1
+    row['lat'] = Decimal(wpt.get('lat'))
+    row['lon'] = Decimal(wpt.get('lon'))
+    mapFields(wptfields, wpt, row)
+    if cachedata:
+        rec['cache'] = dict(filter(lambda x: x[0] in cachecols, row.items()))
+    else:
+        rec['location'] = dict(filter(lambda x: x[0] in locationcols, row.items()))
+    rec['url_name'] = row.get('url_name')
+    return rec
+
+def recordChunks(data, stats, size=None, prints=None):
+    """
+    Yields the waypoint records of a gpx file in lists of up to size
+    (by default chunksize) records, leaving out (and counting in stats)
+    waypoints whose fingerprint is in prints (see loadFingerprints).
+    Nothing in here touches the database.
+    """
+    if size is None:
+        size = chunksize
+    if prints is None:
+        prints = set()
+    chunk = []
+    start = time.time()
+    for wpt in iterwpts(data):
+        stats['waypoints'] += 1
+        fingerprint = wptFingerprint(wpt)
+        if fingerprint in prints:
+            stats['skipped'] += 1
+            continue
+        rec = wptRecord(wpt, fingerprint)
+        stats['logs'] += len(rec['logs'])
+        chunk.append(rec)
+        if len(chunk) >= size:
+            stats.addTime('parse', time.time() - start)
+            yield chunk
+            start = time.time()
+            chunk = []
+    stats.addTime('parse', time.time() - start)
+    if len(chunk) > 0:
+        yield chunk
+
+def parse(data, maint=True, bulk=False, stats=None, prints=None):
+    """
+    Imports a gpx file. data can be a string or a file-like object. With
+    bulk set, rows are written with batched Core inserts and updates, and
+    the secondary indexes are paused until the load is finished (see
+    sadbobjects.beginBulkLoad). Timings and counters go into stats when
+    given, otherwise into a new ImportStats which is reported at the end.
+    prints are the fingerprints to skip; callers parsing several files in
+    a row should load them once with loadFingerprints and pass them in,
+    otherwise they are loaded here. Returns the ImportStats.
+    """
+    ownstats = stats is None
+    if ownstats:
+        stats = ImportStats()
+    if prints is None:
+        prints = loadFingerprints()
+    if bulk:
+        cache901.sadbobjects.beginBulkLoad()
+    try:
+        cache_counter = 0
+        for chunk in recordChunks(data, stats, cache901.cfg().importchunksize, prints):
+            cache_counter = applyChunk(chunk, cache_counter, bulk, stats)
+    finally:
+        if bulk:
+            stats.timed('indexes', cache901.sadbobjects.endBulkLoad)
+    stats.timed('indexes', cache901.sadbobjects.syncFullText)
+    stats.timed('indexes', cache901.sadbobjects.refreshCacheStatus)
     if maint:
-        cache901.db().maintdb()
+        stats.timed('maint', cache901.db().maintdb)
+    if ownstats:
+        stats.finish(u'gpx file')
+    cache901.progress.flush()
+    return stats
+
+def gpxSources(path):
+    """
+    Returns the gpx sources found at path, in the form parseSource takes
+    them: the path itself for a gpx file, and one (path, member) tuple per
+    gpx file inside a zip file.
+    """
+    if path.lower().endswith('.zip'):
+        zfile = zipfile.ZipFile(path)
+        return map(lambda x: (path, x), filter(lambda x: x.lower().endswith('.gpx'), zfile.namelist()))
+    elif path.lower().endswith('.gpx'):
+        return [path]
+    return []
+
+def sourceName(source):
+    if isinstance(source, tuple):
+        return os.sep.join(source)
+    return source
+
+def openSource(source):
+    if isinstance(source, tuple):
+        zpath, member = source
+        return zipfile.ZipFile(zpath).open(member)
+    return open(source)
+
+# How many chunks a pool worker may parse ahead of the chunk being written
+queuedchunks = 4
+
+def parseSource(args):
+    """
+    Process pool side of importSources. Reads and parses a single gpx
+    source, putting its records on queue one chunk of size at a time, and
+    then None. The queue only holds a few chunks, so a worker which is
+    ahead of the writer waits for it instead of piling up records. Returns
+    the ImportStats counters and timings. Only plain dicts, strings,
+    numbers and dates are sent back, so chunks pickle cheaply, and the
+    worker never touches the database.
+    """
+    source, queue, size = args
+    data = openSource(source)
+    stats = ImportStats()
+    try:
+        for chunk in recordChunks(data, stats, size, knownprints):
+            queue.put(chunk)
+    finally:
+        # Also after an error, which the pool hands on to importSources
+        queue.put(None)
+        data.close()
+    return stats.counts, stats.times
+
+def importSources(sources, maint=True, bulk=False, processes=None, stats=None):
+    """
+    Imports many gpx sources (see gpxSources) at once. The parsing is spread
+    over a process pool with one worker per cpu by default, while this
+    process stays the only database writer, applying each file's records
+    in the order the sources were given. Without the multiprocessing module,
+    or with a single source, the files are parsed here, one after another.
+    Either way records are written a chunk at a time as they are parsed,
+    so memory use does not grow with the size of the files. stats works as
+    in parse.
+    """
+    sources = list(sources)
+    ownstats = stats is None
+    if ownstats:
+        stats = ImportStats()
+    size = cache901.cfg().importchunksize
+    prints = loadFingerprints()
+    if multiprocessing is not None and len(sources) > 1 and processes != 1:
+        manager = multiprocessing.Manager()
+        queues = map(lambda x: manager.Queue(queuedchunks), sources)
+        pool = multiprocessing.Pool(processes, setFingerprints, (prints,))
+        results = pool.imap(parseSource, map(lambda x: (x[0], x[1], size), zip(sources, queues)))
+    else:
+        pool = None
+    if bulk:
+        cache901.sadbobjects.beginBulkLoad()
+    try:
+        cache_counter = 0
+        for i, source in enumerate(sources):
+            cache901.notify('Processing %s' % sourceName(source))
+            if pool is None:
+                data = openSource(source)
+                try:
+                    for chunk in recordChunks(data, stats, size, prints):
+                        cache_counter = applyChunk(chunk, cache_counter, bulk, stats)
+                finally:
+                    data.close()
+            else:
+                chunk = queues[i].get()
+                while chunk is not None:
+                    cache_counter = applyChunk(chunk, cache_counter, bulk, stats)
+                    chunk = queues[i].get()
+                counts, times = results.next()
+                stats.merge(counts, times)
+            cache901.notify('Completed processing %s' % sourceName(source))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+            manager.shutdown()
+        if bulk:
+            stats.timed('indexes', cache901.sadbobjects.endBulkLoad)
+    stats.timed('indexes', cache901.sadbobjects.syncFullText)
+    stats.timed('indexes', cache901.sadbobjects.refreshCacheStatus)
+    if maint:
+        stats.timed('maint', cache901.db().maintdb)
+    if ownstats:
+        stats.finish(u'%d gpx files' % len(sources))
+    cache901.progress.flush()
+    return stats
+
+def applyChunk(records, cache_counter=0, bulk=False, stats=None):
+    """
+    Writes a chunk of records and commits it. ORM objects the chunk brought
+    into the session are expunged again afterwards, so the session only
+    ever holds about one chunk, and whatever was imported before a failure
+    stays imported.
+    """
+    if stats is None:
+        stats = ImportStats()
+    db = cache901.db()
+    before = set(db.identity_map.keys())
+    for rec in records:
+        if rec['url_name'] is not None:
+            if cache_counter == 0:
+                cache901.notify("Processing %s" % cache901.util.forceAscii(rec['url_name']))
+            cache_counter = (cache_counter + 1) % 5
+    # Whatever the apply functions do not charge to lookup counts as write
+    start = time.time()
+    lookup = stats.times['lookup']
+    if bulk:
+        bulkApplyChunk(records, stats)
+    else:
+        ormApplyChunk(records, stats)
+    stats.addTime('write', time.time() - start - (stats.times['lookup'] - lookup))
+    stats.timed('commit', db.commit)
+    # Objects which were in the session before this chunk may still be in
+    # use (by the gui, say), so those stay
+    for key, obj in db.identity_map.items():
+        if key not in before:
+            db.expunge(obj)
+    return cache_counter
+
+def ormApplyChunk(records, stats):
+    # New children are attached through their many-to-one backref rather
+    # than appended to the cache's collections, so existing caches never
+    # lazy load those collections during an import.
+    db = cache901.db()
+    found = stats.timed('lookup', ImportResolver, records)
+    for rec in records:
+        if rec['cache'] is None:
+            # Waypoints which are not caches have no id of their own in a
+            # gpx file, so each one is added as a new location
+            loc = Locations()
+            db.add(loc)
+            stats['added'] += 1
+            for col, val in rec['location'].items():
+                setattr(loc, col, val)
+            continue
+        cache_id = rec['cache']['cache_id']
+        cache = found.caches.get(cache_id)
+        if not cache:
+            cache = Caches()
+            db.add(cache)
+            found.caches[cache_id] = cache
+            stats['added'] += 1
+        else:
+            stats['updated'] += 1
+        for col, val in rec['cache'].items():
+            setattr(cache, col, val)
+        if rec['hint'] is not None:
+            hint = found.hints.get(cache_id)
+            if not hint:
+                hint = Hints()
+                hint.cache = cache
+                found.hints[cache_id] = hint
+            hint.hint = rec['hint']['hint']
+            hint.cache_id = cache_id
+        for row in rec['bugs']:
+            bug = found.bugs.get(row['ref'])
+            if not bug:
+                bug = TravelBugs()
+                bug.cache = cache
+                found.bugs[row['ref']] = bug
+            for col, val in row.items():
+                setattr(bug, col, val)
+        for row in rec['logs']:
+            log = found.logs.get(row['id'])
+            if not log:
+                log = Logs()
+                log.cache = cache
+                found.logs[row['id']] = log
+            for col, val in row.items():
+                setattr(log, col, val)
+    db.flush()
+
+def existingKeys(column, values):
+    return set(map(lambda x: x[0], inQuery(cache901.db().query(column), column, values)))
+
+def bulkApplyChunk(records, stats):
+    """
+    Writes a chunk of records with executemany inserts for new rows and
+    executemany updates for existing ones, bypassing the ORM entirely.
+    Updates only touch the columns present in the gpx data, so locally
+    maintained columns (my_log, my_log_uploaded, ...) survive a reload.
+    """
+    start = time.time()
+    cacheids, logids, bugrefs = recordKeys(records)
+    known = {
+        'caches': existingKeys(Caches.cache_id, cacheids),
+        'hints': existingKeys(Hints.cache_id, cacheids),
+        'logs': existingKeys(Logs.id, logids),
+        'travelbugs': existingKeys(TravelBugs.ref, bugrefs)
+        }
+    stats.addTime('lookup', time.time() - start)
+    rows = { 'caches': [], 'hints': [], 'logs': [], 'travelbugs': [] }
+    newlocs = []
+    for rec in records:
+        if rec['cache'] is None:
+            # like ormApplyChunk, every plain waypoint is a new location
+            newlocs.append(rec['location'])
+            stats['added'] += 1
+            continue
+        if rec['cache']['cache_id'] in known['caches']:
+            stats['updated'] += 1
+        else:
+            stats['added'] += 1
+        rows['caches'].append(rec['cache'])
+        if rec['hint'] is not None:
+            rows['hints'].append(rec['hint'])
+        rows['logs'].extend(rec['logs'])
+        rows['travelbugs'].extend(rec['bugs'])
+    for table, key in [(Caches.__table__, 'cache_id'), (Hints.__table__, 'cache_id'),
+                       (Logs.__table__, 'id'), (TravelBugs.__table__, 'ref')]:
+        inserts = []
+        updates = []
+        for row in rows[table.name]:
+            if row[key] in known[table.name]:
+                updates.append(row)
+            else:
+                inserts.append(row)
+                # the same key can show up twice in one chunk
+                known[table.name].add(row[key])
+        cache901.sadbobjects.bulkInsert(table, inserts)
+        cache901.sadbobjects.bulkUpdate(table, key, updates)
+    cache901.sadbobjects.bulkInsert(Locations.__table__, newlocs)
@@ -24,22 +24,20 @@ import os
 import cache901
 import cache901.xml901
 
-parser = cache901.xml901.XMLParser()
-
 def testXmlParse(xmlstr):
-    global parser
-    parser.parse(xmlstr)
+    cache901.xml901.parse(xmlstr, False)
+
+def wptElements(*samples):
+    gpx = '<gpx xmlns="http://www.topografix.com/GPX/1/0">%s</gpx>' % ''.join(samples)
+    return list(cache901.xml901.cElementTree.fromstring(gpx).findall(cache901.xml901.gpxwpt))
+
+def testWptMapping(wpts):
+    for wpt in wpts:
+        cache901.xml901.wptRecord(wpt)
 
 class XmlTest(unittest.TestCase):
     def setUp(self):
-        self.parser = cache901.xml901.XMLParser()
-        cur = cache901.db().cursor()
-        cur.execute("delete from caches")
-        cur.execute("delete from logs")
-        cur.execute("delete from locations")
-        cur.execute("delete from hints")
-        cur.execute("delete from travelbugs")
-        cache901.db().commit()
+        cache901.db().delAllCaches()
 
     def TestXmlFragments(self):
         """
@@ -96,6 +94,20 @@ class XmlTest(unittest.TestCase):
         print '\tTime to parse full cache 100 times: %3.3fs' % ttime
         print '\tParses per second: %3.3f' % (100.0/ttime)
 
+    def testWptMapping(self):
+        """
+        Times the field mapping alone (no xml parsing, no database), so the
+        cost per waypoint of the mapping tables can be watched on its own.
+        """
+        for name, sample in [('waypoint', 'waypoint'), ('simple cache', 'cache_simple'), ('full cache', 'cache_full')]:
+            t = timeit.Timer('test.Xml901Speed.testWptMapping(wpts)', 'import test.Xml901Speed\nwpts = test.Xml901Speed.wptElements(*[test.Xml901Speed.%s] * 100)' % sample)
+            print "Mapping %s 10,000 times ... " % name,
+            ttime = t.timeit(100)
+            print "Done!"
+
+            print '\tTime to map %s 10,000 times: %3.3fs' % (name, ttime)
+            print '\tMicroseconds per waypoint: %3.3f' % (ttime * 100.0)
+
     def testParseFullFile(self):
         path = cache901.__path__[0].split(os.sep)[:-3]
         path.extend(['trunk', 'docs', 'gpx', 'samples', '746247.gpx'])
@@ -20,6 +20,8 @@ with this program; if not, write to the Free Software Foundation, Inc.,
 import pysqlite2
 import unittest
 
+from cStringIO import StringIO
+
 import cache901
 import cache901.xml901
 
@@ -211,6 +213,18 @@ class XmlTest(unittest.TestCase):
         self.failUnless(row[8] == 0)
         self.failUnless(row[9] == 0)
 
+    def testStreamedWaypoints(self):
+        gpx = '<gpx xmlns="http://www.topografix.com/GPX/1/0">%s%s</gpx>' % (waypoint, cache_simple)
+        names = map(lambda x: x.find('{http://www.topografix.com/GPX/1/0}name').text, cache901.xml901.iterwpts(StringIO(gpx)))
+        self.failUnless(names == ['S1EAFC', 'GCMW2V'], "Expected ['S1EAFC', 'GCMW2V'], got %s" % names)
+
+    def testFingerprint(self):
+        changed = waypoint.replace('GCEAFC Stage 1', 'GCEAFC Stage 2')
+        gpx = '<gpx xmlns="http://www.topografix.com/GPX/1/0">%s%s\n\n%s</gpx>' % (waypoint, changed, waypoint)
+        prints = map(cache901.xml901.wptFingerprint, cache901.xml901.iterwpts(StringIO(gpx)))
+        self.failUnless(prints[0] == prints[2], "Same waypoint fingerprinted differently: %s" % prints)
+        self.failUnless(prints[0] != prints[1], "Changed waypoint kept its fingerprint: %s" % prints)
+
 #####################
 ###  XML Samples  ###
 #####################
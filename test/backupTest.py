@@ -0,0 +1,103 @@
+"""
+Cache901 - GeoCaching Software for the Asus EEE PC 901
+Copyright (C) 2008, Michael J. Pedersen <m.pedersen@icelus.org>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import unittest
+import os
+import os.path
+import shutil
+import sqlite3
+import tempfile
+
+import cache901
+import cache901.backup
+import cache901.sadbobjects
+
+def rows(path):
+    con = sqlite3.connect(path)
+    try:
+        return con.execute('select id, note from notes order by id').fetchall()
+    finally:
+        con.close()
+
+class backupTest(unittest.TestCase):
+    # Backs up databases of its own, in a home directory of its own, so
+    # that the real databases and backups are never touched
+    def setUp(self):
+        self.debugging = cache901.sadbobjects.engine is not None and str(cache901.sadbobjects.engine.url).endswith(':memory:')
+        self.home = os.environ['HOME']
+        self.tmphome = tempfile.mkdtemp()
+        os.environ['HOME'] = self.tmphome
+        os.makedirs(cache901.cfg().dbpath)
+        self.dbname = os.sep.join([cache901.cfg().dbpath, 'Backup Test.sqlite'])
+        con = sqlite3.connect(self.dbname)
+        con.execute('pragma journal_mode = wal')
+        con.execute('create table notes (id integer primary key, note text)')
+        # Enough rows for a few chunks, some of which stay the same
+        con.executemany('insert into notes (id, note) values (?, ?)',
+                        map(lambda x: (x, u'note %d %s' % (x, 'x' * 200)), range(5000)))
+        con.commit()
+        con.close()
+
+    def tearDown(self):
+        os.environ['HOME'] = self.home
+        shutil.rmtree(self.tmphome)
+        # restore() closes the open database
+        if cache901.sadbobjects.DBSession is None:
+            cache901.db(self.debugging)
+
+    def change(self, note):
+        con = sqlite3.connect(self.dbname, timeout=0)
+        con.execute('update notes set note = ? where id = 1', (note, ))
+        con.commit()
+        con.close()
+
+    def testRoundTrip(self):
+        first = cache901.backup.backup(2, lambda *x: None)
+        saved = rows(self.dbname)
+        self.change(u'second')
+        second = cache901.backup.backup(2, lambda *x: None)
+        self.change(u'third')
+        third = cache901.backup.backup(2, lambda *x: None)
+        self.failUnless(cache901.backup.listBackups() == [second, third])
+        # The first backup's own chunk went with it, the shared ones stayed
+        used = set()
+        for name in [second, third]:
+            for fname, size, digests in cache901.backup.readManifest(name):
+                used.update(digests)
+        stored = set()
+        for subdir in os.listdir(os.sep.join([cache901.backup.backupDir(), 'chunks'])):
+            stored.update(os.listdir(os.sep.join([cache901.backup.backupDir(), 'chunks', subdir])))
+        self.failUnless(stored == used)
+        self.failUnless(os.listdir(os.sep.join([cache901.backup.backupDir(), 'snapshot'])) == [])
+        self.change(u'fourth')
+        cache901.backup.restore(second)
+        restored = rows(self.dbname)
+        self.failUnless(restored[1] == (1, u'second'))
+        self.failUnless(restored[2:] == saved[2:])
+        self.failUnless(len(restored) == len(saved))
+
+    def testUnlocked(self):
+        # While the copy is stored, other connections can write
+        writes = []
+        def notify(message, force=False):
+            if message.startswith('Backing up'):
+                self.change(u'during')
+                writes.append(message)
+        cache901.backup.backup(1, notify)
+        self.failUnless(len(writes) > 0)
@@ -0,0 +1,74 @@
+"""
+Cache901 - GeoCaching Software for the Asus EEE PC 901
+Copyright (C) 2008, Michael J. Pedersen <m.pedersen@icelus.org>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import unittest
+
+import cache901
+import cache901.progress
+
+class RecordingSink(cache901.progress.Sink):
+    def __init__(self):
+        self.messages = []
+
+    def show(self, message):
+        self.messages.append(message)
+
+class LaterSink(RecordingSink):
+    # Keeps the callbacks asked for, to run them when the test says so
+    def __init__(self):
+        RecordingSink.__init__(self)
+        self.callbacks = []
+
+    def later(self, delay, func):
+        self.callbacks.append(func)
+        return True
+
+class progressTest(unittest.TestCase):
+    def setUp(self):
+        self.sink = RecordingSink()
+        self.progress = cache901.progress.Progress([self.sink], 60)
+
+    def testRateLimit(self):
+        for i in range(100):
+            self.progress.notify('message %d' % i)
+        self.failUnless(self.sink.messages == ['message 0'], "Expected only the first message, got %s" % self.sink.messages)
+        self.progress.flush()
+        self.failUnless(self.sink.messages == ['message 0', 'message 99'], "Expected the newest message on flush, got %s" % self.sink.messages)
+
+    def testForce(self):
+        self.progress.notify('first')
+        self.progress.notify('held')
+        self.progress.notify('forced', True)
+        self.progress.flush()
+        self.failUnless(self.sink.messages == ['first', 'forced'], "Expected ['first', 'forced'], got %s" % self.sink.messages)
+
+    def testLater(self):
+        sink = LaterSink()
+        progress = cache901.progress.Progress([sink], 60)
+        for i in range(10):
+            progress.notify('message %d' % i)
+        self.failUnless(len(sink.callbacks) == 1, "Expected one callback for the held messages, got %d" % len(sink.callbacks))
+        sink.callbacks[0]()
+        self.failUnless(sink.messages == ['message 0', 'message 9'], "Expected the last held message from the callback, got %s" % sink.messages)
+
+    def testFallback(self):
+        fallback = RecordingSink()
+        progress = cache901.progress.Progress([cache901.progress.StatusBarSink()], 0, fallback)
+        progress.notify('no window')
+        self.failUnless(fallback.messages == ['no window'], "Expected the fallback sink to get the message, got %s" % fallback.messages)
@@ -0,0 +1,385 @@
+"""
+Cache901 - GeoCaching Software for the Asus EEE PC 901
+Copyright (C) 2007, Michael J. Pedersen <m.pedersen@icelus.org>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import random
+import time
+import unittest
+import timeit
+
+from xml.etree import cElementTree
+
+import cache901
+import cache901.progress
+import cache901.sadbobjects
+import cache901.search
+import cache901.xml901
+
+import test.Xml901Speed
+
+ctype = cache901.sadbobjects.CompressedText()
+
+def sampleText():
+    # The long description of the full cache sample
+    gpx = '<gpx xmlns="http://www.topografix.com/GPX/1/0">%s</gpx>' % test.Xml901Speed.cache_full
+    cache = cElementTree.fromstring(gpx).find('{http://www.topografix.com/GPX/1/0}wpt/{http://www.groundspeak.com/cache/1/0}cache')
+    return unicode(cache.find('{http://www.groundspeak.com/cache/1/0}long_description').text)
+
+def compressText(text, count):
+    for i in range(count):
+        ctype.process_bind_param(text, None)
+
+def expandText(stored, count):
+    for i in range(count):
+        ctype.process_result_value(stored, None)
+
+def sampleGpx(count):
+    # count copies of the simple cache sample, each under its own id
+    wpts = map(lambda x: test.Xml901Speed.cache_simple.replace('210735', str(900000+x)), range(count))
+    return '<gpx xmlns="http://www.topografix.com/GPX/1/0">%s</gpx>' % ''.join(wpts)
+
+def importGpx(gpx):
+    cache901.sadbobjects.beginBulkLoad()
+    try:
+        cache901.xml901.parse(gpx, False, True)
+    finally:
+        cache901.sadbobjects.endBulkLoad()
+
+def plainImportGpx(gpx):
+    # An import under the current profile, without a bulk load
+    cache901.xml901.parse(gpx, False, False)
+
+def runSearch(count):
+    for i in range(count):
+        cache901.search.execSearch({}).all()
+
+def loadRandomCaches(count):
+    # count caches scattered over a 3 by 4 degree area, and a search
+    # location in its middle
+    random.seed(901)
+    rows = map(lambda x: {'cache_id': 900000+x, 'name': u'GCSPD%d' % x, 'url_name': u'Speed %d' % x,
+                          'lat': random.uniform(39, 42), 'lon': random.uniform(-76, -72)}, range(count))
+    cache901.sadbobjects.bulkInsert(cache901.sadbobjects.Caches.__table__, rows)
+    loc = cache901.sadbobjects.Locations()
+    loc.loc_type = 2
+    loc.name = u'Speed Test Origin'
+    loc.desc = u'Speed Test Origin'
+    loc.lat = 40.5
+    loc.lon = -74.0
+    cache901.db().add(loc)
+    cache901.db().commit()
+    return loc
+
+def radiusSearch(miles, count):
+    for i in range(count):
+        cache901.search.execSearch({'searchOrigin': 'Speed Test Origin', 'searchDist': str(miles)}).all()
+
+def loadRandomLogs(count, caches):
+    # count logs of twelve random words each, spread over the first caches
+    # of loadRandomCaches
+    random.seed(901)
+    words = 'the cache was found quickly container needs maintenance wet log full thanks nice hide tftc'.split()
+    rows = map(lambda x: {'id': 900000+x, 'cache_id': 900000 + x % caches,
+                          'log_entry': u' '.join(map(lambda y: random.choice(words), range(12)))}, range(count))
+    cache901.sadbobjects.engine.execute(cache901.sadbobjects.Logs.__table__.insert(), rows)
+
+def loadRandomFinds(count, caches):
+    # count logs by a handful of finders, one of them an account, of random
+    # types and dates over the last two years
+    random.seed(901)
+    now = int(time.time())
+    rows = map(lambda x: {'id': 900000+x, 'cache_id': 900000 + random.randrange(caches),
+                          'finder': random.choice([u'speedtest', u'someone', u'else']),
+                          'type': random.choice([u'Found it', u"Didn't find it", u'Write note']),
+                          'date': now - random.randrange(730*86400)}, range(count))
+    cache901.sadbobjects.engine.execute(cache901.sadbobjects.Logs.__table__.insert(), rows)
+    acct = cache901.sadbobjects.Accounts()
+    acct.sitename = u'Speed Test'
+    acct.username = u'speedtest'
+    cache901.db().add(acct)
+    cache901.db().commit()
+    return acct
+
+def flagSearch(flag, count):
+    for i in range(count):
+        cache901.search.execSearch({flag: 'True', 'maxresults': '100'}).all()
+
+def nameSearch(text, count):
+    for i in range(count):
+        cache901.search.execSearch({'urlname': text}).all()
+
+def writeNotes(count):
+    # One note per commit, the way the gui saves them
+    for i in range(count):
+        cache = cache901.db().query(cache901.sadbobjects.Caches).get(900000+i)
+        cache.notes.append(cache901.sadbobjects.Notes(note=u'Speed test note %d' % i))
+        cache901.db().commit()
+
+def cachedSearch(params, count, hit):
+    # count searches, each a hit or a miss of the result cache
+    for i in range(count):
+        if not hit:
+            cache901.search.resultcache.clear()
+        cursor = cache901.search.searchCursor(params)
+        cursor.count()
+        cursor.row(0)
+
+def pageThrough(params, sort, pages):
+    # The first pages of a fresh cursor, the way the cache list scrolls
+    cache901.search.resultcache.clear()
+    cursor = cache901.search.searchCursor(params, sort)
+    cursor.count()
+    for i in range(pages):
+        cursor.row(i * cursor.pagesize)
+
+def textSearch(text, count):
+    for i in range(count):
+        cache901.search.execSearch({'fulltext': text}).all()
+
+class sadbobjectsTest(unittest.TestCase):
+    def setUp(self):
+        self.compresstext = cache901.sadbobjects.compresstext
+        cache901.sadbobjects.compresstext = True
+        self.profile = cache901.sadbobjects.profile
+        # Progress messages are not part of what is being timed
+        self.sinks = cache901.progress.reporter.sinks
+        cache901.progress.setSinks([cache901.progress.NullSink()])
+
+    def tearDown(self):
+        cache901.sadbobjects.compresstext = self.compresstext
+        cache901.sadbobjects.setProfile(self.profile)
+        cache901.progress.setSinks(self.sinks)
+
+    def testCompressedText(self):
+        text = sampleText()
+        stored = ctype.process_bind_param(text, None)
+        print "Compressed text storage"
+        print '\tText size: %d bytes, stored size: %d bytes (%3.1f:1)' % (len(text.encode('utf8')), len(stored), float(len(text.encode('utf8'))) / len(stored))
+
+        t = timeit.Timer('test.sadbobjectsSpeed.compressText(text, 1000)', 'import test.sadbobjectsSpeed\ntext = test.sadbobjectsSpeed.sampleText()')
+        print "Compressing text 1,000 times",
+        ttime = t.timeit(1)
+        print "Done!"
+
+        print '\tTime to compress text 1,000 times: %3.3fs' % ttime
+        print '\tCompressions per second: %3.3f' % (1000.0/ttime)
+
+        t = timeit.Timer('test.sadbobjectsSpeed.expandText(stored, 1000)', 'import test.sadbobjectsSpeed\nstored = test.sadbobjectsSpeed.ctype.process_bind_param(test.sadbobjectsSpeed.sampleText(), None)')
+        print "Expanding text 1,000 times",
+        ttime = t.timeit(1)
+        print "Done!"
+
+        print '\tTime to expand text 1,000 times: %3.3fs' % ttime
+        print '\tExpansions per second: %3.3f' % (1000.0/ttime)
+
+    def testProfiles(self):
+        print "Storage profiles"
+        for name in sorted(cache901.sadbobjects.profiles.keys()):
+            if name == 'bulk-import':
+                # Only ever active inside of a bulk load
+                continue
+            cache901.sadbobjects.setProfile(name)
+            cache901.db().delAllCaches()
+            cache901.db().commit()
+
+            t = timeit.Timer('test.sadbobjectsSpeed.plainImportGpx(gpx)', 'import test.sadbobjectsSpeed\ngpx = test.sadbobjectsSpeed.sampleGpx(500)')
+            print "Importing 500 caches with the %s profile" % name,
+            ttime = t.timeit(1)
+            print "Done!"
+
+            print '\tTime to import 500 caches: %3.3fs' % ttime
+            print '\tCaches per second: %3.3f' % (500.0/ttime)
+
+            t = timeit.Timer('test.sadbobjectsSpeed.runSearch(20)', 'import test.sadbobjectsSpeed')
+            print "Searching 20 times with the %s profile" % name,
+            ttime = t.timeit(1)
+            print "Done!"
+
+            print '\tTime to search 20 times: %3.3fs' % ttime
+            print '\tSearches per second: %3.3f' % (20.0/ttime)
+        # A bulk load switches to the bulk-import profile by itself
+        cache901.sadbobjects.setProfile(self.profile)
+        cache901.db().delAllCaches()
+        cache901.db().commit()
+        t = timeit.Timer('test.sadbobjectsSpeed.importGpx(gpx)', 'import test.sadbobjectsSpeed\ngpx = test.sadbobjectsSpeed.sampleGpx(500)')
+        print "Importing 500 caches with the bulk-import profile",
+        ttime = t.timeit(1)
+        print "Done!"
+
+        print '\tTime to import 500 caches: %3.3fs' % ttime
+        print '\tCaches per second: %3.3f' % (500.0/ttime)
+        cache901.db().delAllCaches()
+        cache901.db().commit()
+
+    def testRadiusSearch(self):
+        cache901.db().delAllCaches()
+        loc = loadRandomCaches(50000)
+        print "Radius searches over 50,000 caches (spatial index: %s)" % cache901.sadbobjects.spatialindex
+        for miles in [5, 25]:
+            t = timeit.Timer('test.sadbobjectsSpeed.radiusSearch(%d, 10)' % miles, 'import test.sadbobjectsSpeed')
+            print "Searching within %d miles 10 times" % miles,
+            ttime = t.timeit(1)
+            print "Done!"
+
+            print '\tTime to search 10 times: %3.3fs' % ttime
+            print '\tSearches per second: %3.3f' % (10.0/ttime)
+        cache901.db().delete(loc)
+        cache901.db().delAllCaches()
+        cache901.db().commit()
+
+    def testNameSearch(self):
+        cache901.db().delAllCaches()
+        loc = loadRandomCaches(50000)
+        print "Name searches over 50,000 caches"
+        for text in ['GCSPD123', 'speed 4242', '*d 4242']:
+            t = timeit.Timer('test.sadbobjectsSpeed.nameSearch(%r, 10)' % text, 'import test.sadbobjectsSpeed')
+            print "Searching for %s 10 times" % text,
+            ttime = t.timeit(1)
+            print "Done!"
+
+            print '\tTime to search 10 times: %3.3fs' % ttime
+            print '\tSearches per second: %3.3f' % (10.0/ttime)
+        cache901.db().delete(loc)
+        cache901.db().delAllCaches()
+        cache901.db().commit()
+
+    def testFullTextSearch(self):
+        cache901.db().delAllCaches()
+        loc = loadRandomCaches(5000)
+        loadRandomLogs(100000, 5000)
+        print "Indexing 5,000 caches and 100,000 logs (full text index: %s)" % cache901.sadbobjects.fulltext,
+        t = timeit.Timer('cache901.sadbobjects.syncFullText()', 'import cache901.sadbobjects')
+        ttime = t.timeit(1)
+        print "Done!"
+        print '\tTime to index: %3.3fs' % ttime
+        for text in ['maintenance', '"needs maintenance"', 'speed 42*']:
+            t = timeit.Timer('test.sadbobjectsSpeed.textSearch(%r, 10)' % text, 'import test.sadbobjectsSpeed')
+            print "Searching for %s 10 times" % text,
+            ttime = t.timeit(1)
+            print "Done!"
+
+            print '\tTime to search 10 times: %3.3fs' % ttime
+            print '\tSearches per second: %3.3f' % (10.0/ttime)
+        cache901.db().delete(loc)
+        cache901.db().delAllCaches()
+        cache901.db().commit()
+
+    def testStatusFilters(self):
+        cache901.db().delAllCaches()
+        loc = loadRandomCaches(50000)
+        acct = loadRandomFinds(300000, 50000)
+        print "Summing up 50,000 caches and 300,000 logs",
+        t = timeit.Timer('cache901.sadbobjects.refreshCacheStatus()', 'import cache901.sadbobjects')
+        ttime = t.timeit(1)
+        print "Done!"
+        print '\tTime to sum up: %3.3fs' % ttime
+        for flag in ['found', 'notfoundbyme', 'foundlast7', 'notfound', 'updatedlast7', 'hasmylogs']:
+            t = timeit.Timer('test.sadbobjectsSpeed.flagSearch(%r, 10)' % flag, 'import test.sadbobjectsSpeed')
+            print "Searching with %s 10 times" % flag,
+            ttime = t.timeit(1)
+            print "Done!"
+
+            print '\tTime to search 10 times: %3.3fs' % ttime
+            print '\tSearches per second: %3.3f' % (10.0/ttime)
+        cache901.db().delete(acct)
+        cache901.db().delete(loc)
+        cache901.db().delAllCaches()
+        cache901.db().commit()
+
+    def testResultCache(self):
+        cache901.db().delAllCaches()
+        loc = loadRandomCaches(50000)
+        loadRandomLogs(100000, 50000)
+        cache901.sadbobjects.syncFullText()
+        print "Repeated searches over 50,000 caches and 100,000 logs"
+        for params in [{'fulltext': 'needs maintenance', 'maxresults': '500'}, {'searchOrigin': 'Speed Test Origin', 'searchDist': '10'}, {'urlname': 'speed 1'}]:
+            for hit in [False, True]:
+                t = timeit.Timer('test.sadbobjectsSpeed.cachedSearch(%r, 10, %r)' % (params, hit), 'import test.sadbobjectsSpeed')
+                print "Searching for %r 10 times (cached: %s)" % (params, hit),
+                ttime = t.timeit(1)
+                print "Done!"
+
+                print '\tTime to search 10 times: %3.3fs' % ttime
+                print '\tSearches per second: %3.3f' % (10.0/ttime)
+        print '\tResult cache hits: %d, misses: %d' % (cache901.search.resultcache.hits, cache901.search.resultcache.misses)
+        cache901.db().delete(loc)
+        cache901.db().delAllCaches()
+        cache901.db().commit()
+
+    def testSearchCursor(self):
+        cache901.db().delAllCaches()
+        loc = loadRandomCaches(50000)
+        cache901.db().commit()
+        print "Paging through 50,000 caches"
+        for sort in [None, 'url_name', 'difficulty']:
+            for pages in [1, 100]:
+                t = timeit.Timer('test.sadbobjectsSpeed.pageThrough({}, %r, %d)' % (sort, pages), 'import test.sadbobjectsSpeed')
+                print "Reading %d pages sorted by %s" % (pages, sort),
+                ttime = t.timeit(1)
+                print "Done!"
+
+                print '\tTime to read: %3.3fs' % ttime
+                print '\tPages per second: %3.3f' % (pages/ttime)
+        t = timeit.Timer('cursor.row(25000)', 'import cache901.search; cursor = cache901.search.searchCursor({})')
+        print "Jumping to the middle of the list",
+        ttime = t.timeit(1)
+        print "Done!"
+        print '\tTime to jump: %3.3fs' % ttime
+        cache901.db().delete(loc)
+        cache901.db().delAllCaches()
+        cache901.db().commit()
+
+    def testMemoryCopy(self):
+        cache901.db().delAllCaches()
+        loadRandomCaches(50000)
+        loadRandomLogs(100000, 50000)
+        cache901.db().commit()
+        memorycopy = cache901.cfg().memorycopy
+        for copy in [False, True]:
+            cache901.cfg().memorycopy = copy
+            cache901.sadbobjects.closeDb()
+            t = timeit.Timer('cache901.db()', 'import cache901')
+            print "Opening 50,000 caches and 100,000 logs (in memory: %s)" % copy,
+            ttime = t.timeit(1)
+            print "Done!"
+            print '\tTime to open: %3.3fs (in memory: %s)' % (ttime, cache901.sadbobjects.memorycopy is not None)
+
+            for stmt, desc in [('radiusSearch(25, 10)', 'within 25 miles'), ("nameSearch('speed 4242', 10)", 'for speed 4242')]:
+                t = timeit.Timer('test.sadbobjectsSpeed.%s' % stmt, 'import test.sadbobjectsSpeed')
+                print "Searching %s 10 times" % desc,
+                ttime = t.timeit(1)
+                print "Done!"
+
+                print '\tTime to search 10 times: %3.3fs' % ttime
+                print '\tSearches per second: %3.3f' % (10.0/ttime)
+
+            cache901.db().execute(cache901.sadbobjects.Notes.__table__.delete())
+            cache901.db().commit()
+            t = timeit.Timer('test.sadbobjectsSpeed.writeNotes(100)', 'import test.sadbobjectsSpeed')
+            print "Saving 100 notes",
+            ttime = t.timeit(1)
+            print "Done!"
+
+            print '\tTime to save 100 notes: %3.3fs' % ttime
+            print '\tNotes per second: %3.3f' % (100.0/ttime)
+        cache901.cfg().memorycopy = memorycopy
+        cache901.sadbobjects.closeDb()
+        loc = cache901.db().query(cache901.sadbobjects.Locations).filter_by(name=u'Speed Test Origin').one()
+        cache901.db().delete(loc)
+        cache901.db().delAllCaches()
+        cache901.db().commit()
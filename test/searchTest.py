@@ -0,0 +1,250 @@
+"""
+Cache901 - GeoCaching Software for the Asus EEE PC 901
+Copyright (C) 2008, Michael J. Pedersen <m.pedersen@icelus.org>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import unittest
+import time
+
+from sqlalchemy import and_, not_, func, select
+
+import cache901
+import cache901.search
+from cache901 import sadbobjects
+
+firstid = 990001
+week = 86400*7
+
+def loadFixture():
+    """
+    A handful of caches covering each of the search flags, and an account
+    for the flags about my own finds and logs. Returns the cache ids.
+    """
+    now = int(time.time())
+    caches = map(lambda x: {'cache_id': firstid+x, 'name': u'GCTST%d' % x, 'url_name': u'Search Test %d' % x,
+                            'lat': 40.0 + x / 100.0, 'lon': -75.0}, range(8))
+    caches[6]['url_name'] = u'Caf\xe9 Wally'
+    sadbobjects.bulkInsert(sadbobjects.Caches.__table__, caches)
+    logs = [
+        # found by me a long time ago
+        (firstid, now - 5*week, u'Found It', u'searchtest'),
+        # found by me this week, with a log type in another case
+        (firstid+1, now - 86400, u'found it', u'searchtest'),
+        # found by someone else long ago, and a note this week
+        (firstid+2, now - 5*week, u'Found It', u'someone'),
+        (firstid+2, now - 86400, u'Write note', u'someone'),
+        # nobody found it, but somebody wrote this week
+        (firstid+3, now - 86400, u"Didn't find it", u'searchtest'),
+        # found long ago, and nothing since
+        (firstid+4, now - 5*week, u'Found It', u'someone'),
+        ]
+    sadbobjects.engine.execute(sadbobjects.Logs.__table__.insert(),
+        map(lambda x: {'id': firstid+x[0], 'cache_id': x[1][0], 'date': x[1][1], 'type': x[1][2], 'finder': x[1][3]}, enumerate(logs)))
+    sadbobjects.engine.execute(sadbobjects.TravelBugs.__table__.insert(),
+        [{'id': firstid, 'cache_id': firstid+5, 'name': u'Search Test Bug', 'ref': u'TBTST'}])
+    sadbobjects.engine.execute(sadbobjects.Notes.__table__.insert(), [{'cache_id': firstid+6, 'note': u'A note'}])
+    sadbobjects.engine.execute(sadbobjects.Photos.__table__.insert(), [{'cache_id': firstid+6, 'photofile': u'test.jpg'}])
+    acct = sadbobjects.Accounts()
+    acct.sitename = u'Search Test'
+    acct.username = u'searchtest'
+    cache901.db().add(acct)
+    cache901.db().commit()
+    sadbobjects.refreshCacheStatus()
+    # The last cache lost its status row
+    sadbobjects.engine.execute('delete from cache_status where cache_id = %d' % (firstid+7))
+    return map(lambda x: x['cache_id'], caches)
+
+def removeFixture():
+    for table, col in [('logs', 'id'), ('travelbugs', 'id'), ('notes', 'cache_id'), ('photos', 'cache_id'), ('caches', 'cache_id')]:
+        sadbobjects.engine.execute('delete from %s where %s between %d and %d' % (table, col, firstid, firstid+99))
+    sadbobjects.engine.execute("delete from accounts where username = 'searchtest'")
+    cache901.db().commit()
+    sadbobjects.refreshCacheStatus()
+
+def queryPlan(stmt):
+    # What sqlite's explain query plan says it does for stmt, as one string
+    compiled = stmt.compile(bind=sadbobjects.engine)
+    params = map(lambda x: compiled.params[x], compiled.positiontup)
+    return ' '.join(map(lambda x: list(x)[-1], sadbobjects.engine.execute('explain query plan ' + str(compiled), params).fetchall()))
+
+def baselineFilter(flag):
+    """
+    The filter each flag used before there was a cache_status table, with
+    subqueries on the logs, travel bugs, notes and photos.
+    """
+    seconds = week
+    now = int(time.time())
+    accounts = cache901.db().query(sadbobjects.Accounts.username)
+    log_cache_ids = sadbobjects.Logs.cache_id
+    log_cache_qry = cache901.db().query(log_cache_ids.distinct().label('cache_id'))
+    cache_id = sadbobjects.Caches.cache_id
+    cachesfoundbyme = cache901.db().query(log_cache_ids).filter(and_(func.lower(sadbobjects.Logs.type) == 'found it', sadbobjects.Logs.finder.in_(accounts)))
+    return {
+        'notfoundbyme': not_(cache_id.in_(cachesfoundbyme)),
+        'found': cache_id.in_(cachesfoundbyme),
+        'foundlast7': cache_id.in_(log_cache_qry.filter(and_(sadbobjects.Logs.date >= now-seconds, log_cache_ids.in_(log_cache_qry.filter(sadbobjects.Logs.type == 'Found It'))))),
+        'notfound': not_(cache_id.in_(log_cache_qry.filter(sadbobjects.Logs.type=='Found It'))),
+        'updatedlast7': cache_id.in_(log_cache_qry.filter(sadbobjects.Logs.date >= now-seconds)),
+        'hasbugs': cache_id.in_(cache901.db().query(sadbobjects.TravelBugs.cache_id.distinct().label('cache_id'))),
+        'hasmylogs': cache_id.in_(cache901.db().query(sadbobjects.Logs.cache_id).filter(sadbobjects.Logs.finder.in_(accounts))),
+        'hasmynotes': cache_id.in_(cache901.db().query(sadbobjects.Notes.cache_id)),
+        'hasmyphotos': cache_id.in_(cache901.db().query(sadbobjects.Photos.cache_id)),
+        }[flag]
+
+class searchTest(unittest.TestCase):
+    def setUp(self):
+        self.ids = loadFixture()
+
+    def tearDown(self):
+        removeFixture()
+
+    def found(self, qry):
+        return set(filter(lambda x: x in self.ids, map(lambda x: x[0].cache_id, qry.all())))
+
+    def testStatusFlags(self):
+        caches = sadbobjects.Caches
+        expected = {
+            'notfoundbyme': [2, 3, 4, 5, 6, 7],
+            'found': [0, 1],
+            'foundlast7': [2],
+            'notfound': [1, 3, 5, 6, 7],
+            'updatedlast7': [1, 2, 3],
+            'hasbugs': [5],
+            'hasmylogs': [0, 1, 3],
+            'hasmynotes': [6],
+            'hasmyphotos': [6],
+            }
+        for flag in expected.keys():
+            new = self.found(cache901.search.execSearch({flag: 'True'}))
+            old = self.found(cache901.db().query(caches).add_column(caches.name).filter(baselineFilter(flag)))
+            self.failUnless(new == old, '%s: %s before, %s now' % (flag, sorted(old), sorted(new)))
+            self.failUnless(new == set(map(lambda x: firstid+x, expected[flag])), '%s: got %s' % (flag, sorted(new)))
+
+    def testNameSearch(self):
+        def names(pattern):
+            return self.found(cache901.search.execSearch({'urlname': pattern}))
+        everyone = set(self.ids)
+        # A prefix of either name, in any case and with or without accents
+        self.failUnless(names('search te') == everyone - set([firstid+6]))
+        self.failUnless(names('SEARCH TEST 3') == set([firstid+3]))
+        self.failUnless(names('gctst2') == set([firstid+2]))
+        self.failUnless(names(u'caf\xe9') == set([firstid+6]))
+        self.failUnless(names('CAFE W') == set([firstid+6]))
+        # Only a prefix, unless the pattern asks for more
+        self.failUnless(names('wally') == set())
+        self.failUnless(names('test 5') == set())
+        self.failUnless(names('*wally') == set([firstid+6]))
+        self.failUnless(names('search*5') == set([firstid+5]))
+        caches = sadbobjects.Caches
+        qry = cache901.db().query(caches.cache_id).filter(sadbobjects.searchKeyFilter(caches.url_name_key, 'test 5', True))
+        self.failUnless(set(map(lambda x: x[0], qry)) & everyone == set([firstid+5]))
+
+    def testNamePlan(self):
+        caches = sadbobjects.Caches
+        def plan(*args):
+            return queryPlan(select([caches.url_name, caches.lat], sadbobjects.searchKeyFilter(caches.url_name_key, *args)))
+        # A prefix is a range of the key's index
+        self.failUnless('SEARCH' in plan('search') and 'caches_url_name_key' in plan('search'), plan('search'))
+        self.failUnless('caches_url_name_key' in plan('search*5'), plan('search*5'))
+        # Matching anywhere has to look at every row
+        self.failIf('SEARCH' in plan('search', True), plan('search', True))
+        self.failIf('SEARCH' in plan('*wally'), plan('*wally'))
+
+    def testResultCache(self):
+        cache = cache901.search.resultcache
+        cache.clear()
+        hits, misses = cache.hits, cache.misses
+        first = cache901.search.searchCursor({'urlname': 'search te'})
+        self.failUnless((cache.hits, cache.misses) == (hits, misses+1))
+        # The same search, spelled another way, is a hit
+        self.failUnless(cache901.search.searchCursor({'urlname': 'SEARCH TE'}) is first)
+        self.failUnless((cache.hits, cache.misses) == (hits+1, misses+1))
+        # Another order is another entry
+        self.failIf(cache901.search.searchCursor({'urlname': 'search te'}, 'name') is first)
+        self.failUnless((cache.hits, cache.misses) == (hits+1, misses+2))
+        self.failUnless(first.count() == 7)
+        # Any write makes every entry stale
+        sadbobjects.engine.execute("update caches set url_name_key = 'x' where cache_id = %d" % firstid)
+        second = cache901.search.searchCursor({'urlname': 'search te'})
+        self.failIf(second is first)
+        self.failUnless((cache.hits, cache.misses) == (hits+1, misses+3))
+        self.failUnless(second.count() == 6)
+        self.failUnless(cache901.search.searchCursor({'urlname': 'search te'}) is second)
+        # Stale entries are dropped with the next one stored
+        self.failUnless(len(cache.entries) == 1)
+
+    def testResultCacheSize(self):
+        cache = cache901.search.ResultCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.failUnless(cache.get('a') == 1)
+        cache.put('c', 3)
+        # b was used least recently
+        self.failUnless(cache.get('b') is None)
+        self.failUnless(cache.get('a') == 1 and cache.get('c') == 3)
+        self.failUnless((cache.hits, cache.misses) == (3, 1))
+
+    def paged(self, cursor):
+        # Every row of cursor, read a few at a time from the first on, so
+        # that each page but the first starts from the one before it
+        cursor.pagesize = 3
+        cursor.refresh()
+        keys = map(cursor.rowKey, range(cursor.count()))
+        self.failUnless(cursor.row(cursor.count()) is None)
+        self.failUnless(len(cursor.bounds) > 2)
+        for index, key in enumerate(keys):
+            self.failUnless(cursor.find(key) == index, '%s is at %d, not %d' % (key, index, cursor.find(key)))
+        self.failUnless(cursor.find(firstid+99) == -1)
+        return keys
+
+    def testPaging(self):
+        caches = sadbobjects.Caches
+        mine = select([caches.cache_id, caches.lon, caches.difficulty, caches.url_name], caches.cache_id.between(firstid, firstid+99))
+        # Some have no difficulty at all
+        sadbobjects.bulkUpdate(caches.__table__, 'cache_id', map(lambda x: {'cache_id': firstid+x[0], 'difficulty': x[1]}, [(1, 2.0), (2, 1.5), (4, 2.0), (6, 1.0)]))
+        for order in [
+            # Every row tied on the sort column
+            [(caches.lon, False)],
+            [(caches.url_name, True)],
+            # Nulls come first, or last when descending
+            [(caches.difficulty, False)],
+            [(caches.difficulty, True)],
+            [(caches.difficulty, True), (caches.url_name, False)],
+            ]:
+            cursor = cache901.search.SearchCursor(mine, 'cache_id', order)
+            direct = select([caches.cache_id], caches.cache_id.between(firstid, firstid+99)).order_by(*(map(lambda x: x[1] and x[0].desc() or x[0], order) + [caches.cache_id]))
+            expected = map(lambda x: x[0], sadbobjects.engine.execute(direct))
+            self.failUnless(self.paged(cursor) == expected, '%s: %s' % (order, self.paged(cursor)))
+        self.failUnless(self.paged(cache901.search.SearchCursor(mine, 'cache_id', [(caches.difficulty, False)]))[:4] == map(lambda x: firstid+x, [0, 3, 5, 7]))
+
+    def testDistancePaging(self):
+        loc = sadbobjects.Locations(loc_type=2, name=u'Search Test Origin', lat=40.0, lon=-75.0)
+        cache901.db().add(loc)
+        # The last cache is as far away as the sixth
+        sadbobjects.bulkUpdate(sadbobjects.Caches.__table__, 'cache_id', [{'cache_id': firstid+7, 'lat': 40.05, 'lon': -75.0}])
+        cache901.db().commit()
+        try:
+            params = {'searchOrigin': 'Search Test Origin', 'searchDist': '10'}
+            nearest = map(lambda x: firstid+x, [0, 1, 2, 3, 4, 5, 7, 6])
+            keys = filter(lambda x: x in self.ids, self.paged(cache901.search.searchCursor(params)))
+            self.failUnless(keys == nearest, keys)
+            # Ties still go by id, farthest first or not
+            keys = filter(lambda x: x in self.ids, self.paged(cache901.search.searchCursor(params, None, True)))
+            self.failUnless(keys == map(lambda x: firstid+x, [6, 5, 7, 4, 3, 2, 1, 0]), keys)
+        finally:
+            cache901.db().delete(loc)
+            cache901.db().commit()
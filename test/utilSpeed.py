@@ -53,6 +53,35 @@ def sqlite_dist(lat1, lon1, lat2, lon2):
         cur.execute("select distance(?, ?, ?, ?)", (lat1, lon1, lat2, lon2))
         i += 1
 
+def sqlite_dot(lat1, lon1, lat2, lon2):
+    # The same comparison execSearch makes, in plain sql
+    con = sqlite.connect(":memory:")
+    cur = con.cursor()
+    x1, y1, z1 = cache901.util.unitVector(lat1, lon1)
+    x2, y2, z2 = cache901.util.unitVector(lat2, lon2)
+    mindot = cache901.util.dotForDistance(50)
+    i=0
+    while i < 1000:
+        cur.execute("select ?*?+?*?+?*? >= ?", (x1, x2, y1, y2, z1, z2, mindot))
+        i += 1
+
+def sqlite_table(rows):
+    con = sqlite.connect(":memory:")
+    con.create_function("distance", 4, cache901.util.distance_exact)
+    con.execute("create table caches (lat, lon, unit_x, unit_y, unit_z)")
+    for i in range(rows):
+        lat = lat1 + (i % 100) * 0.01
+        lon = lon1 + (i / 100) * 0.01
+        con.execute("insert into caches values (?, ?, ?, ?, ?)", (lat, lon) + cache901.util.unitVector(lat, lon))
+    return con
+
+def sqlite_scan_udf(con):
+    con.execute("select count(*) from caches where distance(lat, lon, ?, ?) <= 50", (lat2, lon2)).fetchall()
+
+def sqlite_scan_dot(con):
+    x, y, z = cache901.util.unitVector(lat2, lon2)
+    con.execute("select count(*) from caches where unit_x*?+unit_y*?+unit_z*? >= ?", (x, y, z, cache901.util.dotForDistance(50))).fetchall()
+
 class utilTest(unittest.TestCase):
     def testDistanceExact(self):
         t = timeit.Timer('cache901.util.distance_exact(%f, %f, %f, %f)' % (lat1, lon1, lat2, lon2), 'import cache901.util')
@@ -71,3 +100,22 @@ class utilTest(unittest.TestCase):
 
         print '\tTime to calculate sqlite estimated distance 1,000 times: %3.3fs' % ttime
         print '\tCalculations per second: %3.3f' % (1000.0/ttime)
+
+    def testSqliteDotProduct(self):
+        t = timeit.Timer('test.utilSpeed.sqlite_dot(%f, %f, %f, %f)' % (lat1, lon1, lat2, lon2), 'import test.utilSpeed')
+        print "Comparing sqlite unit vector dot products 1,000 times",
+        ttime = t.timeit(1)
+        print "Done!"
+
+        print '\tTime to compare sqlite dot products 1,000 times: %3.3fs' % ttime
+        print '\tCalculations per second: %3.3f' % (1000.0/ttime)
+
+    def testSqliteDistanceScan(self):
+        for func in ['sqlite_scan_udf', 'sqlite_scan_dot']:
+            t = timeit.Timer('test.utilSpeed.%s(con)' % func, 'import test.utilSpeed\ncon = test.utilSpeed.sqlite_table(10000)')
+            print "Filtering 10,000 rows by distance with %s 10 times" % func,
+            ttime = t.timeit(10)
+            print "Done!"
+
+            print '\tTime to filter 10,000 rows 10 times: %3.3fs' % ttime
+            print '\tRows per second: %3.3f' % (100000.0/ttime)
@@ -19,6 +19,8 @@ with this program; if not, write to the Free Software Foundation, Inc.,
 """
 
 import unittest
+import math
+import struct
 import cache901.util
 from decimal import Decimal
 
@@ -32,6 +34,26 @@ lon1 = -75.0047
 lat2 =  40.5013
 lon2 = -74.5325
 
+# Search centres for the spatial helpers: an ordinary one, one close to
+# each pole, and two either side of the date line
+centres = [(lat1, lon1), (89.95, 10.0), (-89.9, -120.0), (10.0, 179.99), (-35.0, -179.95)]
+radii = [0.5, 5, 50, 250]
+
+def destination(lat, lon, bearing, miles):
+    # The point miles from lat, lon in the direction bearing (in degrees),
+    # on the sphere distance_exact uses
+    lat = lat / 57.2958
+    lon = lon / 57.2958
+    bearing = bearing / 57.2958
+    arc = miles / 3958.75
+    lat2 = math.asin(math.sin(lat) * math.cos(arc) + math.cos(lat) * math.sin(arc) * math.cos(bearing))
+    lon2 = lon + math.atan2(math.sin(bearing) * math.sin(arc) * math.cos(lat), math.cos(arc) - math.sin(lat) * math.sin(lat2))
+    lon2 = (lon2 * 57.2958 + 540) % 360 - 180
+    return lat2 * 57.2958, lon2
+
+def dot(a, b):
+    return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+
 class utilTest(unittest.TestCase):
     def testDistanceExact(self):
         self.failUnless("%3.4f" % cache901.util.distance_exact(lat1, lon1, lat2, lon2) == "32.8086")
@@ -90,6 +112,78 @@ class utilTest(unittest.TestCase):
         ret = cache901.util.lonToDMS(Decimal("-100.555555"))
         self.failUnless(ret == 'W100%s 33\' 19.9980"' % cache901.util.degsym, "Expected %s, and got %s" % ('W100%s 33\' 19.9980"' % cache901.util.degsym, ret))
 
+    def testUnitVector(self):
+        for lat, lon in centres:
+            x, y, z = cache901.util.unitVector(lat, lon)
+            self.failUnless(abs(x*x + y*y + z*z - 1) < 1e-9)
+        x, y, z = cache901.util.unitVector(0, 90)
+        self.failUnless(abs(x) < 1e-5 and abs(y - 1) < 1e-5 and abs(z) < 1e-5)
+        # The angle between two vectors is distance_exact's distance
+        miles = 3958.75 * math.acos(dot(cache901.util.unitVector(lat1, lon1), cache901.util.unitVector(lat2, lon2)))
+        self.failUnless(abs(miles - cache901.util.distance_exact(lat1, lon1, lat2, lon2)) < 0.01)
+
+    def testDotForDistance(self):
+        # A point is within a radius by the dot product exactly when it is
+        # by distance_exact, including right on the (rounded) edge
+        for lat, lon in centres:
+            centre = cache901.util.unitVector(lat, lon)
+            for miles in radii:
+                for bearing in range(0, 360, 45):
+                    plat, plon = destination(lat, lon, bearing, miles)
+                    exact = cache901.util.distance_exact(lat, lon, plat, plon)
+                    near = dot(centre, cache901.util.unitVector(plat, plon))
+                    self.failUnless(near >= cache901.util.dotForDistance(exact), (lat, lon, miles, bearing))
+                    self.failUnless(near < cache901.util.dotForDistance(exact - 0.01), (lat, lon, miles, bearing))
+        self.failUnless(cache901.util.dotForDistance(0) < 1)
+        self.failUnless(cache901.util.dotForDistance(20000) == -1)
+
+    def testBoundingBox(self):
+        for lat, lon in centres:
+            for miles in radii:
+                minlat, maxlat, minlon, maxlon = cache901.util.boundingBox(lat, lon, miles)
+                # Points on the edge of the circle, and just inside it
+                for bearing in range(0, 360, 15):
+                    for dist in [miles, miles * 0.99]:
+                        plat, plon = destination(lat, lon, bearing, dist)
+                        self.failUnless(cache901.util.distance_exact(lat, lon, plat, plon) <= miles + 0.01)
+                        self.failUnless(minlat <= plat <= maxlat, (lat, lon, miles, bearing))
+                        self.failUnless(minlon <= plon <= maxlon, (lat, lon, miles, bearing))
+        # Away from the poles and the date line, the box stays small
+        minlat, maxlat, minlon, maxlon = cache901.util.boundingBox(lat1, lon1, 10)
+        self.failUnless(maxlat - minlat < 0.3 and maxlon - minlon < 0.4)
+        # Near a pole, or across the date line, it spans every longitude
+        self.failUnless(cache901.util.boundingBox(89.95, 10.0, 5)[2:] == (-180.0, 180.0))
+        self.failUnless(cache901.util.boundingBox(10.0, 179.99, 5)[2:] == (-180.0, 180.0))
+
+    def testSearchKey(self):
+        self.failUnless(cache901.util.searchKey(u'Caf\xe9 WALLY') == u'cafe wally')
+        self.failUnless(cache901.util.searchKey(u'\xc5ngstr\xf6m') == u'angstrom')
+        self.failUnless(cache901.util.searchKey('Caf\xc3\xa9') == u'cafe')
+        self.failUnless(cache901.util.searchKey(None) is None)
+
+    def testSearchKeyBounds(self):
+        low, high = cache901.util.searchKeyBounds(u'wally')
+        self.failUnless((low, high) == (u'wally', u'wallz'))
+        for key in [u'wally', u'wally world', u'wallyz', u'wally\uffff']:
+            self.failUnless(low <= key < high, key)
+        for key in [u'wall', u'wallx', u'wallz', u'walm', u'x']:
+            self.failIf(low <= key < high, key)
+        self.failUnless(cache901.util.searchKeyBounds(u'a') == (u'a', u'b'))
+
+    def testFtsRank(self):
+        # matchinfo's default 'pcx' layout: the phrase and column counts,
+        # then per phrase and column the hits in this row, the hits in all
+        # rows and the rows with hits. Two phrases, over name and log text.
+        blob = buffer(struct.pack('=14I', 2, 2,
+                                  2, 4, 2,   1, 2, 1,
+                                  0, 3, 3,   3, 6, 2))
+        self.failUnless(cache901.util.ftsRank(blob) == 0.5 + 0.5 + 0.5)
+        self.failUnless(cache901.util.ftsRank(blob, 10.0, 1.0) == 10 * 0.5 + 0.5 + 0.5)
+        self.failUnless(cache901.util.ftsRank(blob, 10.0) == 10 * 0.5 + 0.5 + 0.5)
+        self.failUnless(cache901.util.ftsRank(blob, 1.0, 0.0) == 0.5)
+        # A column with no hits anywhere adds nothing, and divides by nothing
+        self.failUnless(cache901.util.ftsRank(buffer(struct.pack('=5I', 1, 1, 0, 0, 0))) == 0.0)
+
     def testForceAscii(self):
         self.failUnless(cache901.util.forceAscii('abc' + u'\u1234' + '123') == 'abc123')
 